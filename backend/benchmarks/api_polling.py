@@ -0,0 +1,85 @@
+"""Load-test job status polling against a running API.
+
+Creates one job through /process (or polls an existing one given with
+--job-id), then for each concurrency level keeps that many clients polling
+GET /jobs/{id} back to back and reports throughput and latency
+percentiles. Run it against the same deployment before and after a change
+to compare how the API holds up while many clients poll at once.
+
+    python backend/benchmarks/api_polling.py --url http://localhost:8080 --concurrency 1,10,50,200
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def create_job(client, url):
+    job_id = f"bench-{uuid.uuid4()}"
+    response = await client.post(f"{url}/process", json={
+        "input_url": "http://example.invalid/benchmark.mp4",
+        "resolutions": ["720p"],
+        "job_id": job_id
+    })
+    response.raise_for_status()
+    return job_id
+
+
+async def poll(client, url, job_id, remaining, latencies, errors):
+    while remaining[0] > 0:
+        remaining[0] -= 1
+        start = time.perf_counter()
+        try:
+            response = await client.get(f"{url}/jobs/{job_id}")
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            errors[0] += 1
+
+
+async def run_level(url, job_id, concurrency, n_requests):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        latencies, errors, remaining = [], [0], [n_requests]
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            poll(client, url, job_id, remaining, latencies, errors) for _ in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+    if not latencies:
+        print(f"{concurrency:>5} clients | all {errors[0]} requests failed")
+        return
+    ms = [latency * 1000 for latency in latencies]
+    print(f"{concurrency:>5} clients | {len(latencies) / elapsed:8.0f} req/s | "
+          f"p50 {percentile(ms, 50):7.1f} ms  p95 {percentile(ms, 95):7.1f} ms  "
+          f"p99 {percentile(ms, 99):7.1f} ms  max {max(ms):7.1f} ms | {errors[0]} errors")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--job-id', help='poll an existing job instead of creating one')
+    parser.add_argument('--concurrency', default='1,10,50,200')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per concurrency level')
+    args = parser.parse_args()
+
+    url = args.url.rstrip('/')
+    job_id = args.job_id
+    if not job_id:
+        async with httpx.AsyncClient(timeout=30) as client:
+            job_id = await create_job(client, url)
+        print(f"Polling job {job_id}")
+
+    for concurrency in (int(level) for level in args.concurrency.split(',')):
+        await run_level(url, job_id, concurrency, args.requests)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""Measure the CPU seconds saved per job by encoding audio once.
+
+Runs the worker's ladder command over the same input twice: once with every
+output encoding the source audio itself (the old behaviour), and once with
+a single audio encode streamed into the ladder and copied into every
+output. Also times the audio encodes on their own, which is the part that
+changes. Reports CPU seconds (user + system, all ffmpeg processes) per job
+and per hour of source video. Without --input a 1080p test pattern with
+48 kHz stereo audio is generated.
+
+    python backend/benchmarks/audio_cpu.py --duration 60 --resolutions 1080p,720p,480p,360p,240p,144p
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from media import generate_input, ladder_outputs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'video_processor'))
+
+from ladder import build_ladder_command, start_audio_pipe  # noqa: E402
+from renditions import PROFILES, plan_renditions, apply_profile  # noqa: E402
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(fn) -> tuple:
+    cpu, start = cpu_seconds(), time.perf_counter()
+    fn()
+    return cpu_seconds() - cpu, time.perf_counter() - start
+
+
+def run_per_output(input_path, renditions, output_dir):
+    cmd = build_ladder_command(input_path, ladder_outputs(renditions, output_dir), os.cpu_count())
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+
+
+def run_shared(input_path, renditions, output_dir):
+    audio, read_fd = start_audio_pipe(input_path, renditions[0]['audio_args'])
+    try:
+        cmd = build_ladder_command(
+            input_path, ladder_outputs(renditions, output_dir), os.cpu_count(), audio_input=f'pipe:{read_fd}'
+        )
+        subprocess.run(cmd, pass_fds=[read_fd], stdout=subprocess.DEVNULL, check=True)
+    finally:
+        os.close(read_fd)
+        audio.communicate()
+
+
+def run_audio_only(input_path, audio_args, copies):
+    """Decode the audio once and encode it `copies` times, discarding the output."""
+    cmd = ['ffmpeg', '-v', 'error', '-vn', '-i', input_path]
+    for _ in range(copies):
+        cmd += ['-map', '0:a:0', *audio_args, '-f', 'null', '-']
+    subprocess.run(cmd, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--input', help='video to encode (needs ffprobe); a test pattern is generated if omitted')
+    parser.add_argument('--duration', type=int, default=30, help='length of the generated test pattern')
+    parser.add_argument('--resolutions', default='1080p,720p,480p,360p,240p,144p')
+    parser.add_argument('--profile', default='default', help='encoder profile; must encode audio (not copy it)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.input:
+            from probe import probe_media
+            input_path = args.input
+            media = probe_media(input_path)
+        else:
+            input_path = os.path.join(workdir, 'input.mp4')
+            media = generate_input(input_path, args.duration)
+
+        renditions, _ = plan_renditions(args.resolutions.split(','), media)
+        apply_profile(renditions, PROFILES[args.profile], media)
+        if renditions[0]['audio_args'] == ['-c:a', 'copy']:
+            parser.error(f"profile {args.profile} copies the source audio; nothing to share")
+        count = len(renditions)
+        hours = media['duration'] / 3600
+
+        audio_n, _ = measure(lambda: run_audio_only(input_path, renditions[0]['audio_args'], count))
+        audio_1, _ = measure(lambda: run_audio_only(input_path, renditions[0]['audio_args'], 1))
+        before_cpu, before_wall = measure(lambda: run_per_output(input_path, renditions, workdir))
+        after_cpu, after_wall = measure(lambda: run_shared(input_path, renditions, workdir))
+
+        print(f"input {media['duration']:.0f}s, {count} renditions, profile {args.profile}")
+        print(f"audio encodes alone: {count}x {audio_n:.2f} CPU s, 1x {audio_1:.2f} CPU s "
+              f"-> {audio_n - audio_1:.2f} CPU s saved per job ({(audio_n - audio_1) / hours:.0f} per hour of video)")
+        print(f"whole ladder, audio per output: {before_cpu:.1f} CPU s, {before_wall:.1f}s wall")
+        print(f"whole ladder, audio once:       {after_cpu:.1f} CPU s, {after_wall:.1f}s wall "
+              f"({before_cpu - after_cpu:+.1f} CPU s saved, {(before_cpu - after_cpu) / before_cpu * 100:.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Compare polling and blocking job dispatch.
+
+Measures enqueue-to-start latency and the Redis command rate of idle
+workers for the old polling loop and the BRPOPLPUSH-based dispatcher.
+Runs against a real Redis and uses a separate database (REDIS_DB,
+default 15) that is flushed before each run.
+
+    python backend/benchmarks/dispatch_latency.py --workers 4 --jobs 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'video_processor'))
+
+from dispatch import (  # noqa: E402
+    JOB_QUEUE, ACTIVE_JOBS, get_blocking_client, claim_next_job, ack_job, enqueue_job
+)
+
+
+STOP = '__stop__'
+
+
+def make_client():
+    return redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        db=int(os.getenv('REDIS_DB', 15)),
+        decode_responses=True,
+        socket_timeout=5
+    )
+
+
+def poll_worker(client, worker_id, enqueued_at, latencies, stop):
+    """The dispatch loop the worker used before: scard/llen/rpop with sleeps."""
+    while not stop.is_set():
+        client.smembers(ACTIVE_JOBS)
+        active_count = client.scard(ACTIVE_JOBS)
+        client.llen(JOB_QUEUE)
+        if active_count < 2:
+            job_id = client.rpop(JOB_QUEUE)
+            if job_id:
+                latencies.append(time.perf_counter() - enqueued_at[job_id])
+                continue
+        time.sleep(1)
+
+
+def blocking_worker(client, worker_id, enqueued_at, latencies, stop):
+    blocking_client = get_blocking_client(client)
+    while True:
+        job_id = claim_next_job(blocking_client, worker_id)
+        ack_job(client, worker_id, job_id)
+        if job_id == STOP:
+            break
+        latencies.append(time.perf_counter() - enqueued_at[job_id])
+
+
+def commands_processed(client):
+    return int(client.info('stats')['total_commands_processed'])
+
+
+def run(mode, n_workers, n_jobs, idle_seconds):
+    client = make_client()
+    client.flushdb()
+    target = poll_worker if mode == 'poll' else blocking_worker
+
+    enqueued_at = {}
+    latencies = []
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=target, args=(make_client(), f"bench-{i}", enqueued_at, latencies, stop), daemon=True)
+        for i in range(n_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+
+    # Idle phase: no jobs, count the commands the workers send anyway.
+    # The two INFO calls used for measuring are subtracted.
+    before = commands_processed(client)
+    time.sleep(idle_seconds)
+    idle_ops = (commands_processed(client) - before - 1) / idle_seconds
+
+    # Latency phase: jobs arrive one at a time with a gap, as in normal traffic
+    for i in range(n_jobs):
+        job_id = f"{mode}-{i}"
+        enqueued_at[job_id] = time.perf_counter()
+        enqueue_job(client, job_id)
+        time.sleep(0.05)
+    deadline = time.time() + 10
+    while len(latencies) < n_jobs and time.time() < deadline:
+        time.sleep(0.1)
+
+    stop.set()
+    if mode == 'blocking':
+        for _ in threads:
+            enqueue_job(client, STOP)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    p99 = latencies_ms[int(len(latencies_ms) * 0.99) - 1] if latencies_ms else float('nan')
+    print(f"{mode:>9} | idle ops/sec {idle_ops:8.2f} | started {len(latencies_ms)}/{n_jobs} | "
+          f"latency p50 {statistics.median(latencies_ms):8.2f} ms  p99 {p99:8.2f} ms")
+    client.flushdb()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--jobs', type=int, default=100)
+    parser.add_argument('--idle-seconds', type=int, default=10)
+    args = parser.parse_args()
+
+    for mode in ('poll', 'blocking'):
+        run(mode, args.workers, args.jobs, args.idle_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Compare the throughput of encoder profiles on the same ladder.
+
+Encodes one input into the requested renditions with each profile, using
+the worker's own single-pass ladder command (decode once, split, scale,
+encode every rendition, threads split by cost over all cores), and reports
+wall time, encode speed (seconds of video per second), CPU seconds and
+output size, relative to the first profile.
+Without --input a 1080p60 test pattern with audio is generated, so the
+fps cap of the fast profiles has something to cut.
+
+    python backend/benchmarks/encoder_profiles.py --profiles default,fast --duration 30
+    python backend/benchmarks/encoder_profiles.py --input talk.mp4 --resolutions 1080p,720p,360p
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from media import generate_input, ladder_outputs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'video_processor'))
+
+from ladder import build_ladder_command  # noqa: E402
+from renditions import PROFILES, plan_renditions, apply_profile  # noqa: E402
+
+
+def run_profile(name: str, input_path: str, media: dict, resolutions: list) -> dict:
+    renditions, _ = plan_renditions(resolutions, media)
+    apply_profile(renditions, PROFILES[name], media)
+    with tempfile.TemporaryDirectory() as output_dir:
+        cmd = build_ladder_command(input_path, ladder_outputs(renditions, output_dir), os.cpu_count())
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        # The worker reads -progress from stdout; nothing needs it here
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        wall = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        size = sum(os.path.getsize(os.path.join(output_dir, f)) for f in os.listdir(output_dir))
+    return {
+        "wall": wall,
+        "cpu": (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        "speed": media['duration'] / wall,
+        "size": size
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--input', help='video to encode (needs ffprobe); a test pattern is generated if omitted')
+    parser.add_argument('--duration', type=int, default=20, help='length of the generated test pattern')
+    parser.add_argument('--profiles', default='default,fast')
+    parser.add_argument('--resolutions', default='1080p,720p,480p')
+    args = parser.parse_args()
+
+    profiles = args.profiles.split(',')
+    unknown = [name for name in profiles if name not in PROFILES]
+    if unknown:
+        parser.error(f"unknown profiles {unknown}; available: {list(PROFILES)}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.input:
+            from probe import probe_media
+            input_path = args.input
+            media = probe_media(input_path)
+        else:
+            input_path = os.path.join(workdir, 'input.mp4')
+            media = generate_input(input_path, args.duration, frame_rate=60)
+
+        print(f"input {media['width']}x{media['height']} @ {media['frame_rate']:.0f}fps, "
+              f"{media['duration']:.0f}s; renditions {args.resolutions}")
+        print(f"{'profile':<10} {'wall s':>8} {'speed':>8} {'cpu s':>8} {'MiB':>8} {'throughput':>11}")
+        baseline = None
+        for name in profiles:
+            result = run_profile(name, input_path, media, args.resolutions.split(','))
+            baseline = baseline or result
+            print(f"{name:<10} {result['wall']:>8.1f} {result['speed']:>7.2f}x {result['cpu']:>8.1f} "
+                  f"{result['size'] / 2**20:>8.1f} {baseline['wall'] / result['wall']:>10.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Compare KEYS-based job listing with the indexed job store.
+
+Fills a scratch Redis database (REDIS_DB, default 15, flushed first) with
+synthetic jobs and times one /jobs page served the old way (KEYS, slice,
+one read per job, sort the page) and through the job index (ZREVRANGE +
+pipelined HGETALL), both for the first page and for a page reached by
+cursor.
+
+    python backend/benchmarks/job_listing.py --sizes 10000,100000,1000000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'video_processor'))
+
+from jobstore import job_key, encode_job, index_job, list_job_ids, load_jobs  # noqa: E402
+
+PAGE_SIZE = 10
+BATCH = 10000
+
+
+def make_client():
+    return redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        db=int(os.getenv('REDIS_DB', 15)),
+        decode_responses=True,
+        socket_timeout=600
+    )
+
+
+def populate(client, n_jobs):
+    client.flushdb()
+    start = datetime(2024, 1, 1)
+    pipe = client.pipeline(transaction=False)
+    for i in range(n_jobs):
+        job = {
+            "job_id": f"job-{i}",
+            "status": "completed" if i % 4 else "failed",
+            "started_at": (start + timedelta(seconds=i)).isoformat(),
+            "conversions": {
+                res: {"resolution": res, "status": "completed", "progress": 100}
+                for res in ("1080p", "720p", "480p")
+            },
+        }
+        pipe.hset(job_key(job['job_id']), mapping=encode_job(job))
+        index_job(pipe, job)
+        if (i + 1) % BATCH == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def old_list_jobs(client, skip, limit):
+    job_keys = client.keys("job:*")
+    jobs = []
+    for key in job_keys[skip:skip + limit]:
+        job_data = client.hgetall(key)
+        if job_data:
+            jobs.append(job_data)
+    jobs.sort(key=lambda job: job['started_at'], reverse=True)
+    return jobs
+
+
+def new_list_jobs(client, cursor, limit):
+    job_ids, _, next_cursor = list_job_ids(client, cursor=cursor, limit=limit)
+    return load_jobs(client, job_ids), next_cursor
+
+
+def timed(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000')
+    parser.add_argument('--depth', type=int, default=50, help='page number used for the deep-page timing')
+    args = parser.parse_args()
+
+    client = make_client()
+    for n_jobs in (int(size) for size in args.sizes.split(',')):
+        populate(client, n_jobs)
+
+        # Walk to the deep page once to get its cursor
+        cursor = None
+        for _ in range(args.depth):
+            _, cursor = new_list_jobs(client, cursor, PAGE_SIZE)
+
+        old_first = timed(lambda: old_list_jobs(client, 0, PAGE_SIZE))
+        old_deep = timed(lambda: old_list_jobs(client, args.depth * PAGE_SIZE, PAGE_SIZE))
+        new_first = timed(lambda: new_list_jobs(client, None, PAGE_SIZE))
+        new_deep = timed(lambda: new_list_jobs(client, cursor, PAGE_SIZE))
+        print(f"{n_jobs:>9} jobs | KEYS first page {old_first:9.2f} ms  page {args.depth} {old_deep:9.2f} ms | "
+              f"index first page {new_first:7.2f} ms  page {args.depth} {new_deep:7.2f} ms")
+    client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
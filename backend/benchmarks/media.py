@@ -0,0 +1,31 @@
+"""Test inputs shared by the encoding benchmarks."""
+import os
+import subprocess
+
+
+def generate_input(path: str, duration: int, frame_rate: int = 30) -> dict:
+    """A 1080p test pattern with 48 kHz stereo AAC audio, like a typical phone or screen recording.
+
+    Returns the media info the worker would probe from it.
+    """
+    subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size=1920x1080:rate={frame_rate}:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18',
+        '-c:a', 'aac', '-ac', '2', '-b:a', '192k',
+        '-y', path
+    ], check=True)
+    return {
+        "duration": float(duration),
+        "width": 1920,
+        "height": 1080,
+        "frame_rate": float(frame_rate),
+        "audio_codec": "aac",
+        "has_audio": True
+    }
+
+
+def ladder_outputs(renditions: list, output_dir: str) -> list:
+    """The (rendition, output_path) pairs `build_ladder_command` takes, one file per rendition."""
+    return [(rendition, os.path.join(output_dir, f"{rendition['resolution']}.mp4")) for rendition in renditions]
@@ -0,0 +1,290 @@
+"""Load test: N dashboards following a job by polling versus by server-sent events.
+
+A simulated worker writes a job's progress through jobstore every
+--update-interval seconds, as worker.py does. Meanwhile --watchers clients
+follow the job, first by polling `GET /jobs/{job_id}` every
+--poll-interval seconds, as the dashboard did, then by holding
+`GET /jobs/{job_id}/events` open. For each mode it reports the HTTP
+requests made, the Redis commands the API sent, the API's CPU time (when
+this script started it), and how stale the progress the watchers saw was.
+
+The API's Redis traffic is counted by a proxy in this script, so the API
+has to connect through it. Either let the script start the API with
+REDIS_HOST/REDIS_PORT pointing at the proxy:
+
+    python backend/benchmarks/progress_streaming.py --watchers 200 \\
+        --api-command "uvicorn main:app --port 8080"
+
+or start it yourself with REDIS_PORT set to --proxy-port before the script
+times out waiting for it. The job records go straight to --redis-port.
+Needs httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+import redis
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'video_processor')
+sys.path.insert(0, SRC)
+
+from jobstore import save_job, update_conversions, set_job_status, delete_jobs  # noqa: E402
+
+
+class CommandCounter:
+    """Counts the commands in a client's RESP request stream."""
+
+    def __init__(self):
+        self.buffer = b''
+        self.commands = 0
+
+    def feed(self, data: bytes):
+        self.buffer += data
+        while True:
+            end = self._command_end()
+            if end is None:
+                return
+            self.buffer = self.buffer[end:]
+            self.commands += 1
+
+    def _command_end(self):
+        buf = self.buffer
+        line = buf.find(b'\r\n')
+        if line < 0:
+            return None
+        if buf[:1] != b'*':
+            return line + 2
+        pos = line + 2
+        for _ in range(int(buf[1:line])):
+            nl = buf.find(b'\r\n', pos)
+            if nl < 0:
+                return None
+            pos = nl + 2 + int(buf[pos + 1:nl]) + 2
+            if pos > len(buf):
+                return None
+        return pos
+
+
+class RedisProxy:
+    """Forwards connections to Redis, counting the commands sent and bytes received."""
+
+    def __init__(self, redis_host: str, redis_port: int):
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.counters = []
+        self.bytes_received = 0
+
+    @property
+    def commands(self) -> int:
+        return sum(counter.commands for counter in self.counters)
+
+    async def handle(self, reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection(self.redis_host, self.redis_port)
+        counter = CommandCounter()
+        self.counters.append(counter)
+
+        async def pipe(src, dst, on_data):
+            try:
+                while True:
+                    data = await src.read(65536)
+                    if not data:
+                        break
+                    on_data(data)
+                    dst.write(data)
+                    await dst.drain()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            finally:
+                dst.close()
+
+        def received(data):
+            self.bytes_received += len(data)
+
+        await asyncio.gather(
+            pipe(reader, upstream_writer, counter.feed),
+            pipe(upstream_reader, writer, received)
+        )
+
+
+def cpu_seconds(pid: int):
+    """User + system CPU time of a process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def simulate_worker(client, job_id: str, renditions: list, args, written: dict, done: threading.Event):
+    """Write the job's progress like a worker's ladder encode; `written[step]` is when step was stored."""
+    set_job_status(client, job_id, 'processing')
+    step = 0
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        step += 1
+        update_conversions(client, job_id, {
+            res: {"status": "processing", "progress": step, "encode": {"fps": 48.0, "speed": 1.6}}
+            for res in renditions
+        })
+        written[step] = time.monotonic()
+        time.sleep(args.update_interval)
+    set_job_status(client, job_id, 'completed', completed_at=datetime.now().isoformat())
+    done.set()
+
+
+def record(seen: dict, progress, written: dict):
+    """Note when a watcher first saw each step, up to the progress it was shown."""
+    now = time.monotonic()
+    for step in range(int(progress or 0), 0, -1):
+        if step in seen:
+            break
+        if step in written:
+            seen[step] = now - written[step]
+
+
+async def poll_watcher(http, args, job_id: str, written: dict, done: threading.Event, stats: dict):
+    seen = {}
+    await asyncio.sleep(random.uniform(0, args.poll_interval))
+    while not done.is_set():
+        response = await http.get(f"/jobs/{job_id}")
+        stats['requests'] += 1
+        record(seen, response.json()['progress'], written)
+        await asyncio.sleep(args.poll_interval)
+    stats['lags'].extend(seen.values())
+
+
+async def stream_watcher(http, args, job_id: str, written: dict, done: threading.Event, stats: dict):
+    seen = {}
+    stats['requests'] += 1
+    async with http.stream('GET', f"/jobs/{job_id}/events") as response:
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: '):
+                data = json.loads(line[len('data: '):])
+                if 'progress' in data:
+                    record(seen, data['progress'], written)
+                if event == 'snapshot' and not seen and data['status'] == 'pending':
+                    stats['connected'] += 1
+                if event == 'snapshot' and data['status'] in ('completed', 'failed'):
+                    break
+    stats['lags'].extend(seen.values())
+
+
+async def run_mode(mode: str, args, client, proxy: RedisProxy, api_pid) -> dict:
+    job_id = f"bench-{mode}-{uuid.uuid4().hex[:8]}"
+    renditions = args.renditions.split(',')
+    save_job(client, {
+        "job_id": job_id,
+        "status": "pending",
+        "started_at": datetime.now().isoformat(),
+        "conversions": {res: {"resolution": res, "status": "waiting", "progress": 0} for res in renditions},
+        "job_data": {"resolutions": renditions}
+    })
+    stats = {"requests": 0, "connected": 0, "lags": []}
+    written, done = {}, threading.Event()
+    watcher = poll_watcher if mode == 'poll' else stream_watcher
+    limits = httpx.Limits(max_connections=args.watchers + 10, max_keepalive_connections=args.watchers + 10)
+    async with httpx.AsyncClient(base_url=args.api, limits=limits, timeout=None) as http:
+        tasks = [asyncio.ensure_future(watcher(http, args, job_id, written, done, stats))
+                 for _ in range(args.watchers)]
+        # Let the streams connect before measuring
+        await asyncio.sleep(1)
+        while mode == 'stream' and stats['connected'] < args.watchers:
+            await asyncio.sleep(0.1)
+        commands, received, cpu = proxy.commands, proxy.bytes_received, cpu_seconds(api_pid) if api_pid else None
+        requests_before, started = stats['requests'], time.monotonic()
+        worker = threading.Thread(target=simulate_worker, args=(client, job_id, renditions, args, written, done))
+        worker.start()
+        await asyncio.get_running_loop().run_in_executor(None, worker.join)
+        await asyncio.wait_for(asyncio.gather(*tasks), args.poll_interval + 30)
+        elapsed = time.monotonic() - started
+    api_cpu = cpu_seconds(api_pid) - cpu if cpu is not None else None
+    delete_jobs(client, [job_id])
+    lags = sorted(stats['lags'])
+    return {
+        "mode": mode,
+        "requests_per_second": (stats['requests'] - requests_before) / elapsed,
+        "redis_commands_per_second": (proxy.commands - commands) / elapsed,
+        "redis_kbytes_per_second": (proxy.bytes_received - received) / elapsed / 1024,
+        "api_cpu_percent": api_cpu / elapsed * 100 if api_cpu is not None else None,
+        "mean_lag": sum(lags) / len(lags) if lags else None,
+        "p95_lag": lags[min(int(len(lags) * 0.95), len(lags) - 1)] if lags else None
+    }
+
+
+async def wait_for_api(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as http:
+        while True:
+            try:
+                if (await http.get('/health')).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise SystemExit(f"API not reachable at {url}")
+            await asyncio.sleep(0.5)
+
+
+def fmt(value, spec: str) -> str:
+    return 'n/a' if value is None else format(value, spec)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--watchers', type=int, default=200, help='clients following the job')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of progress updates per mode')
+    parser.add_argument('--poll-interval', type=float, default=5, help="seconds between a watcher's polls")
+    parser.add_argument('--update-interval', type=float, default=2, help="seconds between the worker's progress writes")
+    parser.add_argument('--renditions', default='1080p,720p,480p,360p')
+    parser.add_argument('--api', default='http://127.0.0.1:8080')
+    parser.add_argument('--api-command', help='start the API with this command, run from the service directory')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--proxy-port', type=int, default=6380)
+    parser.add_argument('--modes', default='poll,stream')
+    args = parser.parse_args()
+
+    proxy = RedisProxy(args.redis_host, args.redis_port)
+    server = await asyncio.start_server(proxy.handle, '127.0.0.1', args.proxy_port)
+    api = None
+    if args.api_command:
+        env = dict(os.environ, REDIS_HOST='127.0.0.1', REDIS_PORT=str(args.proxy_port))
+        api = subprocess.Popen(shlex.split(args.api_command), cwd=SRC, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = redis.Redis(host=args.redis_host, port=args.redis_port, decode_responses=True)
+    try:
+        await wait_for_api(args.api, 60)
+        results = [await run_mode(mode, args, client, proxy, api.pid if api else None)
+                   for mode in args.modes.split(',')]
+    finally:
+        if api:
+            api.terminate()
+            api.wait()
+        server.close()
+
+    print(f"{args.watchers} watchers, progress written every {args.update_interval:g}s, "
+          f"polls every {args.poll_interval:g}s; lag is seconds from a write to a watcher seeing it")
+    print(f"{'mode':<8} {'req/s':>8} {'redis cmd/s':>12} {'redis KB/s':>11} {'API CPU %':>10} "
+          f"{'mean lag':>9} {'p95 lag':>8}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['requests_per_second']:>8.1f} {r['redis_commands_per_second']:>12.1f} "
+              f"{r['redis_kbytes_per_second']:>11.1f} {fmt(r['api_cpu_percent'], '.1f'):>10} "
+              f"{fmt(r['mean_lag'], '.3f'):>9} {fmt(r['p95_lag'], '.3f'):>8}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+"""Simulate queue wait times under mixed load with each scheduling policy.
+
+Replays the same arrivals through the real queue scripts in dispatch.py,
+with simulated time: one client bulk-uploads a back catalogue of long
+videos, a few interactive clients submit short clips throughout, and an
+operator occasionally submits a high priority job. Each policy is run on an
+empty Redis:
+
+    fifo       everything on one queue, as before the scheduler
+    fair       priority classes and fair sharing between clients
+    fair+sjf   the same with SHORTEST_JOB_FIRST
+
+Reports the queue wait of each group of jobs. Uses an in-process fakeredis
+(pip install fakeredis lupa) unless --redis-port is given, in which case
+database --redis-db of that server is flushed and used.
+
+    python backend/benchmarks/scheduling.py --workers 4 --bulk-jobs 200
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'video_processor'))
+
+import dispatch  # noqa: E402
+
+
+def generate_jobs(args) -> list:
+    """(arrival, job_id, group, client, priority, work seconds) for every job, by arrival."""
+    rng = random.Random(args.seed)
+    jobs = []
+    for i in range(args.bulk_jobs):
+        jobs.append((i * 0.5, f"bulk-{i}", "bulk", "archive", "normal",
+                     dispatch.estimate_work(4, rng.uniform(1200, 3600))))
+    for c in range(args.interactive_clients):
+        t = rng.expovariate(1 / args.interactive_interval)
+        while t < args.horizon:
+            jobs.append((t, f"clip-{c}-{len(jobs)}", "interactive", f"user-{c}", "normal",
+                         dispatch.estimate_work(rng.choice([2, 3, 4]), rng.uniform(20, 180))))
+            t += rng.expovariate(1 / args.interactive_interval)
+    t = args.urgent_interval
+    while t < args.horizon:
+        jobs.append((t, f"urgent-{len(jobs)}", "urgent", "ops", "high",
+                     dispatch.estimate_work(3, rng.uniform(60, 600))))
+        t += args.urgent_interval
+    return sorted(jobs)
+
+
+def simulate(client, jobs: list, policy: str, workers: int, speed: float) -> dict:
+    """Run `jobs` through the queue with `workers` encoding at `speed`x realtime; returns waits per group."""
+    client.flushdb()
+    dispatch.SHORTEST_JOB_FIRST = policy == 'fair+sjf'
+    info = {job_id: (arrival, group) for arrival, job_id, group, _, _, _ in jobs}
+    work = {job_id: seconds for _, job_id, _, _, _, seconds in jobs}
+    events = [(job[0], 1, job) for job in jobs]
+    heapq.heapify(events)
+    idle = workers
+    waits = {}
+    while events:
+        now, kind, job = heapq.heappop(events)
+        if kind == 0:
+            idle += 1
+        else:
+            _, job_id, _, client_id, priority, seconds = job
+            if policy == 'fifo':
+                client_id, priority = dispatch.DEFAULT_CLIENT, dispatch.DEFAULT_PRIORITY
+            dispatch.enqueue_job(client, job_id, priority=priority, client_id=client_id, work=seconds, now=now)
+        while idle:
+            job_id = dispatch.pick_next_job(client, "sim", now=now)
+            if not job_id:
+                break
+            idle -= 1
+            arrival, group = info[job_id]
+            waits.setdefault(group, []).append(now - arrival)
+            heapq.heappush(events, (now + work[job_id] / speed, 0, None))
+    return waits
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='jobs encoded at once')
+    parser.add_argument('--speed', type=float, default=4.0, help='seconds of output encoded per second by one job')
+    parser.add_argument('--bulk-jobs', type=int, default=200)
+    parser.add_argument('--interactive-clients', type=int, default=5)
+    parser.add_argument('--interactive-interval', type=float, default=600, help='mean seconds between clips per client')
+    parser.add_argument('--urgent-interval', type=float, default=1800)
+    parser.add_argument('--horizon', type=float, default=4 * 3600, help='seconds over which clips keep arriving')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--redis-port', type=int)
+    parser.add_argument('--redis-db', type=int, default=15)
+    args = parser.parse_args()
+
+    if args.redis_port:
+        import redis
+        client = redis.Redis(port=args.redis_port, db=args.redis_db, decode_responses=True)
+    else:
+        import fakeredis
+        client = fakeredis.FakeRedis(decode_responses=True)
+
+    jobs = generate_jobs(args)
+    groups = sorted({job[2] for job in jobs})
+    print(f"{len(jobs)} jobs ({', '.join(f'{sum(j[2] == g for j in jobs)} {g}' for g in groups)}), "
+          f"{args.workers} workers; queue wait in minutes")
+    print(f"{'policy':<10} {'group':<12} {'mean':>8} {'p95':>8} {'max':>8}")
+    for policy in ('fifo', 'fair', 'fair+sjf'):
+        waits = simulate(client, jobs, policy, args.workers, args.speed)
+        for group in groups:
+            values = waits[group]
+            print(f"{policy:<10} {group:<12} {sum(values) / len(values) / 60:>8.1f} "
+                  f"{percentile(values, 0.95) / 60:>8.1f} {max(values) / 60:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Measure API memory use while streaming a large upload.
+
+Builds a synthetic multipart body shaped like the frontend's (`video` file,
+then `resolutions` and `cloudProvider`), generates it on the fly in request
+sized chunks, and feeds it through the streaming upload parser into a local
+stand-in for the GCS writer. The stand-in buffers `UPLOAD_CHUNK_SIZE` bytes
+before "uploading" them, like the resumable BlobWriter, and either discards
+them or appends them to a file. The growth in peak RSS over the run is
+reported next to the body size; the old `await video.read()` path needed at
+least the body size.
+
+    python backend/benchmarks/upload_memory.py --size-mb 2048
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'video_processor'))
+
+from ingest import stream_multipart_upload, UPLOAD_CHUNK_SIZE  # noqa: E402
+
+BOUNDARY = "----benchmarkboundary7MA4YWxkTrZu0gW"
+# Starlette hands request bodies over in pieces of about this size
+RECEIVE_SIZE = 64 * 1024
+
+
+class LocalWriter:
+    """Stand-in for a resumable BlobWriter: buffers one chunk, then flushes it."""
+
+    def __init__(self, path=None):
+        self.file = open(path, 'wb') if path else None
+        self.buffer = bytearray()
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= UPLOAD_CHUNK_SIZE:
+            self._flush(UPLOAD_CHUNK_SIZE)
+
+    def _flush(self, n):
+        chunk = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        if self.file:
+            self.file.write(chunk)
+
+    def close(self):
+        self._flush(len(self.buffer))
+        if self.file:
+            self.file.close()
+
+
+async def synthetic_body(size):
+    yield (
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="video"; filename="synthetic.mp4"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+    ).encode()
+    block = os.urandom(RECEIVE_SIZE)
+    sent = 0
+    while sent < size:
+        piece = block[:min(RECEIVE_SIZE, size - sent)]
+        sent += len(piece)
+        yield piece
+    yield (
+        f"\r\n--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="resolutions"\r\n\r\n'
+        '["1080p", "720p"]\r\n'
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="cloudProvider"\r\n\r\n'
+        "gcp\r\n"
+        f"--{BOUNDARY}--\r\n"
+    ).encode()
+
+
+async def run(size, path):
+    writers = []
+
+    def open_writer(filename, content_type):
+        writers.append(LocalWriter(path))
+        return writers[-1]
+
+    return await stream_multipart_upload(
+        f"multipart/form-data; boundary={BOUNDARY}", synthetic_body(size), open_writer
+    ), writers[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--to-disk', action='store_true', help='write the upload to a temp file instead of discarding it')
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    path = None
+    if args.to_disk:
+        path = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4').name
+
+    # ru_maxrss is in KiB on Linux
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.perf_counter()
+    (fields, video), writer = asyncio.run(run(size, path))
+    elapsed = time.perf_counter() - start
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+
+    if path:
+        os.remove(path)
+    assert video['size'] == size == writer.size, (video['size'], writer.size)
+    assert fields == {"resolutions": '["1080p", "720p"]', "cloudProvider": "gcp"}, fields
+    print(f"uploaded {size / 2**20:.0f} MiB in {elapsed:.1f}s ({size / 2**20 / elapsed:.0f} MiB/s)")
+    print(f"peak RSS grew by {growth / 2**20:.1f} MiB "
+          f"({growth / size * 100:.2f}% of the body; chunk size {UPLOAD_CHUNK_SIZE / 2**20:.0f} MiB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import time
+from typing import List, Optional
+
+import redis
+
+# Reuse the outputs of earlier jobs on the same content with the same
+# encode parameters instead of encoding again
+TRANSCODE_CACHE = os.getenv('TRANSCODE_CACHE', 'true').lower() == 'true'
+# Entries unused for this many seconds are evicted
+CACHE_TTL = int(os.getenv('CACHE_TTL', 30 * 24 * 3600))
+# Beyond this many entries the least recently used ones are evicted
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+
+# Sorted set of entry ids scored by when they were last used
+CACHE_INDEX = "transcode_cache:index"
+# Hash of lookup counters: hits and misses
+CACHE_STATS = "transcode_cache:stats"
+
+
+def md5_content_hash(md5_hex: str) -> str:
+    """The `content_hash` of a job's source, from the MD5 of its bytes.
+
+    Uploads through the API hash the file as it streams past, and direct
+    uploads use the MD5 storage computed, so both ways of sending the same
+    video share cache entries.
+    """
+    return f"md5:{md5_hex}"
+
+
+def cache_entry_id(content_hash: str, params: dict) -> str:
+    """Identify the output of encoding `content_hash` with `params`.
+
+    `params` holds everything that changes the output (format, rendition
+    sizes, encoder arguments), so any change to them is a different entry.
+    """
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{content_hash}:{digest}"
+
+
+def cache_key(entry_id: str) -> str:
+    return f"transcode_cache:{entry_id}"
+
+
+def cache_prefix(entry_id: str) -> str:
+    """Storage prefix of an entry's files, outside `processed/` so they outlive its lifecycle rule."""
+    return "cache/" + entry_id.replace(':', '/')
+
+
+def lookup_cache(client: redis.Redis, entry_id: str) -> Optional[dict]:
+    """Return a cache entry, marking it used, or None; counts the hit or miss."""
+    entry = client.hgetall(cache_key(entry_id))
+    pipe = client.pipeline(transaction=False)
+    if entry:
+        pipe.zadd(CACHE_INDEX, {entry_id: time.time()})
+        pipe.hincrby(CACHE_STATS, "hits", 1)
+    else:
+        pipe.hincrby(CACHE_STATS, "misses", 1)
+    pipe.execute()
+    if not entry:
+        return None
+    entry['files'] = json.loads(entry['files'])
+    return entry
+
+
+def store_cache(client: redis.Redis, entry_id: str, files: List[str]):
+    """Record an entry whose `files` have been copied under `cache_prefix(entry_id)`."""
+    pipe = client.pipeline()
+    pipe.hset(cache_key(entry_id), mapping={
+        "prefix": cache_prefix(entry_id),
+        "files": json.dumps(files),
+        "created_at": time.time()
+    })
+    pipe.zadd(CACHE_INDEX, {entry_id: time.time()})
+    pipe.execute()
+
+
+def evict_cache(client: redis.Redis) -> List[str]:
+    """Drop entries unused for CACHE_TTL and the least recently used beyond CACHE_MAX_ENTRIES.
+
+    Returns the storage prefixes of the dropped entries for the caller to
+    delete. Each entry is handed to only one caller even when several evict
+    at once.
+    """
+    expired = client.zrangebyscore(CACHE_INDEX, '-inf', time.time() - CACHE_TTL)
+    excess = client.zcard(CACHE_INDEX) - len(expired) - CACHE_MAX_ENTRIES
+    oldest = client.zrange(CACHE_INDEX, len(expired), len(expired) + excess - 1) if excess > 0 else []
+
+    evicted = []
+    for entry_id in expired + oldest:
+        if client.zrem(CACHE_INDEX, entry_id):
+            client.delete(cache_key(entry_id))
+            evicted.append(cache_prefix(entry_id))
+    return evicted
+
+
+def queue_cache_stats(pipe):
+    """Queue the commands whose results `cache_stats_from_results` reads."""
+    pipe.hgetall(CACHE_STATS)
+    pipe.zcard(CACHE_INDEX)
+
+
+def cache_stats_from_results(stats: dict, entries: int) -> dict:
+    hits = int(stats.get("hits", 0))
+    misses = int(stats.get("misses", 0))
+    return {
+        "entries": entries,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else None
+    }
@@ -0,0 +1,262 @@
+import itertools
+import json
+import math
+import os
+import socket
+import time
+from typing import Optional, Tuple
+
+import redis
+
+from dispatch import LEASE_TTL, PRIORITIES
+from slots import WORKER_SLOTS
+
+# Capacity settings read by both the API and the workers, so what the API
+# admits and reports matches what the workers actually run.
+
+# Jobs each worker runs at once; their encodes share its WORKER_SLOTS
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', max(1, WORKER_SLOTS // 2)))
+# New jobs are refused while this many are queued at their priority or above
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', 500))
+# ... or while the work queued ahead of them would take longer than this
+# (seconds) for the live workers to get through
+MAX_BACKLOG_SECONDS = int(os.getenv('MAX_BACKLOG_SECONDS', 2 * 3600))
+# Jobs each client may submit per minute on average, and in one burst
+CLIENT_RATE_LIMIT = float(os.getenv('CLIENT_RATE_LIMIT', 30))
+CLIENT_BURST = int(os.getenv('CLIENT_BURST', 10))
+# Seconds of video one job seat encodes per second (duration x renditions),
+# assumed until the workers have measured it
+DEFAULT_ENCODE_SPEED = float(os.getenv('DEFAULT_ENCODE_SPEED', 1.0))
+# Weight of each finished job in the measured encode speed
+ENCODE_SPEED_SMOOTHING = 0.2
+
+# Workers that have not checked in for this long are not counted
+WORKER_TTL = LEASE_TTL
+
+# worker_id -> time it last checked in
+WORKERS = "workers"
+# worker_id -> job seats it runs
+WORKER_SEATS = "worker_seats"
+# worker_id -> "{host}:{pid}" of the process that last took the id
+WORKER_PROCESSES = "worker_processes"
+# Measured encode speed per job seat
+ENCODE_SPEED = "capacity:encode_speed"
+
+# Blend a finished job's speed into the running average. ARGV: speed, smoothing.
+RECORD_SPEED_SCRIPT = """
+local speed = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+speed = speed + tonumber(ARGV[2]) * (tonumber(ARGV[1]) - speed)
+redis.call('SET', KEYS[1], tostring(speed))
+return tostring(speed)
+"""
+
+# Live workers and their seats, the encode speed and the queue of each
+# class. Forgets workers not seen since ARGV[1]; ARGV[2:] are the classes.
+CAPACITY_SCRIPT = """
+for _, worker in ipairs(redis.call('ZRANGEBYSCORE', 'workers', '-inf', '(' .. ARGV[1])) do
+    redis.call('ZREM', 'workers', worker)
+    redis.call('HDEL', 'worker_seats', worker)
+end
+local seats = 0
+local workers = redis.call('ZRANGE', 'workers', 0, -1)
+for _, worker in ipairs(workers) do
+    seats = seats + tonumber(redis.call('HGET', 'worker_seats', worker) or 0)
+end
+local queues = {}
+for i = 2, #ARGV do
+    local counters = redis.call('HMGET', 'job_queue:stats:' .. ARGV[i], 'queued', 'work')
+    queues[ARGV[i]] = {tonumber(counters[1] or 0), tonumber(counters[2] or 0)}
+end
+return cjson.encode({
+    workers = #workers,
+    seats = seats,
+    speed = redis.call('GET', 'capacity:encode_speed'),
+    queues = queues
+})
+"""
+
+# Take a worker id for this process, unless another one has taken it since
+# the caller looked: its holder must still be the one the caller saw, and
+# that holder must have exited or not checked in since ARGV[4]. Counts the
+# id as live straight away, so siblings starting alongside skip it.
+# ARGV: worker_id, holder seen, new holder, stale before, holder exited (1/0), now
+CLAIM_WORKER_SCRIPT = """
+if (redis.call('HGET', 'worker_processes', ARGV[1]) or '') ~= ARGV[2] then
+    return 0
+end
+local seen = tonumber(redis.call('ZSCORE', 'workers', ARGV[1]) or 0)
+if ARGV[5] ~= '1' and seen >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('HSET', 'worker_processes', ARGV[1], ARGV[3])
+redis.call('ZADD', 'workers', ARGV[6], ARGV[1])
+return 1
+"""
+
+# Token bucket per client. Returns 0 if a token was taken, otherwise the
+# seconds until one is available. ARGV: now, tokens per second, burst.
+TAKE_TOKEN_SCRIPT = """
+local now, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1] or burst)
+local updated_at = tonumber(bucket[2] or now)
+tokens = math.min(burst, tokens + (now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+def rate_limit_key(client_id: str) -> str:
+    return f"rate_limit:{client_id}"
+
+
+def _process_exited(holder: str) -> bool:
+    """Whether the process `{host}:{pid}` is known to have exited; only processes on this host can be checked."""
+    host, _, pid = holder.rpartition(':')
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, ValueError):
+        pass
+    return False
+
+
+def claim_worker_id(client: redis.Redis, role: str) -> str:
+    """Take the lowest free worker id `{name}-{role}-{n}` for this process.
+
+    `name` is WORKER_ID, or the host name (the pod name on Kubernetes), and
+    `role` tells the kinds of worker process on a host apart, e.g. the one
+    supervisord runs from those started by the API processes. Every worker
+    process gets an id of its own, so none of them resumes or cleans up
+    after a sibling that is still running. An id is free once the process
+    holding it has exited or stopped checking in, so a restarted worker
+    normally takes its predecessor's id and carries on with the jobs on its
+    processing list.
+    """
+    prefix = f"{os.getenv('WORKER_ID') or socket.gethostname()}-{role}"
+    holder = f"{socket.gethostname()}:{os.getpid()}"
+    claim = client.register_script(CLAIM_WORKER_SCRIPT)
+    for n in itertools.count():
+        worker_id = f"{prefix}-{n}"
+        seen = client.hget(WORKER_PROCESSES, worker_id) or ''
+        # A holder with this very pid is an earlier run of this container
+        exited = not seen or seen == holder or _process_exited(seen)
+        now = time.time()
+        if claim(args=[worker_id, seen, holder, now - WORKER_TTL, int(exited), now]):
+            return worker_id
+
+
+def register_worker(client: redis.Redis, worker_id: str, seats: int = MAX_CONCURRENT_JOBS):
+    """Count this worker's seats towards the cluster's capacity for the next WORKER_TTL seconds."""
+    pipe = client.pipeline()
+    pipe.zadd(WORKERS, {worker_id: time.time()})
+    pipe.hset(WORKER_SEATS, worker_id, seats)
+    pipe.execute()
+
+
+def unregister_worker(client: redis.Redis, worker_id: str):
+    pipe = client.pipeline()
+    pipe.zrem(WORKERS, worker_id)
+    pipe.hdel(WORKER_SEATS, worker_id)
+    pipe.hdel(WORKER_PROCESSES, worker_id)
+    pipe.execute()
+
+
+def live_workers(client: redis.Redis) -> list:
+    """Workers that have checked in within the last WORKER_TTL seconds.
+
+    Also takes a `redis.asyncio` client, in which case the result is awaited.
+    """
+    return client.zrangebyscore(WORKERS, time.time() - WORKER_TTL, '+inf')
+
+
+def record_encode_speed(client: redis.Redis, work_seconds: float, elapsed: float):
+    """Fold a finished job (`work_seconds` of video encoded in `elapsed` seconds) into the encode speed."""
+    if work_seconds > 0 and elapsed > 0:
+        record = client.register_script(RECORD_SPEED_SCRIPT)
+        record(keys=[ENCODE_SPEED], args=[work_seconds / elapsed, ENCODE_SPEED_SMOOTHING])
+
+
+def read_capacity(client: redis.Redis):
+    """Read what `capacity_from_snapshot` needs in one step.
+
+    Also takes a `redis.asyncio` client, in which case the result is awaited.
+    """
+    return client.eval(CAPACITY_SCRIPT, 0, time.time() - WORKER_TTL, *PRIORITIES)
+
+
+def capacity_from_snapshot(snapshot: str) -> dict:
+    """Live capacity and the backlog ahead of a new job in each priority class.
+
+    A class's backlog is the work queued in it and in the classes above,
+    since those all run first, divided by how fast the live seats get
+    through it.
+    """
+    data = json.loads(snapshot)
+    speed = float(data['speed'] or DEFAULT_ENCODE_SPEED)
+    throughput = speed * data['seats']
+    backlog = {}
+    queued = work = 0
+    for priority in PRIORITIES:
+        class_queued, class_work = data['queues'][priority]
+        queued += class_queued
+        work += max(class_work, 0)
+        backlog[priority] = {
+            "queued_jobs": queued,
+            "backlog_seconds": work / throughput if throughput else None
+        }
+    return {
+        "workers": data['workers'],
+        "job_seats": data['seats'],
+        "encode_speed": speed,
+        "backlog": backlog
+    }
+
+
+def admission_delay(capacity: dict, priority: str) -> Optional[Tuple[str, float]]:
+    """Why a job at `priority` should not be accepted now and when to retry, or None.
+
+    The retry estimate is how long the live workers need to bring the queue
+    back under the limit. Without a measure of their throughput (the backlog
+    has no duration) it falls back to WORKER_TTL, so a number always comes
+    back for the Retry-After header.
+    """
+    if not capacity['job_seats']:
+        return "No workers are running", WORKER_TTL
+    backlog = capacity['backlog'][priority]
+    seconds = backlog['backlog_seconds']
+    if backlog['queued_jobs'] >= MAX_QUEUED_JOBS:
+        excess = backlog['queued_jobs'] - MAX_QUEUED_JOBS + 1
+        if seconds is None:
+            return f"{backlog['queued_jobs']} jobs are queued ahead", WORKER_TTL
+        return (f"{backlog['queued_jobs']} jobs are queued ahead",
+                seconds * excess / backlog['queued_jobs'])
+    if seconds is not None and seconds > MAX_BACKLOG_SECONDS:
+        return f"About {seconds / 60:.0f} minutes of work is queued ahead", seconds - MAX_BACKLOG_SECONDS
+    return None
+
+
+def take_token(client: redis.Redis, client_id: str, now: Optional[float] = None):
+    """Take one of `client_id`'s job submissions; returns 0 or the seconds to wait for one.
+
+    Also takes a `redis.asyncio` client, in which case the result is awaited.
+    """
+    return client.eval(
+        TAKE_TOKEN_SCRIPT, 1, rate_limit_key(client_id),
+        time.time() if now is None else now, CLIENT_RATE_LIMIT / 60, CLIENT_BURST
+    )
+
+
+def retry_after(seconds: float) -> str:
+    """A Retry-After header value: whole seconds, at least one."""
+    return str(max(1, math.ceil(seconds)))
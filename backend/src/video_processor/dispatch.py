@@ -0,0 +1,428 @@
+import json
+import os
+import time
+from typing import List, Optional
+
+import redis
+
+# Queue used by earlier versions: a single FIFO list of job ids
+LEGACY_JOB_QUEUE = "job_queue"
+# Rung once per queued job; idle workers wait on it instead of polling
+DOORBELL = "job_queue:doorbell"
+# job_id -> scheduling record (priority, client, weight, cost, score, enqueued_at),
+# kept until the job is acknowledged so a requeued job returns to its place
+QUEUED_JOBS = "job_queue:jobs"
+ACTIVE_JOBS = "active_jobs"
+# job_id -> worker_id of the worker currently running it
+JOB_OWNERS = "job_owners"
+# job_id -> number of times the job has been requeued after a lost lease
+JOB_ATTEMPTS = "job_attempts"
+REAPER_LOCK = "reaper_lock"
+
+# Seconds a running job's lease lives without being renewed
+LEASE_TTL = int(os.getenv('JOB_LEASE_TTL', 30))
+# Jobs whose lease expires more often than this are failed instead of requeued
+MAX_JOB_ATTEMPTS = int(os.getenv('MAX_JOB_ATTEMPTS', 3))
+
+# Priority classes, highest first. A class only gets workers while every
+# higher class is empty; within a class, clients share the workers in
+# proportion to their weights.
+PRIORITIES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+# Client for jobs submitted without an identity
+DEFAULT_CLIENT = "anonymous"
+# Per-client weights as JSON, e.g. '{"partner-a": 4}'; unlisted clients weigh 1
+CLIENT_WEIGHTS = json.loads(os.getenv('CLIENT_WEIGHTS', '{}'))
+# Run each client's short jobs before its long ones. A job's size is its
+# source duration times its rendition count, so the API probes the source
+# when the job is submitted.
+SHORTEST_JOB_FIRST = os.getenv('SHORTEST_JOB_FIRST', 'false').lower() == 'true'
+# Duration assumed for a source that has not been probed
+DEFAULT_JOB_SECONDS = float(os.getenv('DEFAULT_JOB_SECONDS', 300))
+
+# The scripts below assume a single Redis node (the deployment's `redis`
+# service). The scheduling scripts pick the client to serve, and so the
+# per-client queue, processing list and lease keys they touch, inside the
+# script, so those keys cannot all be declared in KEYS up front. Redis
+# Cluster, or a proxy that prefixes key names, would need the scheduler's
+# keys moved under one hash tag first.
+
+# Renew a lease only while it still belongs to the caller
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Queue a job whose record is in QUEUED_JOBS. A client with nothing queued
+# joins its class at the class's virtual clock, so time spent idle does not
+# build up credit to crowd out the others when it returns.
+# job_queue:stats:{priority} counts the jobs queued in each class and the
+# seconds of video they add up to, and the jobs dispatched from it and
+# their total time in the queue.
+PUSH_JOB_FUNCTION = """
+local function push_job(job)
+    local entry = cjson.decode(redis.call('HGET', 'job_queue:jobs', job))
+    local clients = 'job_queue:' .. entry.priority
+    if not redis.call('ZSCORE', clients, entry.client) then
+        local vtime = tonumber(redis.call('HGET', 'job_queue:vtime:' .. entry.priority, entry.client) or 0)
+        local clock = tonumber(redis.call('GET', 'job_queue:clock:' .. entry.priority) or 0)
+        redis.call('ZADD', clients, math.max(vtime, clock), entry.client)
+    end
+    redis.call('ZADD', clients .. ':' .. entry.client, entry.score, job)
+    redis.call('LPUSH', 'job_queue:doorbell', 1)
+    local stats = 'job_queue:stats:' .. entry.priority
+    redis.call('HINCRBYFLOAT', stats, 'work', tostring(entry.cost))
+    return redis.call('HINCRBY', stats, 'queued', 1)
+end
+"""
+
+# ARGV: job_id, scheduling record as JSON. Returns the number of jobs queued
+# in the job's class.
+ENQUEUE_SCRIPT = PUSH_JOB_FUNCTION + """
+redis.call('HSET', 'job_queue:jobs', ARGV[1], ARGV[2])
+return push_job(ARGV[1])
+"""
+
+# Take the next job for a worker, record it on the worker's processing list
+# and lease it to the worker, all in one step. Classes are tried highest
+# first. Within a class the client with the lowest virtual time goes next,
+# and is then charged the job's cost divided by its weight (start-time fair
+# queuing); its own jobs go in score order.
+# ARGV: worker_id, now, lease TTL, then the priority classes, highest first.
+PICK_SCRIPT = """
+for i = 4, #ARGV do
+    local priority = ARGV[i]
+    local clients = 'job_queue:' .. priority
+    while true do
+        local head = redis.call('ZRANGE', clients, 0, 0, 'WITHSCORES')
+        if #head == 0 then
+            break
+        end
+        local client, start = head[1], tonumber(head[2])
+        local queue = clients .. ':' .. client
+        local job = redis.call('ZRANGE', queue, 0, 0)[1]
+        if not job then
+            redis.call('ZREM', clients, client)
+        else
+            redis.call('ZREM', queue, job)
+            local record = redis.call('HGET', 'job_queue:jobs', job)
+            if record then
+                local entry = cjson.decode(record)
+                local finish = start + entry.cost / entry.weight
+                redis.call('HSET', 'job_queue:vtime:' .. priority, client, tostring(finish))
+                redis.call('SET', 'job_queue:clock:' .. priority, tostring(start))
+                if redis.call('EXISTS', queue) == 1 then
+                    redis.call('ZADD', clients, tostring(finish), client)
+                else
+                    redis.call('ZREM', clients, client)
+                end
+                local stats = 'job_queue:stats:' .. priority
+                redis.call('HINCRBY', stats, 'queued', -1)
+                redis.call('HINCRBYFLOAT', stats, 'work', tostring(-entry.cost))
+                redis.call('HINCRBY', stats, 'dispatched', 1)
+                redis.call('HINCRBYFLOAT', stats, 'wait_seconds', tostring(tonumber(ARGV[2]) - entry.enqueued_at))
+                redis.call('LPUSH', 'processing:' .. ARGV[1], job)
+                redis.call('SET', 'lease:' .. job, ARGV[1], 'EX', ARGV[3])
+                redis.call('HSET', 'job_owners', job, ARGV[1])
+                redis.call('SADD', 'active_jobs', job)
+                return job
+            end
+        end
+    end
+end
+-- Nothing is queued, so any rings left belong to jobs already taken
+redis.call('DEL', 'job_queue:doorbell')
+return false
+"""
+
+# Every queued job per class and client in turn order, plus the class counters.
+# ARGV: the priority classes.
+QUEUE_SNAPSHOT_SCRIPT = """
+local snapshot = {}
+for i = 1, #ARGV do
+    local priority = ARGV[i]
+    local clients = {}
+    for _, client in ipairs(redis.call('ZRANGE', 'job_queue:' .. priority, 0, -1)) do
+        table.insert(clients, {client, redis.call('ZRANGE', 'job_queue:' .. priority .. ':' .. client, 0, -1)})
+    end
+    snapshot[priority] = {clients = clients, stats = redis.call('HGETALL', 'job_queue:stats:' .. priority)}
+end
+return cjson.encode(snapshot)
+"""
+
+# Release a finished job; the active set and owner entry are only cleared
+# if the caller still owns the job, so a worker that lost its lease cannot
+# free a job another worker has since picked up.
+ACK_SCRIPT = """
+redis.call('LREM', KEYS[1], 0, ARGV[1])
+if redis.call('HGET', KEYS[3], ARGV[1]) == ARGV[2] then
+    redis.call('SREM', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('HDEL', KEYS[4], ARGV[1])
+    redis.call('DEL', KEYS[5])
+    redis.call('HDEL', 'job_queue:jobs', ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Hand a job back to the queue, in its old place and without counting an
+# attempt, when its worker cannot run it yet. Like ACK_SCRIPT, only while
+# the caller still owns it. ARGV[3] is the scheduling record for jobs
+# queued by older versions.
+DEFER_SCRIPT = PUSH_JOB_FUNCTION + """
+redis.call('LREM', KEYS[1], 0, ARGV[1])
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('DEL', KEYS[4])
+redis.call('HSETNX', 'job_queue:jobs', ARGV[1], ARGV[3])
+push_job(ARGV[1])
+return 1
+"""
+
+# Requeue an active job whose lease has expired, in its old place. Returns 1
+# if requeued, -1 if it has run out of attempts and 0 if the lease is still
+# live. ARGV[3] is the scheduling record for jobs queued by older versions.
+REQUEUE_SCRIPT = PUSH_JOB_FUNCTION + """
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return 0
+end
+if redis.call('SREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local owner = redis.call('HGET', KEYS[2], ARGV[1])
+if owner then
+    redis.call('LREM', 'processing:' .. owner, 0, ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+local attempts = redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+if attempts > tonumber(ARGV[2]) then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('HDEL', 'job_queue:jobs', ARGV[1])
+    return -1
+end
+redis.call('HSETNX', 'job_queue:jobs', ARGV[1], ARGV[3])
+push_job(ARGV[1])
+return 1
+"""
+
+
+def processing_key(worker_id: str) -> str:
+    return f"processing:{worker_id}"
+
+
+def lease_key(job_id: str) -> str:
+    return f"lease:{job_id}"
+
+
+def get_blocking_client(client: redis.Redis) -> redis.Redis:
+    """Return a client for blocking pops that shares `client`'s connection settings.
+
+    Blocking commands wait server-side for as long as it takes, so the
+    client used for them must not have a socket timeout.
+    """
+    pool = client.connection_pool
+    kwargs = dict(pool.connection_kwargs)
+    kwargs['socket_timeout'] = None
+    kwargs['socket_keepalive'] = True
+    return redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=pool.connection_class, **kwargs
+    ))
+
+
+def client_weight(client_id: str) -> float:
+    return float(CLIENT_WEIGHTS.get(client_id, 1))
+
+
+def estimate_work(rendition_count: int, duration: Optional[float] = None) -> float:
+    """Size of a job in seconds of video to encode, assuming DEFAULT_JOB_SECONDS if unprobed."""
+    return (duration or DEFAULT_JOB_SECONDS) * max(rendition_count, 1)
+
+
+def schedule_record(priority: str = DEFAULT_PRIORITY, client_id: str = DEFAULT_CLIENT,
+                    work: float = DEFAULT_JOB_SECONDS, now: Optional[float] = None) -> str:
+    """The scheduling record of a job, as stored in QUEUED_JOBS.
+
+    Jobs of one client go in order of submission, or with SHORTEST_JOB_FIRST
+    in order of submission time plus size in seconds, so a long job is passed
+    by shorter ones for at most its own size rather than indefinitely.
+    """
+    now = time.time() if now is None else now
+    return json.dumps({
+        "priority": priority,
+        "client": client_id,
+        "weight": client_weight(client_id),
+        "cost": work,
+        "score": now + work if SHORTEST_JOB_FIRST else now,
+        "enqueued_at": now
+    })
+
+
+def enqueue_job(client: redis.Redis, job_id: str, priority: str = DEFAULT_PRIORITY,
+                client_id: str = DEFAULT_CLIENT, work: float = DEFAULT_JOB_SECONDS,
+                now: Optional[float] = None) -> int:
+    """Queue a job and return the number of jobs queued in its priority class.
+
+    `work` (see `estimate_work`) is what the client is charged against its
+    fair share. Also takes a `redis.asyncio` client, in which case the
+    result is awaited.
+    """
+    enqueue = client.register_script(ENQUEUE_SCRIPT)
+    return enqueue(args=[job_id, schedule_record(priority, client_id, work, now)])
+
+
+def migrate_legacy_queue(client: redis.Redis) -> int:
+    """Move jobs left on the old FIFO list into the scheduler, oldest first."""
+    moved = 0
+    while True:
+        job_id = client.rpop(LEGACY_JOB_QUEUE)
+        if not job_id:
+            return moved
+        enqueue_job(client, job_id)
+        moved += 1
+
+
+def take_lease(client: redis.Redis, worker_id: str, job_id: str):
+    """Mark `job_id` as running on `worker_id` under a fresh lease."""
+    pipe = client.pipeline()
+    pipe.set(lease_key(job_id), worker_id, ex=LEASE_TTL)
+    pipe.hset(JOB_OWNERS, job_id, worker_id)
+    pipe.sadd(ACTIVE_JOBS, job_id)
+    pipe.execute()
+
+
+def pick_next_job(client: redis.Redis, worker_id: str, now: Optional[float] = None) -> Optional[str]:
+    """Move the job due next onto this worker's processing list and lease it, if any is queued.
+
+    The job is chosen, recorded and leased in one script, so it is never
+    only in the worker's memory: if the worker dies, either its next run
+    finds the job on its processing list or the reaper requeues it.
+    """
+    pick = client.register_script(PICK_SCRIPT)
+    return pick(args=[worker_id, time.time() if now is None else now, LEASE_TTL, *PRIORITIES])
+
+
+def claim_next_job(blocking_client: redis.Redis, worker_id: str, timeout: int = 0) -> Optional[str]:
+    """Block until a job is queued, then take it and lease it to this worker.
+
+    While the queue is empty the worker waits on the doorbell, which every
+    queued job rings once. With `timeout=0` an idle worker sends no further
+    commands until a job arrives.
+    """
+    while True:
+        job_id = pick_next_job(blocking_client, worker_id)
+        if job_id:
+            return job_id
+        if not blocking_client.brpop(DOORBELL, timeout) and timeout:
+            return None
+
+
+def queued_at(client: redis.Redis, job_id: str) -> Optional[float]:
+    """When a claimed job was queued, from its scheduling record; None for jobs queued by older versions."""
+    record = client.hget(QUEUED_JOBS, job_id)
+    return json.loads(record).get('enqueued_at') if record else None
+
+
+def renew_leases(client: redis.Redis, worker_id: str, job_ids: List[str]) -> List[str]:
+    """Extend the leases of running jobs; returns the jobs whose lease was lost."""
+    renew = client.register_script(RENEW_LEASE_SCRIPT)
+    pipe = client.pipeline()
+    for job_id in job_ids:
+        renew(keys=[lease_key(job_id)], args=[worker_id, LEASE_TTL], client=pipe)
+    results = pipe.execute()
+    return [job_id for job_id, renewed in zip(job_ids, results) if not renewed]
+
+
+def ack_job(client: redis.Redis, worker_id: str, job_id: str) -> bool:
+    """Release a finished job. Returns False if the job had been taken over."""
+    ack = client.register_script(ACK_SCRIPT)
+    return bool(ack(
+        keys=[processing_key(worker_id), ACTIVE_JOBS, JOB_OWNERS, JOB_ATTEMPTS, lease_key(job_id)],
+        args=[job_id, worker_id]
+    ))
+
+
+def defer_job(client: redis.Redis, worker_id: str, job_id: str) -> bool:
+    """Put a claimed job back in the queue for any worker to take. Returns False if it had been taken over."""
+    defer = client.register_script(DEFER_SCRIPT)
+    return bool(defer(
+        keys=[processing_key(worker_id), ACTIVE_JOBS, JOB_OWNERS, lease_key(job_id)],
+        args=[job_id, worker_id, schedule_record()]
+    ))
+
+
+def pending_jobs(client: redis.Redis, worker_id: str) -> list:
+    """Jobs left on this worker's processing list by a previous run, oldest first.
+
+    Jobs that have since been requeued or taken over by another worker are
+    dropped from the list; the rest are leased to this worker again.
+    """
+    jobs = []
+    for job_id in reversed(client.lrange(processing_key(worker_id), 0, -1)):
+        if client.hget(JOB_OWNERS, job_id) == worker_id:
+            take_lease(client, worker_id, job_id)
+            jobs.append(job_id)
+        else:
+            client.lrem(processing_key(worker_id), 0, job_id)
+    return jobs
+
+
+def reap_expired_jobs(client: redis.Redis, interval: int = LEASE_TTL) -> List[str]:
+    """Requeue active jobs whose lease has expired.
+
+    At most one worker in the cluster reaps per `interval`. Returns the jobs
+    that ran out of attempts; the caller is expected to mark them failed.
+    """
+    if not client.set(REAPER_LOCK, "1", nx=True, ex=interval):
+        return []
+
+    requeue = client.register_script(REQUEUE_SCRIPT)
+    exhausted = []
+    for job_id in client.smembers(ACTIVE_JOBS):
+        result = requeue(
+            keys=[ACTIVE_JOBS, JOB_OWNERS, JOB_ATTEMPTS, lease_key(job_id)],
+            args=[job_id, MAX_JOB_ATTEMPTS, schedule_record()]
+        )
+        if result == 1:
+            print(f"Requeued job {job_id} after its lease expired")
+        elif result == -1:
+            print(f"Job {job_id} lost its lease {MAX_JOB_ATTEMPTS} times; giving up")
+            exhausted.append(job_id)
+    return exhausted
+
+
+def queue_snapshot(client: redis.Redis):
+    """Read the queue for `schedule_stats` in one atomic step.
+
+    Also takes a `redis.asyncio` client, in which case the result is awaited.
+    """
+    return client.eval(QUEUE_SNAPSHOT_SCRIPT, 0, *PRIORITIES)
+
+
+def schedule_stats(snapshot: str) -> dict:
+    """Per-class queue statistics from a `queue_snapshot`.
+
+    Each class lists its queued jobs per client in the order the clients
+    take their turns, and the jobs dispatched from it so far with their mean
+    time in the queue.
+    """
+    classes = json.loads(snapshot)
+    stats = {}
+    for priority in PRIORITIES:
+        data = classes[priority]
+        counters = data['stats'] or []
+        counters = dict(zip(counters[::2], counters[1::2]))
+        dispatched = int(counters.get('dispatched', 0))
+        clients = {client: list(jobs) for client, jobs in (data['clients'] or [])}
+        stats[priority] = {
+            "queued": sum(len(jobs) for jobs in clients.values()),
+            "clients": clients,
+            "dispatched": dispatched,
+            "mean_wait_seconds": float(counters.get('wait_seconds', 0)) / dispatched if dispatched else None
+        }
+    return stats
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+from typing import Dict, Optional, Set
+
+from jobstore import JOB_EVENTS_PREFIX, job_channel, decode_job
+
+# Seconds between keepalive comments on an idle event stream, so proxies
+# and browsers do not time it out
+EVENT_KEEPALIVE = float(os.getenv('EVENT_KEEPALIVE', 15))
+# Events held for a watcher that is not keeping up; past this it is sent a
+# fresh snapshot instead
+EVENT_BUFFER = 64
+
+
+def decode_delta(data: str) -> dict:
+    """Turn a published job event into the part of the job it changed.
+
+    The event holds hash fields as `jobstore` stores them, so it decodes the
+    same way as a whole record: `{"progress": 40.0, "conversions": {"720p":
+    {"progress": 38.5, "encode": {...}}}}`. `conversions` is left out when
+    no rendition changed.
+    """
+    delta = decode_job(json.loads(data)) or {}
+    if not delta.get('conversions'):
+        delta.pop('conversions', None)
+    return delta
+
+
+def apply_delta(job: dict, delta: dict):
+    """Fold an event from `decode_delta` into a job dict as `jobstore.load_job` returns it."""
+    for field, value in delta.items():
+        if field == 'conversions':
+            for resolution, conversion in value.items():
+                job['conversions'].setdefault(resolution, {}).update(conversion)
+        else:
+            job[field] = value
+
+
+class JobEventHub:
+    """Fans job events out from one Redis pub/sub connection to every watcher in this process.
+
+    Each job's channel is subscribed while anyone here watches it, so Redis
+    sends each event once per API process however many clients follow the
+    job. A watcher gets an asyncio queue of `(delta, data)` pairs, `data`
+    being the delta already serialised to JSON, or None when it fell too
+    far behind and should resynchronise from the stored job.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = client.pubsub()
+        self.watchers: Dict[str, Set[asyncio.Queue]] = {}
+        self._reader: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def watch(self, job_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENT_BUFFER)
+        watchers = self.watchers.setdefault(job_id, set())
+        watchers.add(queue)
+        if len(watchers) == 1:
+            await self.pubsub.subscribe(job_channel(job_id))
+        if self._reader is None:
+            self._reader = asyncio.get_running_loop().create_task(self._read())
+        return queue
+
+    async def unwatch(self, job_id: str, queue: asyncio.Queue):
+        watchers = self.watchers.get(job_id)
+        if not watchers:
+            return
+        watchers.discard(queue)
+        if not watchers:
+            del self.watchers[job_id]
+            try:
+                await self.pubsub.unsubscribe(job_channel(job_id))
+            except Exception as e:
+                print(f"[WARNING] Failed to unsubscribe from job {job_id} events: {str(e)}")
+
+    async def close(self):
+        # Cancelling the reader is not enough on its own: on Python 3.9 a
+        # cancellation that lands as a read completes can be swallowed, so
+        # the reader also stops at its next read timeout
+        self._closed = True
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+        await self.pubsub.close()
+
+    async def _read(self):
+        while not self._closed:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The connection resubscribes to every channel when it reconnects
+                print(f"[WARNING] Job event subscription failed: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            if message and message['type'] == 'message':
+                self._dispatch(message['channel'][len(JOB_EVENTS_PREFIX):], message['data'])
+
+    def _dispatch(self, job_id: str, data: str):
+        watchers = self.watchers.get(job_id)
+        if not watchers:
+            return
+        try:
+            delta = decode_delta(data)
+        except ValueError:
+            print(f"[WARNING] Ignoring unreadable event for job {job_id}")
+            return
+        event = (delta, json.dumps(delta))
+        for queue in watchers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Drop what it has not read; it reloads the job instead
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
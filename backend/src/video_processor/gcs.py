@@ -0,0 +1,47 @@
+import os
+from datetime import timedelta
+from typing import Optional
+from urllib.parse import quote
+
+# Point the storage client at a local fake GCS server (e.g. fake-gcs-server
+# or gcp-storage-emulator). google-cloud-storage reads this itself and
+# switches to anonymous credentials.
+STORAGE_EMULATOR_HOST = os.getenv('STORAGE_EMULATOR_HOST')
+
+
+def signed_url(blob, expiration: timedelta, method: str = "GET") -> str:
+    """Return a V4 signed URL for `blob`.
+
+    Emulators accept unauthenticated requests and cannot verify signatures,
+    so against one this returns the plain media URL for downloads instead.
+    """
+    if STORAGE_EMULATOR_HOST and method == "GET":
+        return (
+            f"{STORAGE_EMULATOR_HOST.rstrip('/')}/download/storage/v1/b/{blob.bucket.name}"
+            f"/o/{quote(blob.name, safe='')}?alt=media"
+        )
+    return blob.generate_signed_url(version="v4", expiration=expiration, method=method)
+
+
+def abandon_writer(writer):
+    """Drop a `blob.open('wb')` writer without committing its upload.
+
+    BlobWriter is an IOBase, whose finalizer calls `close()`, and closing
+    commits whatever was written so far as the object. Closing its buffer
+    instead leaves the resumable upload unfinished, so no object appears.
+    """
+    buffer = getattr(writer, '_buffer', None)
+    if buffer is not None:
+        buffer.close()
+
+
+def create_upload_session(blob, content_type: Optional[str] = None, size: Optional[int] = None,
+                          origin: Optional[str] = None) -> str:
+    """Start a resumable upload for `blob` and return its session URL.
+
+    The session URL itself authorizes the upload, so a client can PUT the
+    file straight to storage, in one request or in chunks, without
+    credentials. Pass the browser's `origin` so storage answers its CORS
+    preflight requests.
+    """
+    return blob.create_resumable_upload_session(content_type=content_type, size=size, origin=origin)
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import Executor
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+
+from multipart.multipart import MultipartParser, parse_options_header
+
+# Size of each resumable upload request to storage; must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+# File data is handed to the storage writer in blocks of at least this size
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Largest plain form field accepted alongside the file
+MAX_FIELD_SIZE = 64 * 1024
+# Seconds a direct upload may take between being started and finalized
+PENDING_UPLOAD_TTL = int(os.getenv('PENDING_UPLOAD_TTL', 24 * 60 * 60))
+
+
+class UploadError(Exception):
+    pass
+
+
+def pending_upload_key(upload_id: str) -> str:
+    return f"upload:{upload_id}"
+
+
+async def stream_multipart_upload(
+    content_type_header: str,
+    stream: AsyncIterator[bytes],
+    open_writer: Callable[[str, str], object],
+    file_field: str = "video",
+    executor: Optional[Executor] = None,
+    discard_writer: Optional[Callable[[object], None]] = None
+) -> Tuple[Dict[str, str], Optional[dict]]:
+    """Parse a multipart body as it arrives and stream its file part to storage.
+
+    `open_writer(filename, content_type)` is called once, on `executor` (the
+    loop's default executor if None), when the file part starts; it must return a file-like object whose
+    `write` and `close` may block. Writes also happen off the event loop,
+    and the next request chunk is only read once the previous write has
+    returned, so memory use stays bounded by WRITE_BUFFER_SIZE plus the
+    writer's own chunk buffer regardless of the upload size.
+
+    The file's MD5 is computed on the way through, in the same executor
+    calls as the writes, so identical uploads can be recognised later. It
+    is the digest storage keeps for uploaded objects, so files uploaded
+    straight to storage are recognised as the same content.
+
+    If the body ends or fails before the file is complete, the writer is
+    never closed; `discard_writer(writer)`, if given, is called instead.
+
+    Returns the plain form fields and `{"filename", "content_type", "size",
+    "md5"}` for the file, or None if the body had no `file_field` part.
+    """
+    loop = asyncio.get_running_loop()
+
+    def run_blocking(fn, *args):
+        return loop.run_in_executor(executor, fn, *args)
+
+    _, params = parse_options_header(content_type_header)
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise UploadError("Expected a multipart/form-data body")
+
+    events = []
+    callbacks = {
+        "on_part_begin": lambda: events.append(("part_begin", b"")),
+        "on_part_data": lambda data, start, end: events.append(("part_data", data[start:end])),
+        "on_part_end": lambda: events.append(("part_end", b"")),
+        "on_header_field": lambda data, start, end: events.append(("header_field", data[start:end])),
+        "on_header_value": lambda data, start, end: events.append(("header_value", data[start:end])),
+        "on_header_end": lambda: events.append(("header_end", b"")),
+        "on_headers_finished": lambda: events.append(("headers_finished", b"")),
+    }
+    parser = MultipartParser(boundary, callbacks)
+
+    fields = {}
+    upload = None
+    writer = None
+    buffer = bytearray()
+    headers = {}
+    header_field = b""
+    header_value = b""
+    field_name = ""
+    field_data = bytearray()
+    in_file = False
+    digest = hashlib.md5()
+
+    def write_block(block):
+        digest.update(block)
+        writer.write(block)
+
+    try:
+        async for chunk in stream:
+            parser.write(chunk)
+            pending = list(events)
+            events.clear()
+            for event, data in pending:
+                if event == "part_begin":
+                    headers = {}
+                    field_data = bytearray()
+                elif event == "header_field":
+                    header_field += data
+                elif event == "header_value":
+                    header_value += data
+                elif event == "header_end":
+                    headers[header_field.lower()] = header_value
+                    header_field = b""
+                    header_value = b""
+                elif event == "headers_finished":
+                    _, options = parse_options_header(headers.get(b"content-disposition", b""))
+                    field_name = options.get(b"name", b"").decode("latin-1")
+                    in_file = b"filename" in options and field_name == file_field
+                    if in_file:
+                        if writer is not None:
+                            raise UploadError(f"Only one '{file_field}' file is accepted")
+                        upload = {
+                            "filename": options[b"filename"].decode("utf-8", errors="replace"),
+                            "content_type": headers.get(b"content-type", b"").decode("latin-1"),
+                            "size": 0
+                        }
+                        writer = await run_blocking(open_writer, upload["filename"], upload["content_type"])
+                elif event == "part_data":
+                    if in_file:
+                        buffer += data
+                        upload["size"] += len(data)
+                        if len(buffer) >= WRITE_BUFFER_SIZE:
+                            await run_blocking(write_block, bytes(buffer))
+                            buffer.clear()
+                    else:
+                        field_data += data
+                        if len(field_data) > MAX_FIELD_SIZE:
+                            raise UploadError(f"Form field '{field_name}' is too large")
+                elif event == "part_end":
+                    if in_file:
+                        if buffer:
+                            await run_blocking(write_block, bytes(buffer))
+                            buffer.clear()
+                        await run_blocking(writer.close)
+                        upload["md5"] = digest.hexdigest()
+                        in_file = False
+                    else:
+                        fields[field_name] = field_data.decode("utf-8", errors="replace")
+        parser.finalize()
+    except Exception:
+        # Leave an unfinished upload unfinalized rather than committing a partial object
+        if in_file:
+            print(f"[WARNING] Upload of {upload['filename']} aborted after {upload['size']} bytes")
+            if discard_writer:
+                discard_writer(writer)
+        raise
+
+    if in_file:
+        if discard_writer:
+            discard_writer(writer)
+        raise UploadError("Upload ended before the file was complete")
+    return fields, upload
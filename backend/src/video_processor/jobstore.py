@@ -0,0 +1,397 @@
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from redis.exceptions import ResponseError
+
+JOB_INDEX = "jobs:index"
+JOB_STATUSES = ["waiting", "pending", "processing", "completed", "failed"]
+# Bumped whenever stored job records need migrating
+SCHEMA_KEY = "jobs:schema"
+SCHEMA_VERSION = "2"
+# Held while one process migrates, so API processes starting together do
+# not convert the same records at once
+SCHEMA_LOCK = "jobs:schema_lock"
+SCHEMA_LOCK_TTL = 600
+
+# Job records are Redis hashes. These fields hold plain strings; every other
+# field, including the per-rendition `conv:{resolution}:{field}` entries not
+# listed in CONVERSION_STRING_FIELDS, holds a JSON value.
+STRING_FIELDS = {"job_id", "status", "started_at", "completed_at", "error"}
+CONVERSION_STRING_FIELDS = {"resolution", "status", "output_url", "error", "reason"}
+
+# Every change to a running job is published on `job_events:{job_id}` as a
+# JSON object of the hash fields it set, encoded as they are stored, so
+# watchers get pushed deltas instead of re-reading the record.
+JOB_EVENTS_PREFIX = "job_events:"
+
+# Set rendition fields and recompute the job's overall progress as the mean
+# progress of renditions that are not skipped, in one round trip, and
+# publish the fields set along with the new progress.
+UPDATE_CONVERSIONS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local delta = {}
+if #ARGV > 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV))
+    for i = 1, #ARGV, 2 do
+        delta[ARGV[i]] = ARGV[i + 1]
+    end
+end
+local fields = redis.call('HGETALL', KEYS[1])
+local progress, statuses = {}, {}
+for i = 1, #fields, 2 do
+    local res, attr = string.match(fields[i], '^conv:(.+):([%w_]+)$')
+    if attr == 'progress' then
+        progress[res] = tonumber(fields[i + 1])
+    elseif attr == 'status' then
+        statuses[res] = fields[i + 1]
+    end
+end
+local total, count = 0, 0
+for res, value in pairs(progress) do
+    if statuses[res] ~= 'skipped' then
+        total = total + value
+        count = count + 1
+    end
+end
+local overall = 100
+if count > 0 then
+    overall = total / count
+end
+redis.call('HSET', KEYS[1], 'progress', tostring(overall))
+delta['progress'] = tostring(overall)
+redis.call('PUBLISH', 'job_events:' .. string.sub(KEYS[1], 5), cjson.encode(delta))
+return tostring(overall)
+"""
+
+# Change a job's status and move it between status indexes atomically, and
+# publish the change
+SET_STATUS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local old = redis.call('HGET', KEYS[1], 'status')
+if old then
+    redis.call('ZREM', 'jobs:status:' .. old, ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2], unpack(ARGV, 3))
+local score = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if score then
+    redis.call('ZADD', 'jobs:status:' .. ARGV[2], score, ARGV[1])
+end
+local delta = {status = ARGV[2]}
+for i = 3, #ARGV, 2 do
+    delta[ARGV[i]] = ARGV[i + 1]
+end
+redis.call('PUBLISH', 'job_events:' .. ARGV[1], cjson.encode(delta))
+return 1
+"""
+
+
+def job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def status_index(status: str) -> str:
+    return f"jobs:status:{status}"
+
+
+def job_channel(job_id: str) -> str:
+    return f"{JOB_EVENTS_PREFIX}{job_id}"
+
+
+def conversion_field(resolution: str, field: str) -> str:
+    return f"conv:{resolution}:{field}"
+
+
+def job_score(job: dict) -> float:
+    return datetime.fromisoformat(job['started_at']).timestamp()
+
+
+def _encode_value(field: str, value, string_fields) -> str:
+    if field in string_fields and isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _decode_value(field: str, value: str, string_fields):
+    if field in string_fields:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def encode_conversion(resolution: str, conversion: dict) -> dict:
+    return {
+        conversion_field(resolution, field): _encode_value(field, value, CONVERSION_STRING_FIELDS)
+        for field, value in conversion.items()
+        if value is not None
+    }
+
+
+def encode_job(job: dict) -> dict:
+    """Flatten a job dict into the field/value mapping stored in its hash."""
+    mapping = {}
+    for field, value in job.items():
+        if field == 'conversions':
+            for resolution, conversion in value.items():
+                mapping.update(encode_conversion(resolution, conversion))
+        elif value is not None:
+            mapping[field] = _encode_value(field, value, STRING_FIELDS)
+    return mapping
+
+
+def decode_job(fields: dict) -> Optional[dict]:
+    """Rebuild the nested job dict from a hash read with HGETALL."""
+    if not fields:
+        return None
+    job = {"conversions": {}}
+    for field, value in fields.items():
+        if field.startswith('conv:'):
+            resolution, attr = field[len('conv:'):].rsplit(':', 1)
+            conversion = job['conversions'].setdefault(resolution, {})
+            conversion[attr] = _decode_value(attr, value, CONVERSION_STRING_FIELDS)
+        else:
+            job[field] = _decode_value(field, value, STRING_FIELDS)
+    return job
+
+
+def index_job(pipe, job: dict):
+    """Queue the commands that keep the job indexes in step with `job`.
+
+    Every job is in `jobs:index` and in exactly one `jobs:status:{status}`
+    sorted set, all scored by `started_at` so listings come out in order.
+    """
+    job_id = job['job_id']
+    score = job_score(job)
+    pipe.zadd(JOB_INDEX, {job_id: score})
+    for status in JOB_STATUSES:
+        if status != job['status']:
+            pipe.zrem(status_index(status), job_id)
+    pipe.zadd(status_index(job['status']), {job_id: score})
+
+
+def _queue_save(pipe, job: dict):
+    key = job_key(job['job_id'])
+    pipe.delete(key)
+    pipe.hset(key, mapping=encode_job(job))
+    index_job(pipe, job)
+
+
+def _queue_load(pipe, job_ids: List[str]):
+    for job_id in job_ids:
+        pipe.hgetall(job_key(job_id))
+
+
+def _decode_jobs(results: list) -> List[dict]:
+    return [job for job in (decode_job(fields) for fields in results) if job]
+
+
+def save_job(client, job: dict):
+    """Write a whole job record and update the indexes in one transaction.
+
+    Use this to create a job; running jobs are updated field by field with
+    `update_job`, `set_job_status` and `update_conversions`.
+    """
+    pipe = client.pipeline()
+    _queue_save(pipe, job)
+    pipe.execute()
+
+
+def load_job(client, job_id: str) -> Optional[dict]:
+    return decode_job(client.hgetall(job_key(job_id)))
+
+
+def load_jobs(client, job_ids: List[str]) -> List[dict]:
+    """Fetch several job records in one pipelined round trip, skipping missing ones."""
+    if not job_ids:
+        return []
+    pipe = client.pipeline(transaction=False)
+    _queue_load(pipe, job_ids)
+    return _decode_jobs(pipe.execute())
+
+
+def update_job(client, job_id: str, **fields):
+    """Set top-level job fields other than `status`, which goes through `set_job_status`."""
+    mapping = {field: _encode_value(field, value, STRING_FIELDS) for field, value in fields.items()}
+    pipe = client.pipeline()
+    pipe.hset(job_key(job_id), mapping=mapping)
+    pipe.publish(job_channel(job_id), json.dumps(mapping))
+    pipe.execute()
+
+
+def set_job_status(client, job_id: str, status: str, **fields) -> bool:
+    """Set a job's status, and any other top-level fields, keeping the indexes in step."""
+    args = [job_id, status]
+    for field, value in fields.items():
+        args += [field, _encode_value(field, value, STRING_FIELDS)]
+    script = client.register_script(SET_STATUS_SCRIPT)
+    return bool(script(keys=[job_key(job_id), JOB_INDEX], args=args))
+
+
+def update_conversions(client, job_id: str, updates: dict) -> Optional[float]:
+    """Write rendition fields and return the recomputed overall progress.
+
+    `updates` maps each resolution to the fields to set on it. Only the given
+    fields are written, so concurrent updates to different renditions of the
+    same job never overwrite each other.
+    """
+    args = []
+    for resolution, conversion in updates.items():
+        for field, value in encode_conversion(resolution, conversion).items():
+            args += [field, value]
+    script = client.register_script(UPDATE_CONVERSIONS_SCRIPT)
+    overall = script(keys=[job_key(job_id)], args=args)
+    return float(overall) if overall is not None else None
+
+
+def _queue_delete(pipe, job_ids: List[str]):
+    pipe.delete(*[job_key(job_id) for job_id in job_ids])
+    pipe.zrem(JOB_INDEX, *job_ids)
+    for status in JOB_STATUSES:
+        pipe.zrem(status_index(status), *job_ids)
+
+
+def delete_jobs(client, job_ids: List[str]):
+    if not job_ids:
+        return
+    pipe = client.pipeline()
+    _queue_delete(pipe, job_ids)
+    pipe.execute()
+
+
+def encode_cursor(job_id: str, score: float) -> str:
+    return f"{score!r}:{job_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
+    score, job_id = cursor.split(':', 1)
+    return float(score), job_id
+
+
+def _queue_page(pipe, status: Optional[str], cursor: Optional[str], skip: int, limit: int):
+    key = status_index(status) if status else JOB_INDEX
+    pipe.zcard(key)
+    if not cursor:
+        pipe.zrevrange(key, skip, skip + limit, withscores=True)
+    else:
+        score, _ = decode_cursor(cursor)
+        # Jobs sharing the cursor's score come back in descending id order,
+        # so fetch them separately from the jobs below the score
+        pipe.zrevrangebyscore(key, score, score, withscores=True)
+        pipe.zrevrangebyscore(key, f"({score!r}", "-inf", start=0, num=limit + 1, withscores=True)
+
+
+def _page_from_results(results: list, cursor: Optional[str], limit: int) -> Tuple[List[str], int, Optional[str]]:
+    total = results[0]
+    if not cursor:
+        entries = results[1]
+    else:
+        # Resume after the last id seen among the ties, then carry on below the score
+        _, last_id = decode_cursor(cursor)
+        entries = [(job_id, s) for job_id, s in results[1] if job_id < last_id] + results[2]
+
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(*entries[-1])
+    return [job_id for job_id, _ in entries], total, next_cursor
+
+
+def list_job_ids(client, status: Optional[str] = None, cursor: Optional[str] = None,
+                 skip: int = 0, limit: int = 10) -> Tuple[List[str], int, Optional[str]]:
+    """Return one page of job ids, newest first, in one round trip.
+
+    Returns `(job_ids, total, next_cursor)`. Pass `next_cursor` back as
+    `cursor` to get the following page; unlike `skip`, cursors stay correct
+    while new jobs are being added. Raises ValueError for a malformed cursor.
+    """
+    pipe = client.pipeline(transaction=False)
+    _queue_page(pipe, status, cursor, skip, limit)
+    return _page_from_results(pipe.execute(), cursor, limit)
+
+
+def migrate_jobs(client) -> int:
+    """Bring every stored job up to the current schema and index it.
+
+    Converts JSON string records from before job hashes existed and indexes
+    jobs written before the job index existed. Safe to run more than once.
+    """
+    count = 0
+    for key in client.scan_iter(match="job:*", count=1000):
+        try:
+            if client.type(key) == 'string':
+                job_data = client.get(key)
+                if not job_data:
+                    continue
+                job = json.loads(job_data)
+                job.setdefault('job_id', key[len('job:'):])
+                save_job(client, job)
+            else:
+                job = load_job(client, key[len('job:'):])
+                if not job:
+                    continue
+                pipe = client.pipeline()
+                index_job(pipe, job)
+                pipe.execute()
+            count += 1
+        except (ValueError, KeyError, ResponseError):
+            print(f"Skipping unreadable job record {key}")
+    client.set(SCHEMA_KEY, SCHEMA_VERSION)
+    return count
+
+
+def migrate_jobs_once(client) -> Optional[int]:
+    """Run `migrate_jobs` unless the schema is current or another process is already migrating.
+
+    Returns the number of jobs migrated, or None if this process did not
+    migrate.
+    """
+    if client.get(SCHEMA_KEY) == SCHEMA_VERSION:
+        return None
+    if not client.set(SCHEMA_LOCK, "1", nx=True, ex=SCHEMA_LOCK_TTL):
+        return None
+    try:
+        return migrate_jobs(client)
+    finally:
+        client.delete(SCHEMA_LOCK)
+
+
+# Coroutine versions of the calls the API makes, for use with a
+# `redis.asyncio` client so Redis round trips never block the event loop.
+
+async def save_job_async(client, job: dict):
+    pipe = client.pipeline()
+    _queue_save(pipe, job)
+    await pipe.execute()
+
+
+async def load_job_async(client, job_id: str) -> Optional[dict]:
+    return decode_job(await client.hgetall(job_key(job_id)))
+
+
+async def load_jobs_async(client, job_ids: List[str]) -> List[dict]:
+    if not job_ids:
+        return []
+    pipe = client.pipeline(transaction=False)
+    _queue_load(pipe, job_ids)
+    return _decode_jobs(await pipe.execute())
+
+
+async def delete_jobs_async(client, job_ids: List[str]):
+    if not job_ids:
+        return
+    pipe = client.pipeline()
+    _queue_delete(pipe, job_ids)
+    await pipe.execute()
+
+
+async def list_job_ids_async(client, status: Optional[str] = None, cursor: Optional[str] = None,
+                             skip: int = 0, limit: int = 10) -> Tuple[List[str], int, Optional[str]]:
+    pipe = client.pipeline(transaction=False)
+    _queue_page(pipe, status, cursor, skip, limit)
+    return _page_from_results(await pipe.execute(), cursor, limit)
@@ -0,0 +1,68 @@
+import os
+import subprocess
+
+from renditions import video_filter
+from slots import rendition_cost
+from source import input_args
+
+
+def start_audio_pipe(source: str, audio_args: list):
+    """Encode the audio of `source` once in a separate ffmpeg, streamed as Matroska through a pipe.
+
+    Returns the process and the read end of the pipe, to be given to the
+    encoding ffmpeg as `pipe:N` in its `pass_fds`. The caller closes the
+    read end and waits for the process.
+    """
+    read_fd, write_fd = os.pipe()
+    cmd = ['ffmpeg'] + input_args(source) + [
+        '-map', '0:a:0', '-vn', *audio_args, '-loglevel', 'error', '-f', 'matroska', f'pipe:{write_fd}'
+    ]
+    print(f"[DEBUG] Encoding shared audio: {' '.join(cmd)}")
+    try:
+        process = subprocess.Popen(cmd, pass_fds=[write_fd], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except Exception:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    return process, read_fd
+
+
+def build_ladder_command(input_path: str, outputs: list, slots: int, output_flags=(), audio_input=None) -> list:
+    """Build one ffmpeg command that decodes the input once and writes every rendition.
+
+    `outputs` is a list of (rendition, output_path) tuples, where each
+    rendition comes from `plan_renditions`. The decoded video is fanned out
+    with a `split` filter and each branch is scaled and encoded into its own
+    output file. The `slots` granted to the pass are split between the
+    encoders in proportion to their cost. `output_flags` are added to every
+    output. With `audio_input` (an encoded audio stream in Matroska) its
+    audio is copied into every output instead of each encoding the source's.
+    """
+    costs = [rendition_cost(rendition) for rendition, _ in outputs]
+    labels = [f"s{i}" for i in range(len(outputs))]
+    filters = [f"[0:v]split={len(outputs)}" + ''.join(f"[{label}]" for label in labels)]
+    for i, (rendition, _) in enumerate(outputs):
+        filters.append(f"[s{i}]{video_filter(rendition)}[v{i}]")
+
+    cmd = ['ffmpeg'] + input_args(input_path)
+    if audio_input:
+        cmd += ['-f', 'matroska', '-i', audio_input]
+    cmd += [
+        '-filter_complex', ';'.join(filters),
+        '-progress', 'pipe:1',
+        '-loglevel', 'warning',
+        '-nostats'
+    ]
+    for i, (rendition, output_path) in enumerate(outputs):
+        threads = max(1, slots * costs[i] // sum(costs))
+        audio = ['-map', '1:a', '-c:a', 'copy'] if audio_input else ['-map', '0:a?', *rendition['audio_args']]
+        cmd += [
+            '-map', f'[v{i}]',
+            *rendition['video_args'],
+            '-threads', str(threads),
+            *audio,
+            *output_flags,
+            '-y', output_path
+        ]
+    return cmd
@@ -1,20 +1,55 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException, UploadFile, File, Form
-from fastapi.responses import FileResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Request
+from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 from enum import Enum
 from google.cloud import storage
 from google.cloud.storage.blob import Blob
+from google.cloud.exceptions import NotFound
 import os
 import time
 from datetime import datetime, timedelta
 import redis
+import redis.asyncio as aioredis
 import json
 from multiprocessing import Process
 import asyncio
+import base64
+import functools
 import uuid
-import aiofiles
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from renditions import RESOLUTIONS, PROFILES, DEFAULT_PROFILE, Resolution
+from dispatch import (
+    enqueue_job, estimate_work, queue_snapshot, schedule_stats,
+    PRIORITIES, DEFAULT_PRIORITY, DEFAULT_CLIENT, SHORTEST_JOB_FIRST,
+    ACTIVE_JOBS, JOB_OWNERS, JOB_ATTEMPTS, REAPER_LOCK
+)
+from probe import probe_media, probe_cache_key, PROBE_CACHE_TTL
+from capacity import (
+    read_capacity, capacity_from_snapshot, admission_delay, take_token, retry_after, live_workers, WORKER_TTL
+)
+from ingest import (
+    stream_multipart_upload, UploadError, UPLOAD_CHUNK_SIZE, PENDING_UPLOAD_TTL, pending_upload_key
+)
+from jobstore import (
+    load_job_async, save_job_async, list_job_ids_async, load_jobs_async, delete_jobs_async,
+    migrate_jobs_once, job_key, status_index, JOB_INDEX, JOB_STATUSES, SCHEMA_KEY, SCHEMA_VERSION
+)
+from events import JobEventHub, apply_delta, EVENT_KEEPALIVE
+from scratch import clean_orphans
+from gcs import signed_url, create_upload_session, abandon_writer
+from cache import queue_cache_stats, cache_stats_from_results, md5_content_hash
+from segments import SEGMENT_QUEUE
+from metrics import (
+    ClusterCollector, exposition, process_exited, CONTENT_TYPE_LATEST, HTTP_REQUESTS, HTTP_REQUEST_SECONDS,
+    JOBS_SUBMITTED, JOBS_REJECTED
+)
+from packaging import (
+    MP4, ADAPTIVE, OUTPUT_FORMATS, HLS_MASTER, DASH_MANIFEST, MANIFEST_NAME, CONTENT_TYPES,
+    STREAM_URL_TTL, package_prefix, manifest_cache_key, sign_manifest
+)
 
 app = FastAPI()
 
@@ -27,13 +62,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Labelled by handler rather than path, so job ids do not each get a series
+        endpoint = request.scope.get('endpoint')
+        handler = endpoint.__name__ if endpoint else 'unmatched'
+        HTTP_REQUESTS.labels(method=request.method, handler=handler, status=status).inc()
+        HTTP_REQUEST_SECONDS.labels(method=request.method, handler=handler).observe(time.monotonic() - started)
+
 # Video storage path
 UPLOAD_DIR = os.path.abspath("videos")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# Maximum number of concurrent jobs
-MAX_CONCURRENT_JOBS = 20
-
 # GCS Configuration
 BUCKET_NAME = os.getenv('GCS_BUCKET_NAME', 'experiment-456220-videos')
 credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', os.path.join(os.path.dirname(__file__), "experiment-456220-328a0f14d44e.json"))
@@ -65,35 +112,55 @@ except Exception as e:
     print(f"Error accessing bucket {BUCKET_NAME}: {str(e)}")
     raise HTTPException(status_code=500, detail="Storage configuration error")
 
-# Temporary storage for upload processing
-TEMP_DIR = "/tmp/video-processor"
-os.makedirs(TEMP_DIR, exist_ok=True)
-
-def get_redis_client():
+# Connections each API process may hold open to Redis; requests wait for a
+# free connection rather than opening more
+REDIS_POOL_SIZE = int(os.getenv('REDIS_POOL_SIZE', 32))
+# Threads each API process uses for blocking GCS calls
+STORAGE_THREADS = int(os.getenv('STORAGE_THREADS', 16))
+storage_executor = ThreadPoolExecutor(max_workers=STORAGE_THREADS, thread_name_prefix='storage')
+# With SHORTEST_JOB_FIRST the API probes a new job's source to size it.
+# Only uploads to the service's own bucket and sources on these hosts
+# (comma separated) are probed; other jobs are sized from an earlier probe
+# of the same source, or as unprobed.
+SIZE_PROBE_HOSTS = {host.strip() for host in os.getenv('SIZE_PROBE_HOSTS', '').split(',') if host.strip()}
+# Seconds the API waits for that probe before sizing the job as unprobed
+SIZE_PROBE_TIMEOUT = float(os.getenv('SIZE_PROBE_TIMEOUT', 10))
+
+async def run_storage(fn, *args, **kwargs):
+    """Run a blocking google-cloud-storage call without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(storage_executor, functools.partial(fn, *args, **kwargs))
+
+async def get_redis_client():
     redis_host = os.getenv('REDIS_HOST', 'localhost')
     redis_port = int(os.getenv('REDIS_PORT', 6379))
     max_retries = 5
     retry_delay = 5
 
+    pool = aioredis.BlockingConnectionPool(
+        host=redis_host,
+        port=redis_port,
+        decode_responses=True,
+        socket_timeout=5,
+        max_connections=REDIS_POOL_SIZE,
+        timeout=5
+    )
+    client = aioredis.Redis(connection_pool=pool)
     for attempt in range(max_retries):
         try:
-            client = redis.Redis(
-                host=redis_host,
-                port=redis_port,
-                decode_responses=True,
-                socket_timeout=5
-            )
-            client.ping()
+            await client.ping()
             print(f"Successfully connected to Redis at {redis_host}:{redis_port}")
             return client
         except redis.ConnectionError as e:
             if attempt < max_retries - 1:
                 print(f"Failed to connect to Redis (attempt {attempt + 1}/{max_retries}). Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                await asyncio.sleep(retry_delay)
             else:
                 raise Exception(f"Could not connect to Redis after {max_retries} attempts: {str(e)}")
 
 redis_client = None
+# Delivers the job events published by the workers to `/jobs/{job_id}/events`
+job_events = None
 
 class JobStatus(Enum):
     WAITING = "waiting"
@@ -102,12 +169,26 @@ class JobStatus(Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
+class EncodeStats(BaseModel):
+    """Live figures from the rendition's encode; `speed` is a multiple of realtime."""
+    frame: Optional[int] = None
+    fps: Optional[float] = None
+    speed: Optional[float] = None
+    bitrate_kbps: Optional[float] = None
+    out_seconds: Optional[float] = None
+    eta_seconds: Optional[float] = None
+
 class ConversionStatus(BaseModel):
     resolution: str
     status: str
     progress: float
     output_url: Optional[str] = None
     error: Optional[str] = None
+    reason: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    encode: Optional[EncodeStats] = None
+    timings: Optional[Dict[str, float]] = None
 
 class JobStatusResponse(BaseModel):
     job_id: str
@@ -115,194 +196,513 @@ class JobStatusResponse(BaseModel):
     started_at: datetime
     completed_at: Optional[datetime] = None
     conversions: Dict[str, ConversionStatus]
+    progress: Optional[float] = None
+    eta_seconds: Optional[float] = None
     job_data: Optional[dict] = None
+    media: Optional[dict] = None
+    manifests: Optional[Dict[str, str]] = None
+    timings: Optional[Dict[str, float]] = None
 
 class JobsList(BaseModel):
     total: int
     jobs: List[JobStatusResponse]
+    next_cursor: Optional[str] = None
 
 class VideoJob(BaseModel):
     input_url: str
     resolutions: List[str]
     job_id: str
+    output_format: str = MP4
+    profile: Optional[str] = None
+    priority: str = DEFAULT_PRIORITY
 
-class Resolution:
-    def __init__(self, width: int, height: int):
-        self.width = width
-        self.height = height
-
-    @staticmethod
-    def from_string(res: str) -> 'Resolution':
-        resolutions = {
-            "4K": Resolution(3840, 2160),
-            "1080p": Resolution(1920, 1080),
-            "720p": Resolution(1280, 720),
-            "480p": Resolution(854, 480)
-        }
-        return resolutions.get(res, Resolution(854, 480))
+class UploadRequest(BaseModel):
+    filename: str
+    resolutions: List[str]
+    cloudProvider: str
+    outputFormat: str = MP4
+    profile: Optional[str] = None
+    priority: str = DEFAULT_PRIORITY
+    content_type: Optional[str] = None
+    size: Optional[int] = None
+
+def validate_resolutions(resolutions: List[str]):
+    if not isinstance(resolutions, list):
+        raise HTTPException(status_code=400, detail="resolutions must be a list")
+    unknown = []
+    for res in resolutions:
+        try:
+            Resolution.from_string(res)
+        except ValueError:
+            unknown.append(res)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown resolutions {unknown}; supported: {list(RESOLUTIONS)}"
+        )
+    if not resolutions:
+        raise HTTPException(status_code=400, detail="At least one resolution is required")
+
+def validate_output_format(output_format: str):
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown output format {output_format}; supported: {list(OUTPUT_FORMATS)}"
+        )
+
+def validate_profile(profile: Optional[str]) -> str:
+    """Return the encoder profile a job will use, rejecting unknown names."""
+    profile = profile or DEFAULT_PROFILE
+    if profile not in PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown profile {profile}; supported: {list(PROFILES)}"
+        )
+    return profile
+
+def validate_priority(priority: str):
+    if priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown priority {priority}; supported: {list(PRIORITIES)}"
+        )
+
+def get_client_id(request: Request) -> str:
+    """Identify who submitted a request, for sharing the workers fairly.
+
+    Clients can name themselves with an `X-Client-ID` header; otherwise the
+    original address forwarded by the load balancer is used.
+    """
+    client_id = request.headers.get('x-client-id')
+    if not client_id:
+        forwarded = request.headers.get('x-forwarded-for', '')
+        client_id = forwarded.split(',')[0].strip() or (request.client.host if request.client else None)
+    return client_id or DEFAULT_CLIENT
+
+async def check_capacity(priority: str):
+    """Refuse a new job at `priority` with a 503 and a Retry-After estimate while the workers are behind."""
+    delay = admission_delay(capacity_from_snapshot(await read_capacity(redis_client)), priority)
+    if delay:
+        reason, seconds = delay
+        JOBS_REJECTED.labels(reason='overloaded').inc()
+        raise HTTPException(
+            status_code=503,
+            detail=f"Not accepting jobs right now: {reason}",
+            headers={"Retry-After": retry_after(seconds)}
+        )
+
+async def take_client_token(request: Request) -> str:
+    """Charge a new job to its client's rate, or refuse it with a 429 and a Retry-After estimate.
+
+    Returns the client's id. Call it once the request is known to be valid,
+    so requests refused for anything else do not use up the client's rate.
+    """
+    client_id = get_client_id(request)
+    wait = float(await take_token(redis_client, client_id))
+    if wait:
+        JOBS_REJECTED.labels(reason='rate_limited').inc()
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many jobs submitted by {client_id}",
+            headers={"Retry-After": retry_after(wait)}
+        )
+    return client_id
+
+async def admit_job(request: Request, priority: str) -> str:
+    """Refuse a validated new job while the workers are behind or its client is over its rate.
+
+    Returns the client's id. The rate is charged last, so a job refused for
+    overload does not count against its client.
+    """
+    await check_capacity(priority)
+    return await take_client_token(request)
+
+def may_probe(job_data: dict) -> bool:
+    """Whether the API may fetch a job's source itself; see SIZE_PROBE_HOSTS."""
+    if 'gcs_path' in job_data:
+        return True
+    parts = urlsplit(job_data['input_url'])
+    return parts.scheme in ('http', 'https') and parts.hostname in SIZE_PROBE_HOSTS
+
+async def probe_duration(job_data: dict) -> Optional[float]:
+    """Duration of a job's source from an earlier probe, or from probing it now if allowed.
+
+    Returns None if the source is unknown and may not be probed, or its
+    probe fails or takes longer than SIZE_PROBE_TIMEOUT. A probe made here
+    is cached where the worker looks for it, so the source is still probed
+    only once.
+    """
+    content_hash = job_data.get('content_hash')
+    try:
+        key = f"content:{content_hash}" if content_hash else probe_cache_key(job_data['input_url'])
+        cached = await redis_client.get(f"probe:{key}")
+        if cached:
+            return json.loads(cached)['duration']
+        if not may_probe(job_data):
+            return None
+        media = await run_storage(probe_media, job_data['input_url'], timeout=SIZE_PROBE_TIMEOUT)
+        media['cache_key'] = key
+        await redis_client.set(f"probe:{key}", json.dumps(media), ex=PROBE_CACHE_TTL)
+        return media['duration']
+    except Exception as e:
+        print(f"Could not probe {job_data['input_url']} to size its job: {str(e)}")
+        return None
 
 # Create a separate process for the worker
 def start_worker_process():
     from worker import start_worker
-    worker_process = Process(target=start_worker)
+    worker_process = Process(target=start_worker, args=('api',))
     worker_process.start()
     return worker_process
 
-@app.post("/process")
-async def process_video(job: VideoJob, background_tasks: BackgroundTasks):
-    if redis_client.exists(f"job:{job.job_id}"):
-        raise HTTPException(status_code=400, detail="Job ID already exists")
-    
-    # Initialize conversion status for each resolution
-    conversions = {}
-    for resolution in job.resolutions:
-        conversions[resolution] = {
-            "resolution": resolution,
-            "status": "waiting",
-            "progress": 0
-        }
-    
+def stop_worker_process(worker_process):
+    worker_process.terminate()
+    worker_process.join()
+    # A worker killed before its exit handler ran leaves its live gauges behind
+    process_exited(worker_process.pid)
+
+async def create_job(job_id: str, resolutions: List[str], job_data: dict,
+                     status: JobStatus = JobStatus.WAITING) -> int:
+    """Store a new job with one conversion per resolution and queue it.
+
+    The job is queued in its `priority` class under its `client_id`, both
+    taken from `job_data`. Returns the number of jobs queued in that class.
+    """
     job_status = {
-        "job_id": job.job_id,
-        "status": JobStatus.WAITING.value,
+        "job_id": job_id,
+        "status": status.value,
         "started_at": datetime.now().isoformat(),
-        "conversions": conversions,
-        "job_data": {
-            "input_url": job.input_url,
-            "resolutions": job.resolutions,
-            "job_id": job.job_id
-        }
+        "conversions": {
+            res: {
+                "resolution": res,
+                "status": status.value,
+                "progress": 0
+            } for res in resolutions
+        },
+        "job_data": job_data
     }
     
-    redis_client.set(f"job:{job.job_id}", json.dumps(job_status))
-    redis_client.lpush("job_queue", job.job_id)
+    # Sizing a job for shortest-first needs its duration before any worker probes it
+    duration = await probe_duration(job_data) if SHORTEST_JOB_FIRST else None
+    
+    await save_job_async(redis_client, job_status)
+    priority = job_data.get('priority', DEFAULT_PRIORITY)
+    position = await enqueue_job(
+        redis_client, job_id,
+        priority=priority,
+        client_id=job_data.get('client_id', DEFAULT_CLIENT),
+        work=estimate_work(len(resolutions), duration)
+    )
+    JOBS_SUBMITTED.labels(priority=priority).inc()
+    return position
+
+@app.post("/process")
+async def process_video(job: VideoJob, request: Request, background_tasks: BackgroundTasks):
+    if await redis_client.exists(job_key(job.job_id)):
+        raise HTTPException(status_code=400, detail="Job ID already exists")
+    validate_resolutions(job.resolutions)
+    validate_output_format(job.output_format)
+    profile = validate_profile(job.profile)
+    validate_priority(job.priority)
+    client_id = await admit_job(request, job.priority)
+    
+    position = await create_job(job.job_id, job.resolutions, {
+        "input_url": job.input_url,
+        "resolutions": job.resolutions,
+        "job_id": job.job_id,
+        "output_format": job.output_format,
+        "profile": profile,
+        "priority": job.priority,
+        "client_id": client_id
+    })
     
     return {
         "status": "Job queued",
         "job_id": job.job_id,
-        "position": redis_client.llen("job_queue")
+        "position": position
     }
 
+def to_job_response(job_dict: dict) -> JobStatusResponse:
+    # Convert string status to enum
+    job_dict["status"] = JobStatus(job_dict["status"])
+    
+    # Parse datetime strings
+    job_dict["started_at"] = datetime.fromisoformat(job_dict["started_at"])
+    if job_dict.get("completed_at"):
+        job_dict["completed_at"] = datetime.fromisoformat(job_dict["completed_at"])
+    
+    # Ensure conversions are properly formatted
+    formatted_conversions = {}
+    for res, conv in job_dict.get("conversions", {}).items():
+        formatted_conversions[res] = ConversionStatus(
+            resolution=res,
+            status=conv.get("status", "waiting"),
+            progress=float(conv.get("progress", 0)),
+            output_url=conv.get("output_url"),
+            error=conv.get("error"),
+            reason=conv.get("reason"),
+            width=conv.get("width"),
+            height=conv.get("height"),
+            encode=conv.get("encode"),
+            timings=conv.get("timings")
+        )
+    job_dict["conversions"] = formatted_conversions
+
+    # The job is done when its slowest running encode is
+    if job_dict["status"] == JobStatus.PROCESSING:
+        etas = [
+            conv.encode.eta_seconds for conv in formatted_conversions.values()
+            if conv.status == "processing" and conv.encode and conv.encode.eta_seconds is not None
+        ]
+        job_dict["eta_seconds"] = max(etas) if etas else None
+
+    # Adaptive jobs are played through their manifests rather than downloaded
+    job_data = job_dict.get("job_data") or {}
+    if job_data.get("output_format") == ADAPTIVE and job_dict["status"] == JobStatus.COMPLETED:
+        job_dict["manifests"] = {
+            "hls": f"/stream/{job_dict['job_id']}/{HLS_MASTER}",
+            "dash": f"/stream/{job_dict['job_id']}/{DASH_MANIFEST}"
+        }
+    
+    return JobStatusResponse(**job_dict)
+
 @app.get("/jobs/{job_id}", response_model=JobStatusResponse)
 async def get_job_status(job_id: str):
     try:
-        job_data = redis_client.get(f"job:{job_id}")
-        if not job_data:
+        job_dict = await load_job_async(redis_client, job_id)
+        if not job_dict:
             raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
         
-        job_dict = json.loads(job_data)
-        
-        # Convert string status to enum
-        job_dict["status"] = JobStatus(job_dict["status"])
-        
-        # Parse datetime strings
-        job_dict["started_at"] = datetime.fromisoformat(job_dict["started_at"])
-        if job_dict.get("completed_at"):
-            job_dict["completed_at"] = datetime.fromisoformat(job_dict["completed_at"])
-        
-        # Ensure conversions are properly formatted
-        formatted_conversions = {}
-        for res, conv in job_dict.get("conversions", {}).items():
-            formatted_conversions[res] = ConversionStatus(
-                resolution=res,
-                status=conv.get("status", "waiting"),
-                progress=float(conv.get("progress", 0)),
-                output_url=conv.get("output_url"),
-                error=conv.get("error")
-            )
-        job_dict["conversions"] = formatted_conversions
-        
-        return JobStatusResponse(**job_dict)
+        return to_job_response(job_dict)
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Invalid job data: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving job: {str(e)}")
 
+def sse_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Follow a job as server-sent events instead of polling `/jobs/{job_id}`.
+
+    The stream opens with a `snapshot` event holding the job as `/jobs/{job_id}`
+    returns it. Each time a worker writes to the job an `update` event
+    follows with just the fields it changed (the overall `progress`, and
+    under `conversions` the renditions that changed). When the job completes
+    or fails a final `snapshot` is sent and the stream ends.
+    """
+    queue = await job_events.watch(job_id)
+    try:
+        job_dict = await load_job_async(redis_client, job_id)
+    except Exception as e:
+        await job_events.unwatch(job_id, queue)
+        raise HTTPException(status_code=500, detail=f"Error retrieving job: {str(e)}")
+    if not job_dict:
+        await job_events.unwatch(job_id, queue)
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    async def stream():
+        # The job as of the last event, kept to send the final snapshot
+        job = job_dict
+        snapshot = True
+        try:
+            while True:
+                if snapshot:
+                    finished = job["status"] in (JobStatus.COMPLETED.value, JobStatus.FAILED.value)
+                    yield sse_event("snapshot", to_job_response(dict(job)).json())
+                    if finished:
+                        return
+                    snapshot = False
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    # Fell behind and missed events; start again from the stored job
+                    job = await load_job_async(redis_client, job_id)
+                    if not job:
+                        return
+                    snapshot = True
+                    continue
+                delta, data = event
+                apply_delta(job, delta)
+                if delta.get("status") in (JobStatus.COMPLETED.value, JobStatus.FAILED.value):
+                    snapshot = True
+                    continue
+                yield sse_event("update", data)
+        finally:
+            await job_events.unwatch(job_id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Stop nginx buffering the stream
+        "X-Accel-Buffering": "no"
+    })
+
 @app.get("/jobs", response_model=JobsList)
-async def list_jobs(skip: int = 0, limit: int = 10):
+async def list_jobs(skip: int = 0, limit: int = 10, status: Optional[JobStatus] = None, cursor: Optional[str] = None):
+    """List jobs newest first.
+
+    Pass the returned `next_cursor` as `cursor` to page through the jobs;
+    `skip` is kept for existing clients but can shift while jobs are added.
+    """
+    limit = max(1, min(limit, 100))
+    try:
+        job_ids, total_jobs, next_cursor = await list_job_ids_async(
+            redis_client,
+            status=status.value if status else None,
+            cursor=cursor,
+            skip=skip,
+            limit=limit
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
     try:
-        job_keys = redis_client.keys("job:*")
-        total_jobs = len(job_keys)
-        paginated_keys = job_keys[skip:skip + limit]
-        
         jobs_data = []
-        for key in paginated_keys:
+        for job_dict in await load_jobs_async(redis_client, job_ids):
             try:
-                job_data = redis_client.get(key)
-                if job_data:
-                    job_dict = json.loads(job_data)
-                    
-                    # Convert string status to enum
-                    job_dict["status"] = JobStatus(job_dict["status"])
-                    
-                    # Parse datetime strings
-                    job_dict["started_at"] = datetime.fromisoformat(job_dict["started_at"])
-                    if job_dict.get("completed_at"):
-                        job_dict["completed_at"] = datetime.fromisoformat(job_dict["completed_at"])
-                    
-                    # Format conversions
-                    formatted_conversions = {}
-                    for res, conv in job_dict.get("conversions", {}).items():
-                        formatted_conversions[res] = ConversionStatus(
-                            resolution=res,
-                            status=conv.get("status", "waiting"),
-                            progress=float(conv.get("progress", 0)),
-                            output_url=conv.get("output_url"),
-                            error=conv.get("error")
-                        )
-                    job_dict["conversions"] = formatted_conversions
-                    
-                    jobs_data.append(JobStatusResponse(**job_dict))
+                jobs_data.append(to_job_response(job_dict))
             except Exception as e:
-                print(f"Error processing job {key}: {str(e)}")
+                print(f"Error processing job {job_dict.get('job_id')}: {str(e)}")
                 continue
         
-        # Sort by started_at in descending order
-        jobs_data.sort(key=lambda x: x.started_at, reverse=True)
-        
-        return JobsList(total=total_jobs, jobs=jobs_data)
+        return JobsList(total=total_jobs, jobs=jobs_data, next_cursor=next_cursor)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching jobs: {str(e)}")
 
 
 @app.get("/queue")
 async def get_queue_status():
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.scard("active_jobs")
+    queue_cache_stats(pipe)
+    active_jobs, cache_stats, cache_entries = await pipe.execute()
+    classes = schedule_stats(await queue_snapshot(redis_client))
+    capacity = capacity_from_snapshot(await read_capacity(redis_client))
     return {
-        "active_jobs": redis_client.scard("active_jobs"),
-        "queued_jobs": redis_client.llen("job_queue"),
-        "max_concurrent_jobs": MAX_CONCURRENT_JOBS,
-        "queue_position": redis_client.lrange("job_queue", 0, -1)
+        "active_jobs": active_jobs,
+        "queued_jobs": sum(stats["queued"] for stats in classes.values()),
+        "max_concurrent_jobs": capacity["job_seats"],
+        "capacity": capacity,
+        "queue_position": [
+            job_id for stats in classes.values()
+            for jobs in stats["clients"].values() for job_id in jobs
+        ],
+        "priorities": classes,
+        "transcode_cache": cache_stats_from_results(cache_stats, cache_entries)
     }
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: this API's requests and submissions, and the cluster's queues and capacity.
+
+    Run with PROMETHEUS_MULTIPROC_DIR set, the request metrics cover every
+    API process, along with any worker sharing the directory.
+    """
+    cluster = None
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.scard("active_jobs")
+        pipe.llen(SEGMENT_QUEUE)
+        for status in JOB_STATUSES:
+            pipe.zcard(status_index(status))
+        active_jobs, queued_segments, *counts = await pipe.execute()
+        cluster = ClusterCollector(
+            classes=schedule_stats(await queue_snapshot(redis_client)),
+            capacity=capacity_from_snapshot(await read_capacity(redis_client)),
+            statuses=dict(zip(JOB_STATUSES, counts)),
+            active_jobs=active_jobs,
+            queued_segments=queued_segments
+        )
+    except redis.RedisError as e:
+        print(f"[WARNING] Leaving cluster figures out of /metrics: {str(e)}")
+    return Response(exposition(cluster), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/download/{job_id}/{resolution}")
 async def download_video(job_id: str, resolution: str):
-    job_data = redis_client.get(f"job:{job_id}")
-    if not job_data:
+    job_status = await load_job_async(redis_client, job_id)
+    if not job_status:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job_status = json.loads(job_data)
     if resolution not in job_status["conversions"]:
         raise HTTPException(status_code=404, detail="Resolution not found")
     
     if job_status["conversions"][resolution]["status"] != "completed":
         raise HTTPException(status_code=400, detail="Video conversion not completed")
+
+    if job_status["job_data"].get("output_format") == ADAPTIVE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Job was packaged for streaming; play /stream/{job_id}/{HLS_MASTER} instead"
+        )
     
     # Generate signed URL for the processed video
     blob_name = f"processed/{job_id}/{resolution}.mp4"
     blob = bucket.blob(blob_name)
     
-    if not blob.exists():
+    if not await run_storage(blob.exists):
         raise HTTPException(status_code=404, detail="Video file not found")
     
     # Generate signed URL with 5-minute expiration
-    signed_url = blob.generate_signed_url(
-        version="v4",
-        expiration=timedelta(minutes=5),
-        method="GET"
-    )
+    url = await run_storage(signed_url, blob, timedelta(minutes=5))
     
     # Redirect to the signed URL
-    return RedirectResponse(url=signed_url)
+    return RedirectResponse(url=url)
+
+@app.get("/stream/{job_id}/{name}")
+async def stream_manifest(job_id: str, name: str):
+    """Serve a manifest of an adaptive job with every segment URL signed.
+
+    Players open `/stream/{job_id}/master.m3u8` (HLS) or
+    `/stream/{job_id}/manifest.mpd` (DASH); the HLS media playlists are
+    fetched through here as well. Segments are then read straight from
+    storage. Signed manifests are cached for half their URLs' lifetime.
+    """
+    if not MANIFEST_NAME.match(name):
+        raise HTTPException(status_code=404, detail="Manifest not found")
+
+    cache_key = manifest_cache_key(job_id, name)
+    manifest = await redis_client.get(cache_key)
+    if manifest is None:
+        job_status = await load_job_async(redis_client, job_id)
+        if not job_status:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job_status["job_data"].get("output_format") != ADAPTIVE:
+            raise HTTPException(status_code=400, detail="Job was not packaged for streaming")
+        if job_status["status"] != JobStatus.COMPLETED.value:
+            raise HTTPException(status_code=400, detail="Video conversion not completed")
+
+        prefix = package_prefix(job_id)
+        try:
+            text = (await run_storage(bucket.blob(f"{prefix}/{name}").download_as_bytes)).decode()
+        except NotFound:
+            raise HTTPException(status_code=404, detail="Manifest not found")
+
+        expiration = timedelta(seconds=STREAM_URL_TTL)
+        manifest = await run_storage(
+            sign_manifest, name, text,
+            lambda segment: signed_url(bucket.blob(f"{prefix}/{segment}"), expiration)
+        )
+        await redis_client.set(cache_key, manifest, ex=STREAM_URL_TTL // 2)
+
+    return Response(
+        content=manifest,
+        media_type=CONTENT_TYPES[os.path.splitext(name)[1]],
+        headers={"Cache-Control": f"private, max-age={STREAM_URL_TTL // 2}"}
+    )
+
+@app.get("/profiles")
+async def list_profiles():
+    """Encoder profiles a job can choose with `profile`."""
+    return {
+        "default": DEFAULT_PROFILE,
+        "profiles": {name: profile.describe() for name, profile in PROFILES.items()}
+    }
 
 @app.get("/health")
 async def health_check():
@@ -314,36 +714,34 @@ async def clear_all():
     try:
         # First stop the worker process
         if hasattr(app.state, 'worker_process'):
-            app.state.worker_process.terminate()
-            app.state.worker_process.join()
+            stop_worker_process(app.state.worker_process)
         
         # Clear Redis data
-        active_jobs = redis_client.smembers("active_jobs")
-        job_keys = redis_client.keys("job:*")
+        active_jobs = await redis_client.smembers("active_jobs")
+        job_ids = await redis_client.zrange(JOB_INDEX, 0, -1)
+        # Per-job keys: leases, segment state and leases, cached manifests
+        job_keys = []
+        for pattern in ("processing:*", "job_queue*", "lease:*", "segments:*", "segment_lease:*", "manifest:*"):
+            job_keys += [key async for key in redis_client.scan_iter(match=pattern)]
         
         pipe = redis_client.pipeline()
-        pipe.delete("job_queue")
-        pipe.delete("active_jobs")
         if job_keys:
             pipe.delete(*job_keys)
-        pipe.execute()
+        pipe.delete(ACTIVE_JOBS, JOB_OWNERS, JOB_ATTEMPTS, REAPER_LOCK, SEGMENT_QUEUE)
+        await pipe.execute()
+        await delete_jobs_async(redis_client, job_ids)
         
-        # Clear video storage safely
-        if os.path.exists("/tmp/videos"):
-            for file in os.listdir("/tmp/videos"):
-                try:
-                    file_path = os.path.join("/tmp/videos", file)
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                except Exception as e:
-                    print(f"Error deleting file {file}: {str(e)}")
+        # Other API processes' workers and the supervisord one keep running,
+        # so only scratch files no live worker can be using are deleted
+        live = await live_workers(redis_client)
+        await asyncio.get_running_loop().run_in_executor(None, clean_orphans, None, live, WORKER_TTL)
         
         # Restart worker process
         app.state.worker_process = start_worker_process()
         
         return {
             "status": "success",
-            "message": f"Cleared {len(job_keys)} jobs and all associated files",
+            "message": f"Cleared {len(job_ids)} jobs and their orphaned scratch files",
             "active_jobs_stopped": len(active_jobs),
             "worker_restarted": True
         }
@@ -356,53 +754,29 @@ async def clear_all():
             detail=f"Error clearing system: {str(e)}"
         )
 
-async def process_next_job():
-    """Process jobs from the Redis queue"""
-    while True:
-        try:
-            # Check for active jobs
-            active_count = redis_client.scard("active_jobs")
-            if active_count >= MAX_CONCURRENT_JOBS:
-                await asyncio.sleep(1)
-                continue
-
-            # Try to get next job from queue
-            job_id = redis_client.rpop("job_queue")
-            if not job_id:
-                await asyncio.sleep(1)
-                continue
-
-            # Update job status
-            job_data = redis_client.get(f"job:{job_id}")
-            if job_data:
-                job_status = json.loads(job_data)
-                job_status["status"] = JobStatus.PENDING.value
-                redis_client.set(f"job:{job_id}", json.dumps(job_status))
-                redis_client.sadd("active_jobs", job_id)
-
-        except Exception as e:
-            print(f"Error in process_next_job: {str(e)}")
-            await asyncio.sleep(1)
-        
-        await asyncio.sleep(0.1)  # Prevent CPU overload
-
 @app.on_event("startup")
 async def startup_event():
-    global redis_client
-    redis_client = get_redis_client()
+    global redis_client, job_events
+    redis_client = await get_redis_client()
+    job_events = JobEventHub(redis_client)
     
-    # Ensure temp directory exists
-    os.makedirs(TEMP_DIR, exist_ok=True)
+    # Convert and index job records written by older versions. Every API
+    # process starts here, but only the one holding the schema lock
+    # migrates, on a thread so the event loop is not blocked meanwhile.
+    if await redis_client.get(SCHEMA_KEY) != SCHEMA_VERSION:
+        sync_client = redis.Redis(connection_pool=redis.ConnectionPool(
+            **redis_client.connection_pool.connection_kwargs
+        ))
+        try:
+            migrated = await asyncio.get_running_loop().run_in_executor(None, migrate_jobs_once, sync_client)
+            if migrated is not None:
+                print(f"Migrated {migrated} existing jobs")
+        finally:
+            sync_client.close()
     
     # Start worker process
     app.state.worker_process = start_worker_process()
     
-    # Start background task for job queue monitoring
-    app.state.background_tasks = set()
-    task = asyncio.create_task(process_next_job())
-    app.state.background_tasks.add(task)
-    task.add_done_callback(app.state.background_tasks.discard)
-    
     print("Backend startup complete: Redis connected, GCS configured, worker started")
 
 @app.on_event("shutdown")
@@ -414,67 +788,88 @@ async def shutdown_event():
         await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
     # Terminate worker process
     if hasattr(app.state, 'worker_process'):
-        app.state.worker_process.terminate()
-        app.state.worker_process.join()
+        stop_worker_process(app.state.worker_process)
+    if job_events is not None:
+        await job_events.close()
+    if redis_client is not None:
+        await redis_client.close()
+        await redis_client.connection_pool.disconnect()
+    storage_executor.shutdown(wait=False)
+    process_exited(os.getpid())
 
 @app.post("/upload")
-async def upload_video(
-    video: UploadFile = File(...),
-    resolutions: str = Form(...),
-    cloudProvider: str = Form(...)
-):
-    try:
-        # Generate unique filename with original extension
-        file_extension = os.path.splitext(video.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        temp_path = os.path.join(TEMP_DIR, unique_filename)
-
-        # Save temporarily
-        async with aiofiles.open(temp_path, 'wb') as out_file:
-            content = await video.read()
-            await out_file.write(content)
-
-        # Upload to GCS
-        blob = bucket.blob(f"uploads/{unique_filename}")
-        blob.upload_from_filename(temp_path)
-        
-        # Clean up temp file
-        os.remove(temp_path)
+async def upload_video(request: Request):
+    """Accept a multipart upload (`video`, `resolutions`, `cloudProvider`).
+
+    The body is parsed as it arrives and the video is streamed straight to
+    GCS with a resumable upload, so the API never holds more than a few
+    chunks of it in memory however large the file is.
+    """
+    # The job's priority only arrives after the file, so the body is only
+    # turned away up front when even the highest class would be refused
+    await check_capacity(PRIORITIES[0])
+
+    unique_id = str(uuid.uuid4())
+    uploaded = {}
+
+    def open_writer(filename, content_type):
+        gcs_path = f"uploads/{unique_id}{os.path.splitext(filename)[1]}"
+        uploaded['blob'] = bucket.blob(gcs_path)
+        return uploaded['blob'].open(
+            'wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type=content_type or None
+        )
 
-        # Generate signed URL for processing
-        gcs_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(hours=24),
-            method="GET"
+    try:
+        fields, video = await stream_multipart_upload(
+            request.headers.get('content-type', ''), request.stream(), open_writer,
+            executor=storage_executor, discard_writer=abandon_writer
         )
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error uploading video: {str(e)}")
 
-        # Parse resolutions
-        resolution_list = json.loads(resolutions)
+    blob = uploaded.get('blob')
+    try:
+        if not video:
+            raise HTTPException(status_code=400, detail="A 'video' file is required")
+        if 'cloudProvider' not in fields:
+            raise HTTPException(status_code=400, detail="cloudProvider is required")
+        # The frontend sends the file first, so the other fields can only be
+        # checked once it has been stored
+        try:
+            resolution_list = json.loads(fields.get('resolutions', ''))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="resolutions must be a JSON list")
+        validate_resolutions(resolution_list)
+        output_format = fields.get('outputFormat', MP4)
+        validate_output_format(output_format)
+        profile = validate_profile(fields.get('profile'))
+        priority = fields.get('priority', DEFAULT_PRIORITY)
+        validate_priority(priority)
+        client_id = await admit_job(request, priority)
+    except HTTPException:
+        if blob is not None:
+            await run_storage(blob.delete)
+        raise
+
+    try:
+        # Generate signed URL for processing
+        gcs_url = await run_storage(signed_url, blob, timedelta(hours=24))
 
         # Create job
         job_id = str(uuid.uuid4())
-        job_status = {
-            "job_id": job_id,
-            "status": JobStatus.PENDING.value,
-            "started_at": datetime.now().isoformat(),
-            "conversions": {
-                res: {
-                    "resolution": res,
-                    "status": "pending",
-                    "progress": 0
-                } for res in resolution_list
-            },
-            "job_data": {
-                "input_url": gcs_url,
-                "gcs_path": f"uploads/{unique_filename}",
-                "resolutions": resolution_list,
-                "cloud_provider": cloudProvider
-            }
-        }
-
-        # Store job status in Redis
-        redis_client.set(f"job:{job_id}", json.dumps(job_status))
-        redis_client.lpush("job_queue", job_id)
+        await create_job(job_id, resolution_list, {
+            "input_url": gcs_url,
+            "gcs_path": blob.name,
+            "content_hash": md5_content_hash(video['md5']),
+            "resolutions": resolution_list,
+            "cloud_provider": fields['cloudProvider'],
+            "output_format": output_format,
+            "profile": profile,
+            "priority": priority,
+            "client_id": client_id
+        }, status=JobStatus.PENDING)
 
         return {
             "taskId": job_id,
@@ -483,11 +878,119 @@ async def upload_video(
         }
 
     except Exception as e:
-        # Clean up temp file if it exists
-        if 'temp_path' in locals() and os.path.exists(temp_path):
-            os.remove(temp_path)
+        # No job will ever read the stored video
+        try:
+            await run_storage(blob.delete)
+        except Exception as delete_error:
+            print(f"[WARNING] Failed to delete {blob.name}: {str(delete_error)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/uploads")
+async def start_upload(upload: UploadRequest, request: Request):
+    """First step of a direct upload: get a URL to send the video straight to storage.
+
+    PUT the file to the returned `uploadUrl` (a resumable upload session, so
+    it can be sent in chunks and resumed), then call
+    `/uploads/{uploadId}/finalize` to create the job. The video never passes
+    through the API. Uploads that are never finalized are forgotten after
+    PENDING_UPLOAD_TTL seconds. The job is admitted here rather than at
+    finalize, so a finished upload is never turned away.
+    """
+    validate_resolutions(upload.resolutions)
+    validate_output_format(upload.outputFormat)
+    profile = validate_profile(upload.profile)
+    validate_priority(upload.priority)
+    await check_capacity(upload.priority)
+
+    upload_id = str(uuid.uuid4())
+    gcs_path = f"uploads/{upload_id}{os.path.splitext(upload.filename)[1]}"
+    try:
+        upload_url = await run_storage(
+            create_upload_session,
+            bucket.blob(gcs_path),
+            content_type=upload.content_type,
+            size=upload.size,
+            origin=request.headers.get('origin')
+        )
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Could not start upload: {str(e)}")
+    # Charged once the session exists; a session refused here is never used
+    client_id = await take_client_token(request)
+
+    await redis_client.set(pending_upload_key(upload_id), json.dumps({
+        "gcs_path": gcs_path,
+        "size": upload.size,
+        "resolutions": upload.resolutions,
+        "cloud_provider": upload.cloudProvider,
+        "output_format": upload.outputFormat,
+        "profile": profile,
+        "priority": upload.priority,
+        "client_id": client_id
+    }), ex=PENDING_UPLOAD_TTL)
+
+    return {
+        "uploadId": upload_id,
+        "uploadUrl": upload_url,
+        "expiresAt": (datetime.now() + timedelta(seconds=PENDING_UPLOAD_TTL)).isoformat()
+    }
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str):
+    """Second step of a direct upload: check the video arrived and queue its job.
+
+    The job id is the upload id, so finalizing twice returns the same job.
+    """
+    finalized = {
+        "taskId": upload_id,
+        "message": "Video uploaded successfully",
+        "status": "pending"
+    }
+    pending_data = await redis_client.get(pending_upload_key(upload_id))
+    if not pending_data:
+        if await redis_client.exists(job_key(upload_id)):
+            return finalized
+        raise HTTPException(status_code=404, detail="Upload not found or expired")
+    pending = json.loads(pending_data)
+
+    # A resumable upload only becomes an object once its last byte is stored
+    blob = bucket.blob(pending['gcs_path'])
+    try:
+        await run_storage(blob.reload)
+    except NotFound:
+        raise HTTPException(status_code=409, detail="Upload has not completed")
+    if pending.get('size') is not None and blob.size != pending['size']:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload has {blob.size} bytes, expected {pending['size']}"
+        )
+
+    # Storage has already hashed the object; composite objects have no MD5
+    content_hash = md5_content_hash(base64.b64decode(blob.md5_hash).hex()) if blob.md5_hash else None
+
+    # Only the first of concurrent finalize calls gets to create the job
+    if not await redis_client.delete(pending_upload_key(upload_id)):
+        return finalized
+
+    try:
+        gcs_url = await run_storage(signed_url, blob, timedelta(hours=24))
+        await create_job(upload_id, pending['resolutions'], {
+            "input_url": gcs_url,
+            "gcs_path": pending['gcs_path'],
+            "content_hash": content_hash,
+            "resolutions": pending['resolutions'],
+            "cloud_provider": pending['cloud_provider'],
+            "output_format": pending.get('output_format', MP4),
+            "profile": pending.get('profile'),
+            "priority": pending.get('priority', DEFAULT_PRIORITY),
+            "client_id": pending.get('client_id', DEFAULT_CLIENT)
+        }, status=JobStatus.PENDING)
+    except Exception as e:
+        # Let the client retry the finalize
+        await redis_client.set(pending_upload_key(upload_id), pending_data, ex=PENDING_UPLOAD_TTL)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return finalized
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
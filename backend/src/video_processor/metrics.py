@@ -0,0 +1,194 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+    multiprocess, start_http_server
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Port of the worker's metrics exporter; 0 turns it off
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 9101))
+# With several API and worker processes in one container, point this at an
+# empty directory shared by all of them (prometheus_client multiprocess
+# mode) so any one /metrics or exporter reports them all
+MULTIPROCESS = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+# Stage durations range from a probe of a few hundred milliseconds to
+# encodes of long sources taking hours
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+# Seconds of video encoded per second of wall time
+SPEED_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 6, 8, 12, 16)
+
+JOB_STAGE_SECONDS = Histogram(
+    'video_job_stage_seconds', 'Time jobs spend in each stage of the pipeline',
+    ['stage'], buckets=STAGE_BUCKETS
+)
+RENDITION_STAGE_SECONDS = Histogram(
+    'video_rendition_stage_seconds', 'Time spent encoding and storing each rendition',
+    ['stage', 'resolution'], buckets=STAGE_BUCKETS
+)
+ENCODE_SPEED = Histogram(
+    'video_encode_speed_ratio', 'Seconds of video encoded per second, per rendition',
+    ['resolution'], buckets=SPEED_BUCKETS
+)
+SEGMENT_ENCODE_SECONDS = Histogram(
+    'video_segment_encode_seconds', 'Time spent encoding one segment of a segmented job into every rendition',
+    buckets=STAGE_BUCKETS
+)
+JOBS_FINISHED = Counter('video_jobs_finished_total', 'Jobs run by workers, by outcome', ['outcome'])
+RENDITIONS_FINISHED = Counter(
+    'video_renditions_finished_total', 'Renditions finished, by resolution and outcome', ['resolution', 'outcome']
+)
+SEGMENTS_FINISHED = Counter('video_segments_finished_total', 'Segment tasks run by workers, by outcome', ['outcome'])
+
+# Sampled by each worker's heartbeat
+SLOTS_TOTAL = Gauge('video_worker_slots', 'CPU slots workers hand out', multiprocess_mode='livesum')
+SLOTS_IN_USE = Gauge('video_worker_slots_in_use', 'CPU slots held by running encodes', multiprocess_mode='livesum')
+RUNNING_JOBS = Gauge('video_worker_running_jobs', 'Jobs running on workers', multiprocess_mode='livesum')
+RUNNING_SEGMENTS = Gauge(
+    'video_worker_running_segments', 'Segment tasks running on workers', multiprocess_mode='livesum'
+)
+SCRATCH_QUOTA = Gauge('video_scratch_quota_bytes', 'Scratch space workers may reserve', ['area'], multiprocess_mode='livesum')
+SCRATCH_RESERVED = Gauge(
+    'video_scratch_reserved_bytes', 'Scratch space reserved by running jobs', ['area'], multiprocess_mode='livesum'
+)
+
+HTTP_REQUESTS = Counter('video_api_requests_total', 'API requests, by handler and status', ['method', 'handler', 'status'])
+HTTP_REQUEST_SECONDS = Histogram(
+    'video_api_request_seconds', 'API response times, up to the start of the response body', ['method', 'handler']
+)
+JOBS_SUBMITTED = Counter('video_jobs_submitted_total', 'Jobs accepted by the API', ['priority'])
+JOBS_REJECTED = Counter('video_jobs_rejected_total', 'Job submissions refused by admission control', ['reason'])
+
+
+class JobTimings:
+    """Wall-clock seconds a job spends in each stage, for its job record.
+
+    Every stage is also observed into JOB_STAGE_SECONDS as it ends. A stage
+    entered more than once adds up.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = round(self.stages.get(stage, 0) + seconds, 3)
+        JOB_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - started)
+
+
+def rendition_timings(resolution: str, duration: float, encode: Optional[float] = None,
+                      upload: Optional[float] = None) -> dict:
+    """Observe a rendition's encode and upload times and return them for its conversion record.
+
+    Renditions encoded together in one pass each report the whole pass.
+    """
+    timings = {}
+    if encode is not None:
+        timings['encode'] = round(encode, 3)
+        RENDITION_STAGE_SECONDS.labels(stage='encode', resolution=resolution).observe(encode)
+        if encode > 0:
+            ENCODE_SPEED.labels(resolution=resolution).observe(duration / encode)
+    if upload is not None:
+        timings['upload'] = round(upload, 3)
+        RENDITION_STAGE_SECONDS.labels(stage='upload', resolution=resolution).observe(upload)
+    return timings
+
+
+def metrics_registry():
+    """The registry to expose: this process's, or every process's in multiprocess mode."""
+    if not MULTIPROCESS:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def start_exporter(port: int = WORKER_METRICS_PORT) -> bool:
+    """Serve this worker's metrics over HTTP; False if the port is taken or the exporter is off."""
+    if not port:
+        return False
+    try:
+        start_http_server(port, registry=metrics_registry())
+    except OSError as e:
+        # Another worker on the host has it; in multiprocess mode it reports this one too
+        print(f"[WARNING] Metrics exporter not started on port {port}: {str(e)}")
+        return False
+    print(f"[DEBUG] Serving metrics on port {port}")
+    return True
+
+
+def process_exited(pid: int):
+    """Drop a finished process's live gauges in multiprocess mode."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+
+class ClusterCollector:
+    """Cluster-wide figures read from Redis for one scrape: queues, capacity and job counts.
+
+    Each API process reads the same shared state, so these are the same
+    whichever process serves the scrape.
+    """
+
+    def __init__(self, classes: dict, capacity: dict, statuses: dict, active_jobs: int, queued_segments: int):
+        self.classes = classes
+        self.capacity = capacity
+        self.statuses = statuses
+        self.active_jobs = active_jobs
+        self.queued_segments = queued_segments
+
+    def collect(self):
+        queued = GaugeMetricFamily('video_queue_jobs', 'Jobs waiting in the queue', labels=['priority'])
+        backlog = GaugeMetricFamily(
+            'video_queue_backlog_seconds', 'Seconds the live workers need for the work queued at or above a priority',
+            labels=['priority']
+        )
+        dispatched = CounterMetricFamily(
+            'video_queue_dispatched', 'Jobs handed to workers from the queue', labels=['priority']
+        )
+        waited = CounterMetricFamily(
+            'video_queue_wait_seconds', 'Total time dispatched jobs spent in the queue', labels=['priority']
+        )
+        for priority, stats in self.classes.items():
+            queued.add_metric([priority], stats['queued'])
+            dispatched.add_metric([priority], stats['dispatched'])
+            waited.add_metric([priority], (stats['mean_wait_seconds'] or 0) * stats['dispatched'])
+            seconds = self.capacity['backlog'][priority]['backlog_seconds']
+            if seconds is not None:
+                backlog.add_metric([priority], seconds)
+        yield from (queued, backlog, dispatched, waited)
+
+        jobs = GaugeMetricFamily('video_jobs', 'Stored jobs by status', labels=['status'])
+        for status, count in self.statuses.items():
+            jobs.add_metric([status], count)
+        yield jobs
+        yield GaugeMetricFamily('video_active_jobs', 'Jobs claimed by workers', value=self.active_jobs)
+        yield GaugeMetricFamily('video_queue_segments', 'Segment tasks waiting for a worker', value=self.queued_segments)
+        yield GaugeMetricFamily('video_workers', 'Workers seen within the last lease', value=self.capacity['workers'])
+        yield GaugeMetricFamily('video_job_seats', 'Job seats of the live workers', value=self.capacity['job_seats'])
+        yield GaugeMetricFamily(
+            'video_cluster_encode_speed', 'Measured seconds of video one job seat encodes per second',
+            value=self.capacity['encode_speed']
+        )
+
+
+def exposition(cluster: Optional[ClusterCollector] = None) -> bytes:
+    """Text for a /metrics response: this process's (or every process's) metrics, then the cluster's."""
+    output = generate_latest(metrics_registry())
+    if cluster is not None:
+        registry = CollectorRegistry()
+        registry.register(cluster)
+        output += generate_latest(registry)
+    return output
+
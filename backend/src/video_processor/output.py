@@ -0,0 +1,139 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.retry import Retry
+
+from gcs import abandon_writer
+
+# Upload renditions while ffmpeg is still writing them instead of after the
+# encode finishes. Off by default: it delivers fragmented MP4 rather than
+# regular MP4 files, which some players seek in differently.
+PROGRESSIVE_UPLOAD = os.getenv('PROGRESSIVE_UPLOAD', 'false').lower() == 'true'
+# Size of each resumable upload request; must be a multiple of 256 KiB
+OUTPUT_CHUNK_SIZE = int(os.getenv('OUTPUT_CHUNK_SIZE', 8 * 1024 * 1024))
+# Finished files at least this big are uploaded as parallel parts and composed
+COMPOSITE_UPLOAD_THRESHOLD = int(os.getenv('COMPOSITE_UPLOAD_THRESHOLD', 256 * 1024 * 1024))
+COMPOSITE_PART_SIZE = 64 * 1024 * 1024
+# GCS composes at most 32 source objects in one request
+MAX_COMPOSE_PARTS = 32
+UPLOAD_THREADS = int(os.getenv('UPLOAD_THREADS', 8))
+
+OUTPUT_CONTENT_TYPE = 'video/mp4'
+OUTPUT_METADATA = {'auto-delete': 'true'}
+
+# Fragmented MP4 is written strictly front to back, so it can go to a pipe;
+# the moov box comes first and browsers can play it progressively
+PROGRESSIVE_OUTPUT_FLAGS = ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+# Resumable upload requests can be retried safely
+UPLOAD_RETRY = Retry(deadline=120)
+
+
+def prepare_blob(blob):
+    """Set the rendition's content type and metadata so the upload itself writes them."""
+    blob.content_type = OUTPUT_CONTENT_TYPE
+    blob.metadata = OUTPUT_METADATA
+    return blob
+
+
+def upload_file(blob, path: str):
+    """Upload a finished rendition, in parallel parts if it is big."""
+    prepare_blob(blob)
+    size = os.path.getsize(path)
+    if size < COMPOSITE_UPLOAD_THRESHOLD:
+        blob.upload_from_filename(path, content_type=OUTPUT_CONTENT_TYPE, retry=UPLOAD_RETRY)
+    else:
+        composite_upload(blob, path, size)
+
+
+def composite_upload(blob, path: str, size: int):
+    """Upload `path` as parts on UPLOAD_THREADS threads and compose them into `blob`.
+
+    The parts are temporary objects next to the destination and are deleted
+    once composed, or if the upload fails.
+    """
+    part_size = max(COMPOSITE_PART_SIZE, -(-size // MAX_COMPOSE_PARTS))
+    offsets = list(range(0, size, part_size))
+    prefix = f"{blob.name}.parts-{uuid.uuid4().hex[:8]}"
+    parts = [blob.bucket.blob(f"{prefix}/{i:02d}") for i in range(len(offsets))]
+
+    def upload_part(part, offset):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            part.upload_from_file(f, size=min(part_size, size - offset), retry=UPLOAD_RETRY)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(UPLOAD_THREADS, len(parts))) as executor:
+            for future in [executor.submit(upload_part, part, offset) for part, offset in zip(parts, offsets)]:
+                future.result()
+        blob.compose(parts)
+    finally:
+        for part in parts:
+            try:
+                part.delete()
+            except Exception:
+                pass
+
+
+class ProgressiveUpload:
+    """Upload one ffmpeg output through a pipe while it is being encoded.
+
+    Give `target` to ffmpeg as the output path and `fd` in its `pass_fds`.
+    A thread copies whatever ffmpeg writes into a resumable upload, so when
+    the encode ends only the last chunk is left to send. The object only
+    appears once `finish(True)` commits the upload; after a failed encode
+    `finish(False)` leaves the upload unfinished and nothing is stored.
+    """
+
+    def __init__(self, blob):
+        self.blob = prepare_blob(blob)
+        self.read_fd, self.fd = os.pipe()
+        self.writer = self.blob.open(
+            'wb', chunk_size=OUTPUT_CHUNK_SIZE, content_type=OUTPUT_CONTENT_TYPE, retry=UPLOAD_RETRY
+        )
+        self.error = None
+        self.size = 0
+        self.thread = threading.Thread(target=self._copy, daemon=True)
+        self.thread.start()
+
+    @property
+    def target(self) -> str:
+        return f"pipe:{self.fd}"
+
+    def _copy(self):
+        with os.fdopen(self.read_fd, 'rb', buffering=0) as pipe:
+            while True:
+                data = pipe.read(1024 * 1024)
+                if not data:
+                    break
+                self.size += len(data)
+                if self.error is None:
+                    try:
+                        self.writer.write(data)
+                    except Exception as e:
+                        # Keep draining the pipe so ffmpeg can finish and report
+                        self.error = e
+
+    def finish(self, success: bool):
+        """Wait for ffmpeg's output to be consumed and commit the upload if `success`.
+
+        Raises if the upload failed. Call once ffmpeg has exited, or has
+        failed to start.
+        """
+        # The reader only sees the end of the pipe once this copy is closed too
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.thread.join()
+        if self.error is not None:
+            abandon_writer(self.writer)
+            raise Exception(f"Upload of {self.blob.name} failed: {str(self.error)}")
+        if not success:
+            abandon_writer(self.writer)
+            return
+        if self.size == 0:
+            abandon_writer(self.writer)
+            raise Exception(f"ffmpeg wrote no output for {self.blob.name}")
+        self.writer.close()
@@ -0,0 +1,110 @@
+import html
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from output import OUTPUT_METADATA, UPLOAD_RETRY, UPLOAD_THREADS
+
+# "mp4" stores one standalone file per rendition; "adaptive" packages all
+# renditions as fMP4 segments with HLS and DASH manifests for bitrate switching
+MP4 = "mp4"
+ADAPTIVE = "adaptive"
+OUTPUT_FORMATS = (MP4, ADAPTIVE)
+
+# Length of each streaming segment; playback can start after the first one
+STREAM_SEGMENT_SECONDS = float(os.getenv('STREAM_SEGMENT_SECONDS', 4))
+
+# Lifetime (seconds) of the signed segment URLs handed out in manifests;
+# long enough to watch a whole video without refreshing the manifest
+STREAM_URL_TTL = int(os.getenv('STREAM_URL_TTL', 6 * 3600))
+
+HLS_MASTER = "master.m3u8"
+DASH_MANIFEST = "manifest.mpd"
+# Manifests the API serves: the two entry points and the per-stream HLS playlists
+MANIFEST_NAME = re.compile(r'^(master\.m3u8|manifest\.mpd|media_\d+\.m3u8)$')
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.mpd': 'application/dash+xml',
+    '.m4s': 'video/iso.segment'
+}
+
+HLS_URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+DASH_URL_ATTRIBUTE = re.compile(r'\b(sourceURL|media)="([^"]+)"')
+
+
+def package_prefix(job_id: str) -> str:
+    return f"processed/{job_id}/stream"
+
+
+def manifest_cache_key(job_id: str, name: str) -> str:
+    return f"manifest:{job_id}:{name}"
+
+
+def keyframe_args() -> list:
+    """Force keyframes on every segment boundary so all renditions cut at the same times."""
+    return ['-force_key_frames', f'expr:gte(t,n_forced*{STREAM_SEGMENT_SECONDS})']
+
+
+def package_args(has_audio: bool, output_dir: str) -> list:
+    """ffmpeg output options that package every mapped stream into `output_dir`.
+
+    The dash muxer writes one set of fMP4 segments and describes it twice:
+    `manifest.mpd` for DASH and `master.m3u8` plus a `media_N.m3u8` per
+    stream for HLS. Segments are listed one by one rather than by a URL
+    template, so the API can sign each of them.
+    """
+    adaptation_sets = "id=0,streams=v" + (" id=1,streams=a" if has_audio else "")
+    return [
+        '-f', 'dash',
+        '-seg_duration', str(STREAM_SEGMENT_SECONDS),
+        '-use_template', '0',
+        '-use_timeline', '0',
+        '-hls_playlist', '1',
+        '-hls_master_name', HLS_MASTER,
+        '-adaptation_sets', adaptation_sets,
+        '-init_seg_name', 'init-$RepresentationID$.m4s',
+        '-media_seg_name', 'chunk-$RepresentationID$-$Number%05d$.m4s',
+        '-y', os.path.join(output_dir, DASH_MANIFEST)
+    ]
+
+
+def upload_package(bucket, output_dir: str, prefix: str):
+    """Upload a packaged output, segments first so no manifest points at a missing one."""
+    names = sorted(os.listdir(output_dir))
+    segments = [name for name in names if name.endswith('.m4s')]
+    manifests = [name for name in names if name.endswith(('.m3u8', '.mpd'))]
+
+    def upload(name):
+        blob = bucket.blob(f"{prefix}/{name}")
+        blob.metadata = OUTPUT_METADATA
+        content_type = CONTENT_TYPES[os.path.splitext(name)[1]]
+        blob.upload_from_filename(os.path.join(output_dir, name), content_type=content_type, retry=UPLOAD_RETRY)
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        list(executor.map(upload, segments))
+        list(executor.map(upload, manifests))
+
+
+def sign_manifest(name: str, text: str, sign) -> str:
+    """Replace the segment references in a manifest with `sign(segment_name)`.
+
+    References to other playlists are left relative, so players fetch them
+    through the API as well.
+    """
+    def signed(ref):
+        return ref if ref.endswith('.m3u8') else sign(ref)
+
+    if name.endswith('.mpd'):
+        return DASH_URL_ATTRIBUTE.sub(
+            lambda m: f'{m.group(1)}="{html.escape(signed(html.unescape(m.group(2))))}"', text
+        )
+
+    lines = []
+    for line in text.splitlines():
+        if line.startswith('#'):
+            line = HLS_URI_ATTRIBUTE.sub(lambda m: f'URI="{signed(m.group(1))}"', line)
+        elif line.strip():
+            line = signed(line.strip())
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from source import input_args
+
+# How long probe results are kept in Redis
+PROBE_CACHE_TTL = int(os.getenv('PROBE_CACHE_TTL', 24 * 3600))
+# Number of probe results kept in process memory
+PROBE_MEMORY_CACHE_SIZE = 128
+# Bytes read from each of the head, middle and tail of a file for its content key
+HASH_SAMPLE_SIZE = 1024 * 1024
+# Query parameters of V4 and V2 signed URLs; they change with every signing
+# but not with the object
+SIGNING_PARAMS = ('X-Goog-', 'GoogleAccessId', 'Expires', 'Signature')
+
+_memory_cache = OrderedDict()
+# Jobs run on several threads of one worker
+_memory_cache_lock = threading.Lock()
+
+
+def probe_cache_key(source: str) -> str:
+    """Return the cache key for a local file path or URL.
+
+    Local files are keyed by their size and a hash of samples taken from the
+    head, middle and tail of the file, so the same content probed under
+    different temp paths shares one entry. URLs are keyed by the whole URL
+    without its signing parameters, so fresh signed URLs for one object
+    share an entry while URLs that differ in any other parameter do not.
+    """
+    if source.startswith('http'):
+        parts = urlsplit(source)
+        query = sorted(
+            (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not name.startswith(SIGNING_PARAMS)
+        )
+        return 'url:' + urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+    size = os.path.getsize(source)
+    digest = hashlib.sha256(str(size).encode())
+    with open(source, 'rb') as f:
+        for offset in (0, size // 2, max(size - HASH_SAMPLE_SIZE, 0)):
+            f.seek(offset)
+            digest.update(f.read(HASH_SAMPLE_SIZE))
+    return 'sha256:' + digest.hexdigest()
+
+
+def _parse_frame_rate(rate: Optional[str]) -> Optional[float]:
+    if not rate or rate == '0/0':
+        return None
+    if '/' in rate:
+        num, den = rate.split('/')
+        return float(num) / float(den) if float(den) else None
+    return float(rate)
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def probe_media(source: str, timeout: Optional[float] = None) -> dict:
+    """Run a single JSON ffprobe on `source` and summarise the result.
+
+    With `timeout`, ffprobe is killed and TimeoutExpired raised once it has
+    run that many seconds.
+    """
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-print_format', 'json',
+        '-show_format', '-show_streams'
+    ] + input_args(source)
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        print(f"[ERROR] Failed to probe video: {result.stderr}")
+        raise Exception(f"Failed to probe video: {result.stderr}")
+
+    data = json.loads(result.stdout)
+    fmt = data.get('format', {})
+
+    streams = []
+    for stream in data.get('streams', []):
+        streams.append({
+            "index": stream.get('index'),
+            "codec_type": stream.get('codec_type'),
+            "codec_name": stream.get('codec_name'),
+            "profile": stream.get('profile'),
+            "pix_fmt": stream.get('pix_fmt'),
+            "width": _to_int(stream.get('width')),
+            "height": _to_int(stream.get('height')),
+            "frame_rate": _parse_frame_rate(stream.get('avg_frame_rate') or stream.get('r_frame_rate')),
+            "bit_rate": _to_int(stream.get('bit_rate')),
+            "sample_rate": _to_int(stream.get('sample_rate')),
+            "channels": _to_int(stream.get('channels')),
+            "duration": _to_float(stream.get('duration')),
+        })
+
+    video = next((s for s in streams if s['codec_type'] == 'video'), None)
+    audio = next((s for s in streams if s['codec_type'] == 'audio'), None)
+
+    duration = _to_float(fmt.get('duration'))
+    if duration is None and video:
+        duration = video['duration']
+    if not duration:
+        raise Exception("Failed to get video duration")
+
+    return {
+        "duration": duration,
+        "size": _to_int(fmt.get('size')),
+        "bit_rate": _to_int(fmt.get('bit_rate')),
+        "format_name": fmt.get('format_name'),
+        "width": video['width'] if video else None,
+        "height": video['height'] if video else None,
+        "frame_rate": video['frame_rate'] if video else None,
+        "video_codec": video['codec_name'] if video else None,
+        "audio_codec": audio['codec_name'] if audio else None,
+        "has_audio": audio is not None,
+        "streams": streams,
+    }
+
+
+def get_media_info(source: str, redis_client=None, cache_key: Optional[str] = None) -> dict:
+    """Return probe data for `source`, running ffprobe only on a cache miss.
+
+    Results are cached in process memory and, when `redis_client` is given,
+    in Redis under `probe:{key}` so other workers and the API can reuse them.
+    """
+    key = cache_key or probe_cache_key(source)
+
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            _memory_cache.move_to_end(key)
+            return _memory_cache[key]
+
+    media = None
+    if redis_client is not None:
+        try:
+            cached = redis_client.get(f"probe:{key}")
+            if cached:
+                media = json.loads(cached)
+                print(f"[DEBUG] Probe cache hit for {key}")
+        except Exception as e:
+            print(f"[WARNING] Failed to read probe cache: {str(e)}")
+
+    if media is None:
+        media = probe_media(source)
+        media['cache_key'] = key
+        print(f"[DEBUG] Probed {source}: {media['width']}x{media['height']}, "
+              f"{media['duration']}s, {media['video_codec']}/{media['audio_codec']}")
+        if redis_client is not None:
+            try:
+                redis_client.set(f"probe:{key}", json.dumps(media), ex=PROBE_CACHE_TTL)
+            except Exception as e:
+                print(f"[WARNING] Failed to write probe cache: {str(e)}")
+
+    with _memory_cache_lock:
+        _memory_cache[key] = media
+        if len(_memory_cache) > PROBE_MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+    return media
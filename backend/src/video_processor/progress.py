@@ -0,0 +1,145 @@
+import os
+import re
+import selectors
+import time
+from collections import deque
+from typing import Optional
+
+# Seconds between the progress updates published for one ffmpeg process;
+# the blocks in between are coalesced into the latest
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', 2))
+# Lines of ffmpeg's stderr kept for the error message if it fails
+STDERR_TAIL_LINES = 50
+# Progress is held below 100 until the caller has stored the output
+MAX_RUNNING_PROGRESS = 98
+
+BITRATE = re.compile(r'^([\d.]+)kbits/s$')
+SPEED = re.compile(r'^([\d.e+-]+)x$')
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def out_time_seconds(block: dict) -> Optional[float]:
+    """Position reached in the output, in seconds.
+
+    `out_time_us` and `out_time_ms` are both microseconds (the latter is
+    misnamed and kept for older ffmpeg); `out_time` is HH:MM:SS.micro.
+    """
+    for key in ('out_time_us', 'out_time_ms'):
+        value = _to_float(block.get(key))
+        if value is not None:
+            return max(value, 0) / 1_000_000
+    out_time = block.get('out_time', '')
+    if out_time.count(':') == 2:
+        h, m, s = out_time.split(':')
+        return max(float(h) * 3600 + float(m) * 60 + float(s), 0)
+    return None
+
+
+def encode_stats(block: dict, duration: float) -> dict:
+    """Summarise one `-progress` block: frames, fps, speed (x realtime), bitrate and ETA.
+
+    Values ffmpeg reports as N/A (e.g. speed before the first frame) are None.
+    """
+    seconds = out_time_seconds(block)
+    speed = SPEED.match(block.get('speed', '').strip())
+    speed = float(speed.group(1)) if speed else None
+    bitrate = BITRATE.match(block.get('bitrate', '').strip())
+    eta = None
+    if block.get('progress') == 'end':
+        eta = 0
+    elif speed and seconds is not None and duration:
+        eta = round(max(duration - seconds, 0) / speed, 1)
+    return {
+        "frame": int(_to_float(block.get('frame')) or 0),
+        "fps": _to_float(block.get('fps')),
+        "speed": speed,
+        "bitrate_kbps": float(bitrate.group(1)) if bitrate else None,
+        "out_seconds": round(seconds, 3) if seconds is not None else None,
+        "eta_seconds": eta
+    }
+
+
+class ProgressMonitor:
+    """Follows an ffmpeg process started with `-progress pipe:1` and piped stderr.
+
+    Both pipes are read as data arrives from a single selector, so neither
+    can fill up and stall ffmpeg, and nothing is polled or printed per line.
+    Each complete `-progress` block is parsed; `on_progress(percent, stats)`
+    gets the latest one at most every `interval` seconds, and once more when
+    ffmpeg finishes. Only the tail of stderr is kept, for error messages.
+    """
+
+    def __init__(self, duration: float, on_progress, interval: float = PROGRESS_INTERVAL):
+        self.duration = duration
+        self.on_progress = on_progress
+        self.interval = interval
+        self.latest = None
+        self.stderr = deque(maxlen=STDERR_TAIL_LINES)
+        self._block = {}
+        self._published = None
+        self._last_publish = 0.0
+
+    def follow(self, process) -> int:
+        """Read `process` until both pipes close, then wait for it and return its exit code."""
+        selector = selectors.DefaultSelector()
+        pending = {}
+        for pipe, handler in ((process.stdout, self._progress_line), (process.stderr, self._stderr_line)):
+            selector.register(pipe, selectors.EVENT_READ, handler)
+            pending[pipe.fileno()] = b''
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+                    fd = key.fileobj.fileno()
+                    data = os.read(fd, 65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        if pending[fd]:
+                            key.data(pending[fd].decode(errors='replace'))
+                        continue
+                    # stderr stats lines end in carriage returns
+                    lines = re.split(rb'[\r\n]', pending[fd] + data)
+                    pending[fd] = lines.pop()
+                    for line in lines:
+                        if line:
+                            key.data(line.decode(errors='replace'))
+        finally:
+            selector.close()
+        returncode = process.wait()
+        self._publish()
+        return returncode
+
+    def stderr_tail(self, lines: int = 20) -> str:
+        return '\n'.join(list(self.stderr)[-lines:])
+
+    def _stderr_line(self, line: str):
+        self.stderr.append(line)
+
+    def _progress_line(self, line: str):
+        key, sep, value = line.partition('=')
+        if not sep:
+            return
+        self._block[key.strip()] = value.strip()
+        # `progress=continue|end` closes each block
+        if key.strip() == 'progress':
+            self.latest = encode_stats(self._block, self.duration)
+            self._block = {}
+            if time.monotonic() - self._last_publish >= self.interval:
+                self._publish()
+
+    def _publish(self):
+        if self.latest is None or self.latest is self._published:
+            return
+        self._published = self.latest
+        self._last_publish = time.monotonic()
+        seconds = self.latest['out_seconds'] or 0
+        percent = min(MAX_RUNNING_PROGRESS, seconds / self.duration * 100) if self.duration else 0
+        try:
+            self.on_progress(percent, self.latest)
+        except Exception as e:
+            print(f"[WARNING] Failed to publish progress: {str(e)}")
@@ -0,0 +1,217 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+# What to do with renditions larger than the source: "skip" drops them,
+# "cap" encodes the smallest of them at the source size instead.
+UPSCALE_POLICY = os.getenv('UPSCALE_POLICY', 'cap').lower()
+# Encoder profile for jobs that do not choose one
+DEFAULT_PROFILE = os.getenv('DEFAULT_PROFILE', 'default')
+
+
+class Resolution:
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+
+    @staticmethod
+    def from_string(res: str) -> 'Resolution':
+        if not isinstance(res, str) or res not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution: {res}")
+        return RESOLUTIONS[res]
+
+
+RESOLUTIONS = {
+    "4K": Resolution(3840, 2160),
+    "1080p": Resolution(1920, 1080),
+    "720p": Resolution(1280, 720),
+    "480p": Resolution(854, 480),
+    "360p": Resolution(640, 360),
+    "240p": Resolution(426, 240),
+    "144p": Resolution(256, 144)
+}
+
+
+class EncoderProfile:
+    """How renditions are encoded: codec, speed/quality trade-off, fps cap and audio.
+
+    `max_bitrates` maps resolutions to peak bitrates in kbit/s; CRF encodes
+    of those renditions are capped to them. `copy_audio` passes AAC source
+    audio through instead of encoding it again.
+    """
+
+    def __init__(self, name: str, codec: str, preset: str, crf: int, max_fps: Optional[float] = None,
+                 audio_bitrate: Optional[str] = None, tune: Optional[str] = None,
+                 max_bitrates: Optional[Dict[str, int]] = None, copy_audio: bool = False,
+                 extra_args: Tuple[str, ...] = ()):
+        self.name = name
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.max_fps = max_fps
+        self.audio_bitrate = audio_bitrate
+        self.tune = tune
+        self.max_bitrates = max_bitrates or {}
+        self.copy_audio = copy_audio
+        self.extra_args = extra_args
+
+    def video_args(self, resolution: str) -> List[str]:
+        args = ['-c:v', self.codec, '-preset', self.preset, '-crf', str(self.crf)]
+        if self.tune:
+            args += ['-tune', self.tune]
+        if resolution in self.max_bitrates:
+            rate = self.max_bitrates[resolution]
+            args += ['-maxrate', f'{rate}k', '-bufsize', f'{rate * 2}k']
+        return args + list(self.extra_args)
+
+    def audio_args(self, media: dict) -> List[str]:
+        if self.copy_audio and media.get('audio_codec') == 'aac':
+            return ['-c:a', 'copy']
+        args = ['-c:a', 'aac']
+        if self.audio_bitrate:
+            args += ['-b:a', self.audio_bitrate]
+        return args
+
+    def describe(self) -> dict:
+        return {
+            "codec": self.codec,
+            "preset": self.preset,
+            "crf": self.crf,
+            "max_fps": self.max_fps,
+            "audio_bitrate": self.audio_bitrate,
+            "tune": self.tune,
+            "max_bitrates": self.max_bitrates,
+            "copy_audio": self.copy_audio
+        }
+
+
+# Peak bitrates (kbit/s) per rendition, so each step of a streaming ladder
+# stays within a predictable bandwidth
+BITRATE_LADDER = {
+    "4K": 16000,
+    "1080p": 6000,
+    "720p": 3000,
+    "480p": 1500,
+    "360p": 800,
+    "240p": 400,
+    "144p": 200
+}
+
+PROFILES = {profile.name: profile for profile in [
+    EncoderProfile("default", "libx264", "medium", 23),
+    # About 2.7x the throughput of default on a 1080p60 ladder (benchmarks/encoder_profiles.py)
+    EncoderProfile("fast", "libx264", "veryfast", 23, max_fps=30, copy_audio=True),
+    EncoderProfile("quality", "libx264", "slow", 20, audio_bitrate="192k"),
+    EncoderProfile("streaming", "libx264", "medium", 23, audio_bitrate="128k", max_bitrates=BITRATE_LADDER),
+    # hvc1 tagging lets Apple players open HEVC in MP4
+    EncoderProfile("hevc", "libx265", "medium", 28, extra_args=('-tag:v', 'hvc1', '-x265-params', 'log-level=error'))
+]}
+
+
+def get_profile(name: Optional[str]) -> EncoderProfile:
+    profile = PROFILES.get(name or DEFAULT_PROFILE)
+    if profile is None:
+        raise ValueError(f"Unknown encoder profile: {name}")
+    return profile
+
+def _even(value: float) -> int:
+    return max(2, int(round(value / 2)) * 2)
+
+
+def fit_to_source(target: Resolution, source_width: int, source_height: int) -> Tuple[int, int]:
+    """Size a rendition so its short side matches the target, keeping the source aspect ratio."""
+    if source_width >= source_height:
+        height = target.height
+        width = _even(source_width * height / source_height)
+    else:
+        width = target.height
+        height = _even(source_height * width / source_width)
+    return width, _even(height)
+
+
+def plan_renditions(resolutions: List[str], media: dict) -> Tuple[List[dict], dict]:
+    """Decide which requested renditions to encode, and at what size.
+
+    Returns `(planned, skipped)`: `planned` is a list of
+    `{"resolution", "width", "height"}` dicts ordered as requested and
+    `skipped` maps each dropped resolution to the reason it was dropped.
+    Nothing is ever scaled above the source; see `UPSCALE_POLICY`. Raises
+    ValueError for resolutions that are not in RESOLUTIONS; the API refuses
+    those before a job is created.
+    """
+    source_width, source_height = media.get('width'), media.get('height')
+    if not source_width or not source_height:
+        raise ValueError("Source has no video stream")
+    source_short = min(source_width, source_height)
+
+    planned: List[dict] = []
+    skipped = {}
+    upscales = []
+    for resolution in resolutions:
+        if resolution in skipped or any(r['resolution'] == resolution for r in planned):
+            continue
+        target = Resolution.from_string(resolution)
+        if target.height > source_short:
+            upscales.append(resolution)
+            continue
+        width, height = fit_to_source(target, source_width, source_height)
+        planned.append({"resolution": resolution, "width": width, "height": height})
+
+    if upscales:
+        source_size = f"{source_width}x{source_height}"
+        covered = any(min(r['width'], r['height']) >= source_short for r in planned)
+        capped: Optional[str] = None
+        if UPSCALE_POLICY == 'cap' and not covered:
+            capped = min(upscales, key=lambda res: RESOLUTIONS[res].height)
+            planned.append({
+                "resolution": capped,
+                "width": _even(source_width),
+                "height": _even(source_height),
+                "capped": True
+            })
+        for resolution in upscales:
+            if resolution == capped:
+                continue
+            if capped:
+                skipped[resolution] = f"Source is {source_size}; capped to source size as {capped}"
+            else:
+                skipped[resolution] = f"Source is {source_size}; {resolution} would upscale"
+
+    order = {}
+    for i, res in enumerate(resolutions):
+        order.setdefault(res, i)
+    planned.sort(key=lambda r: order[r['resolution']])
+    return planned, skipped
+
+
+def apply_profile(renditions: List[dict], profile: EncoderProfile, media: dict) -> List[dict]:
+    """Complete planned renditions into full encode specs.
+
+    Adds `profile`, `video_args`, `audio_args` and `fps` (the frame rate
+    cap, or None to keep the source rate) to each rendition dict.
+    """
+    source_fps = media.get('frame_rate')
+    fps = profile.max_fps if profile.max_fps and source_fps and source_fps > profile.max_fps else None
+    for rendition in renditions:
+        rendition.update({
+            "profile": profile.name,
+            "video_args": profile.video_args(rendition['resolution']),
+            "audio_args": profile.audio_args(media),
+            "fps": fps
+        })
+    return renditions
+
+
+def video_filter(rendition: dict) -> str:
+    """Filter chain that turns the decoded source into `rendition`."""
+    chain = f"scale={rendition['width']}:{rendition['height']}"
+    if rendition.get('fps'):
+        chain += f",fps={rendition['fps']}"
+    return chain
+
+
+def stream_args(args: List[str], index: int) -> List[str]:
+    """Address `-option value` pairs to the `index`th video stream of a shared output."""
+    addressed = []
+    for flag, value in zip(args[::2], args[1::2]):
+        addressed += [f"{flag.split(':')[0]}:v:{index}", value]
+    return addressed
@@ -0,0 +1,228 @@
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, Optional
+
+# Local working space for inputs, outputs and segments. Each worker keeps
+# its jobs under SCRATCH_DIR/{worker_id}/{job}, so what a dead worker left
+# behind can be told apart from what live ones are still writing.
+SCRATCH_DIR = os.getenv('SCRATCH_DIR', '/tmp/video-processor')
+# Bytes this worker may reserve in SCRATCH_DIR; by default what is free
+# when it starts, less SCRATCH_HEADROOM_BYTES
+SCRATCH_QUOTA_BYTES = int(os.getenv('SCRATCH_QUOTA_BYTES', 0))
+# Bytes of the filesystem always left free, for logs and whatever else shares it
+SCRATCH_HEADROOM_BYTES = int(os.getenv('SCRATCH_HEADROOM_BYTES', 1024 ** 3))
+# Seconds a job waits for scratch space before it is handed back to the queue
+SCRATCH_WAIT = float(os.getenv('SCRATCH_WAIT', 300))
+# Seconds between checks of the filesystem while waiting, since other
+# workers and processes sharing it do not tell us when they free space
+SCRATCH_POLL_INTERVAL = 5
+
+# Optional memory-backed directory (e.g. /dev/shm/video-processor) for jobs
+# needing at most TMPFS_MAX_JOB_BYTES; counts against the container's memory
+TMPFS_DIR = os.getenv('TMPFS_DIR')
+TMPFS_QUOTA_BYTES = int(os.getenv('TMPFS_QUOTA_BYTES', 512 * 1024 ** 2))
+TMPFS_MAX_JOB_BYTES = int(os.getenv('TMPFS_MAX_JOB_BYTES', 128 * 1024 ** 2))
+
+# Estimated bits per pixel per frame of a CRF encode with no bitrate cap;
+# libx264 at CRF 23 lands around 0.1 for typical footage
+SCRATCH_BITS_PER_PIXEL = float(os.getenv('SCRATCH_BITS_PER_PIXEL', 0.1))
+# Audio bitrate (bit/s) assumed when the profile does not set one
+DEFAULT_AUDIO_BITRATE = 192000
+# Every estimate is scaled by this, so an encode a little bigger than
+# expected still fits
+SCRATCH_SAFETY_FACTOR = float(os.getenv('SCRATCH_SAFETY_FACTOR', 1.25))
+
+
+def directory_size(path: str) -> int:
+    """Bytes used by the files under `path`."""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+
+def _bitrate(value: str) -> Optional[float]:
+    """An ffmpeg bitrate such as `3000k` or `128k`, in bit/s."""
+    scale = {'k': 1e3, 'M': 1e6}.get(value[-1:], 1)
+    try:
+        return float(value.rstrip('kM')) * scale
+    except ValueError:
+        return None
+
+
+def _arg(args: list, flag: str) -> Optional[str]:
+    return args[args.index(flag) + 1] if flag in args[:-1] else None
+
+
+def input_bytes(media: dict) -> int:
+    """Size of a local copy of the probed input."""
+    if media.get('size'):
+        return media['size']
+    return int((media.get('bit_rate') or 0) * media['duration'] / 8)
+
+
+def audio_bytes(audio_args: list, duration: float) -> int:
+    """Estimated size of `duration` seconds of audio encoded with `audio_args`."""
+    rate = _bitrate(_arg(audio_args, '-b:a') or '') or DEFAULT_AUDIO_BITRATE
+    return int(rate * duration / 8 * SCRATCH_SAFETY_FACTOR)
+
+
+def rendition_bytes(rendition: dict, media: dict, duration: Optional[float] = None) -> int:
+    """Estimated size of a rendition's video, for the whole input or `duration` seconds of it.
+
+    Renditions capped with `-maxrate` are sized at the cap. Uncapped CRF
+    encodes are sized from their pixel rate at SCRATCH_BITS_PER_PIXEL.
+    """
+    duration = media['duration'] if duration is None else duration
+    rate = _bitrate(_arg(rendition['video_args'], '-maxrate') or '')
+    if rate is None:
+        fps = rendition.get('fps') or media.get('frame_rate') or 30
+        rate = rendition['width'] * rendition['height'] * fps * SCRATCH_BITS_PER_PIXEL
+    return int(rate * duration / 8 * SCRATCH_SAFETY_FACTOR)
+
+
+class ScratchSpace:
+    """Byte reservations in one scratch directory, shared by every job on this worker.
+
+    Like `slots.SlotBudget`, requests are granted in arrival order. A request
+    is granted once it fits in the quota and the filesystem still has room
+    for it on top of the headroom and of what earlier reservations have yet
+    to write, so workers and other processes sharing the filesystem are
+    accounted for too. Requests for no space at all do not queue behind
+    others. Requests larger than the whole quota are capped to it and only
+    run while nothing else holds space.
+    """
+
+    def __init__(self, root: str, quota: int = 0, headroom: int = 0):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.headroom = headroom
+        self.quota = quota or max(shutil.disk_usage(root).free - headroom, 0)
+        self.in_use = 0
+        self.reservations: Dict[str, int] = {}
+        self._cond = threading.Condition()
+        self._waiting = deque()
+
+    def _unwritten(self) -> int:
+        return sum(max(granted - directory_size(path), 0) for path, granted in self.reservations.items())
+
+    def _fits(self, nbytes: int) -> bool:
+        if nbytes >= self.quota:
+            return self.in_use == 0
+        if self.in_use + nbytes > self.quota:
+            return False
+        return shutil.disk_usage(self.root).free - self.headroom - self._unwritten() >= nbytes
+
+    def acquire(self, name: str, nbytes: int, timeout: Optional[float] = None) -> Optional[str]:
+        """Reserve `nbytes` for a fresh directory `name`, waiting up to `timeout` seconds.
+
+        Returns the directory, or None if the space did not free up in time.
+        """
+        nbytes = min(max(0, nbytes), self.quota)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while (nbytes and self._waiting[0] is not ticket) or not self._fits(nbytes):
+                    remaining = SCRATCH_POLL_INTERVAL
+                    if deadline is not None:
+                        remaining = min(remaining, deadline - time.monotonic())
+                        if remaining <= 0:
+                            return None
+                    self._cond.wait(remaining)
+                path = os.path.join(self.root, name)
+                shutil.rmtree(path, ignore_errors=True)
+                os.makedirs(path)
+                self.reservations[path] = nbytes
+                self.in_use += nbytes
+                return path
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+    def release(self, path: str):
+        """Delete a reserved directory and give its space back."""
+        shutil.rmtree(path, ignore_errors=True)
+        with self._cond:
+            self.in_use -= self.reservations.pop(path, 0)
+            self._cond.notify_all()
+
+
+class Scratch:
+    """This worker's scratch space: its SCRATCH_DIR area and, if set up, a tmpfs one for small jobs."""
+
+    def __init__(self, worker_id: str):
+        self.disk = ScratchSpace(os.path.join(SCRATCH_DIR, worker_id), SCRATCH_QUOTA_BYTES, SCRATCH_HEADROOM_BYTES)
+        self.tmpfs = None
+        if TMPFS_DIR:
+            self.tmpfs = ScratchSpace(os.path.join(TMPFS_DIR, worker_id), TMPFS_QUOTA_BYTES)
+        self._spaces = {}
+
+    def acquire(self, name: str, nbytes: int, timeout: Optional[float] = SCRATCH_WAIT) -> Optional[str]:
+        """Reserve a directory for `nbytes` of scratch files; None if none freed up within `timeout`."""
+        space, path = self.disk, None
+        if self.tmpfs and nbytes <= TMPFS_MAX_JOB_BYTES:
+            space, path = self.tmpfs, self.tmpfs.acquire(name, nbytes, timeout=0)
+        if path is None:
+            space, path = self.disk, self.disk.acquire(name, nbytes, timeout)
+        if path:
+            self._spaces[path] = space
+            print(f"[DEBUG] Reserved {nbytes / 1024 ** 2:.0f} MiB of scratch space at {path}")
+        return path
+
+    def release(self, path: str):
+        space = self._spaces.pop(path, None)
+        if space:
+            space.release(path)
+
+    def usage(self) -> dict:
+        return {
+            area: {"path": space.root, "quota": space.quota, "reserved": space.in_use, "jobs": len(space.reservations)}
+            for area, space in (('disk', self.disk), ('tmpfs', self.tmpfs)) if space
+        }
+
+
+def clean_orphans(worker_id: Optional[str], live_workers: Iterable[str], grace: float):
+    """Delete scratch files no running job can still be using.
+
+    This worker's own area is emptied, since whatever it was doing before
+    a restart starts again from the job's stored state. Areas of workers
+    that are no longer live, and files left directly in the scratch
+    directories by earlier versions, are deleted once untouched for `grace`
+    seconds, so a worker that is only just starting up keeps its files.
+    Without a `worker_id`, as when the API clears up, only those are deleted.
+    """
+    live = set(live_workers) - {worker_id}
+    cutoff = time.time() - grace
+    for root in filter(None, (SCRATCH_DIR, TMPFS_DIR)):
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name in live:
+                continue
+            try:
+                if entry.name != worker_id and entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                print(f"[DEBUG] Removed orphaned scratch files {entry.path}")
+            except OSError as e:
+                print(f"[WARNING] Failed to remove orphaned scratch files {entry.path}: {str(e)}")
@@ -0,0 +1,223 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from dispatch import LEASE_TTL, MAX_JOB_ATTEMPTS, RENEW_LEASE_SCRIPT
+
+SEGMENT_QUEUE = "segment_queue"
+
+# Split jobs at least this long (seconds) into segments encoded in parallel
+SEGMENT_MIN_DURATION = float(os.getenv('SEGMENT_MIN_DURATION', 600))
+# Target segment length; cuts land on the first keyframe after each multiple
+SEGMENT_SECONDS = float(os.getenv('SEGMENT_SECONDS', 60))
+SEGMENTED_ENCODING = os.getenv('SEGMENTED_ENCODING', 'true').lower() == 'true'
+
+# Claim a queued segment for a worker: mark it running under a lease, unless
+# the job it belongs to has since finished or restarted with a new run
+CLAIM_SEGMENT_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[2] .. ':status', 'running', ARGV[2] .. ':worker', ARGV[3])
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[4])
+return 1
+"""
+
+# Record a segment's result if it still belongs to the current run
+FINISH_SEGMENT_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('DEL', KEYS[2])
+return 1
+"""
+
+
+# Put a claimed segment back at the end of the queue without counting an
+# attempt, if it still belongs to the current run
+RETURN_SEGMENT_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[2] .. ':status', 'queued', ARGV[2] .. ':progress', 0)
+redis.call('DEL', KEYS[2])
+redis.call('LPUSH', KEYS[3], ARGV[3])
+return 1
+"""
+
+
+def segment_state_key(job_id: str) -> str:
+    return f"segments:{job_id}"
+
+
+def segment_lease_key(task: str) -> str:
+    return f"segment_lease:{task}"
+
+
+def segment_task(job_id: str, run: str, index: int) -> str:
+    return f"{job_id}:{run}:{index}"
+
+
+def parse_segment_task(task: str) -> Tuple[str, str, int]:
+    job_id, run, index = task.rsplit(':', 2)
+    return job_id, run, int(index)
+
+
+def use_segments(media: dict) -> bool:
+    return SEGMENTED_ENCODING and media.get('duration', 0) >= SEGMENT_MIN_DURATION
+
+
+def create_segments(client: redis.Redis, job_id: str, run: str, renditions: list, durations: List[float],
+                    output_format: str = "mp4"):
+    """Record a job's segments and queue one encode task per segment.
+
+    The state hash `segments:{job_id}` holds the run id, the renditions to
+    encode, the job's output format and, per segment, `{i}:status`, `{i}:progress`, `{i}:duration`
+    and `{i}:attempts`. Tasks from an earlier run of the same job are
+    ignored by workers, since their run id no longer matches. The state
+    outlives the worker coordinating the run, so if it dies the job's next
+    attempt carries on with the same run (see `resumable_run`).
+    """
+    mapping = {
+        "run": run,
+        "renditions": json.dumps(renditions),
+        "output_format": output_format,
+        "count": len(durations)
+    }
+    for index, duration in enumerate(durations):
+        mapping.update({
+            f"{index}:status": "queued",
+            f"{index}:progress": 0,
+            f"{index}:duration": duration,
+            f"{index}:attempts": 0
+        })
+    pipe = client.pipeline()
+    pipe.delete(segment_state_key(job_id))
+    pipe.hset(segment_state_key(job_id), mapping=mapping)
+    pipe.lpush(SEGMENT_QUEUE, *[segment_task(job_id, run, index) for index in range(len(durations))])
+    pipe.execute()
+
+
+def resumable_run(client: redis.Redis, job_id: str, renditions: list, output_format: str = "mp4") -> Optional[Tuple[str, int]]:
+    """The run left by an interrupted attempt of the job, if it can produce `renditions`.
+
+    Returns `(run, segment count)`. Its segments that are done need not be
+    encoded again; the run must be for the same output format and encode
+    every rendition wanted, with the same settings.
+    """
+    run, encoded, run_format, count = client.hmget(
+        segment_state_key(job_id), 'run', 'renditions', 'output_format', 'count'
+    )
+    if not run or run_format != output_format:
+        return None
+    encoded = json.loads(encoded)
+    if any(json.loads(json.dumps(rendition)) not in encoded for rendition in renditions):
+        return None
+    return run, int(count)
+
+
+def claim_segment(blocking_client: redis.Redis, worker_id: str, timeout: int = 0) -> Optional[Tuple[str, dict]]:
+    """Block until a segment task is queued and lease it to this worker.
+
+    Returns `(task, state)`, or None for stale tasks and timeouts. Tasks are
+    popped without a processing list: a segment that is lost between the
+    pop and the lease is requeued by its job's coordinator.
+    """
+    popped = blocking_client.brpop(SEGMENT_QUEUE, timeout)
+    if not popped:
+        return None
+    task = popped[1]
+    job_id, run, index = parse_segment_task(task)
+    claim = blocking_client.register_script(CLAIM_SEGMENT_SCRIPT)
+    if not claim(keys=[segment_state_key(job_id), segment_lease_key(task)], args=[run, index, worker_id, LEASE_TTL]):
+        return None
+    state = blocking_client.hgetall(segment_state_key(job_id))
+    return task, state
+
+
+def set_segment_progress(client: redis.Redis, task: str, progress: float):
+    job_id, _, index = parse_segment_task(task)
+    client.hset(segment_state_key(job_id), f"{index}:progress", progress)
+
+
+def finish_segment(client: redis.Redis, task: str, status: str, error: Optional[str] = None) -> bool:
+    """Mark a segment done or failed and release its lease."""
+    job_id, run, index = parse_segment_task(task)
+    args = [run, f"{index}:status", status]
+    if status == "done":
+        args += [f"{index}:progress", 100]
+    if error:
+        args += [f"{index}:error", error]
+    finish = client.register_script(FINISH_SEGMENT_SCRIPT)
+    return bool(finish(keys=[segment_state_key(job_id), segment_lease_key(task)], args=args))
+
+
+def return_segment(client: redis.Redis, task: str) -> bool:
+    """Give up a claimed segment this worker cannot encode yet, for any worker to take."""
+    job_id, run, index = parse_segment_task(task)
+    script = client.register_script(RETURN_SEGMENT_SCRIPT)
+    return bool(script(keys=[segment_state_key(job_id), segment_lease_key(task), SEGMENT_QUEUE], args=[run, index, task]))
+
+
+def renew_segment_leases(client: redis.Redis, worker_id: str, tasks: List[str]) -> List[str]:
+    """Extend the leases of segments this worker is encoding; returns the segments whose lease was lost.
+
+    A lost lease stays lost: the segment may already be queued again or
+    claimed by another worker.
+    """
+    renew = client.register_script(RENEW_LEASE_SCRIPT)
+    pipe = client.pipeline()
+    for task in tasks:
+        renew(keys=[segment_lease_key(task)], args=[worker_id, LEASE_TTL], client=pipe)
+    results = pipe.execute()
+    return [task for task, renewed in zip(tasks, results) if not renewed]
+
+
+def segment_states(client: redis.Redis, job_id: str) -> Dict[int, dict]:
+    """Per-segment status, progress, duration and attempts of a job."""
+    state = client.hgetall(segment_state_key(job_id))
+    segments = {}
+    for field, value in state.items():
+        index, sep, attr = field.partition(':')
+        if sep:
+            segments.setdefault(int(index), {})[attr] = value
+    for segment in segments.values():
+        segment['progress'] = float(segment.get('progress', 0))
+        segment['duration'] = float(segment.get('duration', 0))
+        segment['attempts'] = int(segment.get('attempts', 0))
+    return segments
+
+
+def orphaned_segments(client: redis.Redis, job_id: str, run: str, segments: Dict[int, dict]) -> List[int]:
+    """Segments that are neither queued nor held under a live lease."""
+    pending = [index for index, segment in segments.items() if segment.get('status') in ('queued', 'running')]
+    pipe = client.pipeline(transaction=False)
+    for index in pending:
+        task = segment_task(job_id, run, index)
+        pipe.exists(segment_lease_key(task))
+        pipe.lpos(SEGMENT_QUEUE, task)
+    results = pipe.execute()
+    return [
+        index for i, index in enumerate(pending)
+        if not results[2 * i] and results[2 * i + 1] is None
+    ]
+
+
+def requeue_segment(client: redis.Redis, job_id: str, run: str, index: int) -> bool:
+    """Queue a lost segment again. Returns False once it has run out of attempts."""
+    attempts = client.hincrby(segment_state_key(job_id), f"{index}:attempts", 1)
+    if attempts > MAX_JOB_ATTEMPTS:
+        return False
+    pipe = client.pipeline()
+    pipe.hset(segment_state_key(job_id), mapping={f"{index}:status": "queued", f"{index}:progress": 0})
+    pipe.rpush(SEGMENT_QUEUE, segment_task(job_id, run, index))
+    pipe.execute()
+    return True
+
+
+def delete_segments(client: redis.Redis, job_id: str):
+    """Forget a job's segments; tasks still queued for it are skipped by workers."""
+    client.delete(segment_state_key(job_id))
@@ -0,0 +1,62 @@
+import math
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+
+# Worker processes sharing this host's CPUs. The image runs one under
+# supervisord and one per API process, so it sets this to 5; each worker's
+# default budget is its share of the cores, so together they hand out no
+# more slots than the host has.
+WORKERS_PER_HOST = max(1, int(os.getenv('WORKERS_PER_HOST', 1)))
+# CPU slots this worker hands out across all running jobs
+WORKER_SLOTS = int(os.getenv('WORKER_SLOTS', max(1, cpu_count() // WORKERS_PER_HOST)))
+# Slots a 1080p libx264 encode can keep busy; other sizes scale with pixel count
+SLOTS_PER_1080P = int(os.getenv('SLOTS_PER_1080P', 4))
+
+
+def rendition_cost(rendition: dict) -> int:
+    """Number of CPU slots an encode of `rendition` should get."""
+    pixels = rendition['width'] * rendition['height']
+    return max(1, math.ceil(pixels / (1920 * 1080) * SLOTS_PER_1080P))
+
+
+class SlotBudget:
+    """A weighted semaphore shared by every job running in this worker.
+
+    Requests are granted in arrival order, so a large encode waiting for
+    slots is not starved by a stream of small ones. Requests larger than
+    the whole budget are capped to it.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        self.in_use = 0
+        self._cond = threading.Condition()
+        self._waiting = deque()
+
+    def acquire(self, slots: int) -> int:
+        slots = min(max(1, slots), self.total)
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            while self._waiting[0] is not ticket or self.in_use + slots > self.total:
+                self._cond.wait()
+            self._waiting.popleft()
+            self.in_use += slots
+            self._cond.notify_all()
+        return slots
+
+    def release(self, slots: int):
+        with self._cond:
+            self.in_use -= slots
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, slots: int):
+        granted = self.acquire(slots)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
@@ -0,0 +1,88 @@
+import os
+import struct
+
+import requests
+
+# 'stream' lets ffmpeg read remote inputs straight from their URL while it
+# encodes; 'download' always fetches a local copy first
+INPUT_MODE = os.getenv('INPUT_MODE', 'stream')
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+# Top-level MP4 boxes inspected before assuming the input needs seeking
+MAX_BOX_LOOKUPS = 16
+
+# Keep reading through dropped connections and stalls; signed URLs accept
+# the range requests ffmpeg resumes with
+HTTP_INPUT_OPTIONS = [
+    '-reconnect', '1',
+    '-reconnect_streamed', '1',
+    '-reconnect_on_network_error', '1',
+    '-reconnect_delay_max', '10',
+    '-rw_timeout', '30000000'
+]
+
+# Box types that can start an ISO base media file (MP4, MOV, M4V, 3GP)
+ISO_BMFF_FIRST_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot'}
+
+
+def is_remote(source: str) -> bool:
+    return source.startswith(('http://', 'https://'))
+
+
+def input_args(source: str) -> list:
+    """ffmpeg arguments that open `source`, a local path or a URL, as an input."""
+    if is_remote(source):
+        return HTTP_INPUT_OPTIONS + ['-i', source]
+    return ['-i', source]
+
+
+def _read_range(session: requests.Session, url: str, start: int, length: int) -> bytes:
+    response = session.get(url, headers={'Range': f"bytes={start}-{start + length - 1}"}, timeout=30)
+    if response.status_code == 416:
+        return b''
+    if response.status_code != 206:
+        raise requests.RequestException(f"Range request answered with {response.status_code}")
+    return response.content
+
+
+def needs_local_copy(url: str) -> bool:
+    """Whether ffmpeg would have to seek around `url` to read it.
+
+    MP4s with the `moov` index after the media data (the default for most
+    encoders unless written with `-movflags +faststart`) cannot be decoded
+    front to back, and over HTTP every seek is a new request. The top-level
+    boxes are walked with small range requests until `moov` or `mdat` shows
+    up. Other containers (MPEG-TS, Matroska, WebM) are read sequentially.
+    Returns True if the server does not answer range requests.
+    """
+    try:
+        with requests.Session() as session:
+            offset = 0
+            for _ in range(MAX_BOX_LOOKUPS):
+                header = _read_range(session, url, offset, 16)
+                if len(header) < 8:
+                    return False
+                size, box_type = struct.unpack('>I4s', header[:8])
+                if offset == 0 and box_type not in ISO_BMFF_FIRST_BOXES:
+                    return False
+                if box_type == b'moov':
+                    return False
+                if box_type == b'mdat':
+                    return True
+                if size == 1:
+                    size = struct.unpack('>Q', header[8:16])[0]
+                if size < 8:
+                    # Box runs to the end of the file (size 0) or is malformed
+                    return True
+                offset += size
+    except requests.RequestException as e:
+        print(f"[WARNING] Could not inspect {url.split('?')[0]}: {str(e)}")
+    return True
+
+
+def download(url: str, path: str):
+    """Download `url` to `path` in DOWNLOAD_CHUNK_SIZE pieces."""
+    with requests.get(url, stream=True, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
@@ -5,10 +5,52 @@ import signal
 import sys
 import subprocess
 import os
-import requests
 from datetime import datetime, timedelta
 from google.cloud import storage
-from multiprocessing import Pool, cpu_count
+from google.api_core.exceptions import NotFound
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+import threading
+import shutil
+import atexit
+import uuid
+from typing import Optional
+from probe import get_media_info
+from progress import ProgressMonitor
+from renditions import plan_renditions, get_profile, apply_profile, video_filter, stream_args
+from ladder import build_ladder_command, start_audio_pipe
+from dispatch import (
+    get_blocking_client, claim_next_job, ack_job, defer_job, pending_jobs, queued_at,
+    renew_leases, reap_expired_jobs, migrate_legacy_queue, LEASE_TTL
+)
+from slots import SlotBudget, WORKER_SLOTS, rendition_cost
+from capacity import (
+    MAX_CONCURRENT_JOBS, WORKER_TTL, claim_worker_id, register_worker, unregister_worker, live_workers,
+    record_encode_speed
+)
+from jobstore import load_job, update_job, set_job_status, update_conversions
+from gcs import signed_url
+from cache import (
+    TRANSCODE_CACHE, cache_entry_id, cache_prefix, lookup_cache, store_cache, evict_cache
+)
+from output import (
+    PROGRESSIVE_UPLOAD, PROGRESSIVE_OUTPUT_FLAGS, UPLOAD_THREADS, ProgressiveUpload, upload_file
+)
+from packaging import (
+    ADAPTIVE, HLS_MASTER, STREAM_SEGMENT_SECONDS, package_prefix, keyframe_args, package_args, upload_package
+)
+from segments import (
+    SEGMENT_SECONDS, use_segments, create_segments, resumable_run, claim_segment, set_segment_progress,
+    finish_segment, return_segment, renew_segment_leases, segment_states, orphaned_segments, requeue_segment,
+    delete_segments, parse_segment_task
+)
+from source import INPUT_MODE, is_remote, input_args, needs_local_copy, download
+from scratch import SCRATCH_WAIT, Scratch, clean_orphans, input_bytes, audio_bytes, rendition_bytes
+from metrics import (
+    JobTimings, rendition_timings, start_exporter, process_exited, JOBS_FINISHED, RENDITIONS_FINISHED,
+    SEGMENT_ENCODE_SECONDS, SEGMENTS_FINISHED, SLOTS_TOTAL, SLOTS_IN_USE, RUNNING_JOBS, RUNNING_SEGMENTS,
+    SCRATCH_QUOTA, SCRATCH_RESERVED
+)
 
 def get_redis_client():
     redis_host = os.getenv('REDIS_HOST', 'localhost')
@@ -35,7 +77,26 @@ def get_redis_client():
                 raise Exception(f"Could not connect to Redis after {max_retries} attempts: {str(e)}")
 
 redis_client = None
-MAX_CONCURRENT_JOBS = 2
+
+# Created in start_worker and shared by every job on this worker
+slot_budget = None
+rendition_executor = None
+scratch = None
+
+# Segment encodes run at once on this worker, on the same slot budget as jobs
+MAX_CONCURRENT_SEGMENTS = int(os.getenv('MAX_CONCURRENT_SEGMENTS', max(2, cpu_count() // 4)))
+# Seconds between a segmented job's checks on its segments
+SEGMENT_POLL_INTERVAL = 2
+
+# Jobs and segment tasks currently running here, whose leases the heartbeat keeps alive
+running_jobs = set()
+running_segments = set()
+running_jobs_lock = threading.Lock()
+HEARTBEAT_INTERVAL = LEASE_TTL / 3
+
+# Decode each input once and write every rendition from a single ffmpeg process
+LADDER_MODE = os.getenv('LADDER_MODE', 'true').lower() == 'true'
+
 
 # Initialize GCS client with service account
 credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', os.path.join(os.path.dirname(__file__), "experiment-456220-328a0f14d44e.json"))
@@ -68,175 +129,311 @@ except Exception as e:
     print(f"[WORKER] Error accessing bucket {BUCKET_NAME}: {str(e)}")
     raise Exception("Storage configuration error")
 
-# Use proper temp directory for Windows
-TEMP_DIR = "/tmp/video-processor" # Changed to Linux-compatible path
-os.makedirs(TEMP_DIR, exist_ok=True)
-print(f"[DEBUG] Using temp directory: {TEMP_DIR}")
-
-class Resolution:
-    def __init__(self, width: int, height: int):
-        self.width = width
-        self.height = height
-
-    @staticmethod
-    def from_string(res: str) -> 'Resolution':
-        resolutions = {
-            "4K": Resolution(3840, 2160),
-            "1080p": Resolution(1920, 1080),
-            "720p": Resolution(1280, 720),
-            "480p": Resolution(854, 480),
-            "360p": Resolution(640, 360),
-            "240p": Resolution(426, 240),
-            "144p": Resolution(256, 144)
-        }
-        return resolutions.get(res, Resolution(854, 480))
-
 def update_job_status(job_id: str, resolution: str, status: dict):
+    update_job_statuses(job_id, {resolution: status})
+
+def update_job_statuses(job_id: str, statuses: dict):
+    """Write rendition fields; overall progress is recomputed inside Redis."""
     try:
-        job_data = json.loads(redis_client.get(f"job:{job_id}"))
-        job_data['conversions'][resolution].update(status)
-        
-        # Calculate overall progress
-        total_progress = sum(conv['progress'] for conv in job_data['conversions'].values())
-        job_data['progress'] = total_progress / len(job_data['conversions'])
-        
-        redis_client.set(f"job:{job_id}", json.dumps(job_data))
-        print(f"Updated status for job {job_id}, resolution {resolution}: {status}")
+        progress = update_conversions(redis_client, job_id, statuses)
+        print(f"Updated status for job {job_id}, resolutions {list(statuses)}: overall progress {progress}")
     except Exception as e:
         print(f"Error updating job status: {str(e)}")
 
-def process_video_in_worker(job_id: str, input_path: str, resolution: str) -> dict:
+def run_ffmpeg(cmd: list, duration: float, on_progress, pass_fds=()) -> dict:
+    """Run an ffmpeg command that writes `-progress pipe:1` and report progress.
+
+    `on_progress(percent, stats)` is called with the percentage (capped at
+    98) and the encode stats of `progress.encode_stats`, at most every
+    PROGRESS_INTERVAL seconds and once at the end. `pass_fds` are file
+    descriptors ffmpeg writes outputs to (as `pipe:N`). Returns the final
+    stats; raises if ffmpeg exits with a non-zero status.
+    """
+    print(f"[DEBUG] Running FFmpeg command: {' '.join(cmd)}")
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds)
+    monitor = ProgressMonitor(duration, on_progress)
+    if monitor.follow(process) != 0:
+        raise Exception(f"FFmpeg failed: {monitor.stderr_tail()}")
+    return monitor.latest
+
+def output_blob(job_id: str, resolution: str):
+    return bucket.blob(f"processed/{job_id}/{resolution}.mp4")
+
+def completed_output(job_id: str, resolution: str, blob) -> dict:
+    print(f"Successfully processed {resolution} for job {job_id}")
+    return {
+        "status": "completed",
+        "progress": 100,
+        "output_url": signed_url(blob, timedelta(minutes=5))
+    }
+
+def upload_output(job_id: str, resolution: str, temp_output_path: str) -> dict:
+    if not os.path.exists(temp_output_path):
+        raise Exception("Output file not created")
+
+    blob = output_blob(job_id, resolution)
+    upload_file(blob, temp_output_path)
+    os.remove(temp_output_path)
+    return completed_output(job_id, resolution, blob)
+
+def finish_output(job_id: str, resolution: str, output) -> dict:
+    """Finish storing a rendition: commit its progressive upload, or upload its file."""
+    if isinstance(output, ProgressiveUpload):
+        output.finish(True)
+        return completed_output(job_id, resolution, output.blob)
+    return upload_output(job_id, resolution, output)
+
+def discard_output(output):
+    if isinstance(output, ProgressiveUpload):
+        try:
+            output.finish(False)
+        except Exception as e:
+            print(f"[WARNING] {str(e)}")
+    elif os.path.exists(output):
+        os.remove(output)
+
+def open_output(job_id: str, resolution: str, workdir: str):
+    """Where ffmpeg should write a rendition: a progressive upload or a file in the job's scratch directory."""
+    if PROGRESSIVE_UPLOAD:
+        return ProgressiveUpload(output_blob(job_id, resolution))
+    return os.path.join(workdir, f"{resolution}.mp4")
+
+def stored_outputs(job_id: str, output_format: str, resolutions: list) -> list:
+    """Those of a job's finished renditions whose outputs are still in storage."""
+    if output_format == ADAPTIVE:
+        return resolutions if bucket.blob(f"{package_prefix(job_id)}/{HLS_MASTER}").exists() else []
+    return [resolution for resolution in resolutions if output_blob(job_id, resolution).exists()]
+
+def output_target(output) -> str:
+    return output.target if isinstance(output, ProgressiveUpload) else output
+
+def output_fds(outputs) -> list:
+    return [output.fd for output in outputs if isinstance(output, ProgressiveUpload)]
+
+def shares_audio(renditions: list, media: dict) -> bool:
+    """Whether a job's renditions should mux one shared audio encode instead of each encoding it.
+
+    Profiles that stream-copy AAC audio have nothing to share.
+    """
+    return media.get('has_audio', False) and renditions[0]['audio_args'] != ['-c:a', 'copy']
+
+def process_ladder_in_worker(job_id: str, input_path: str, renditions: list, media: dict, workdir: str) -> dict:
+    """Transcode all planned renditions of a job in a single ffmpeg pass.
+
+    Returns a dict mapping each resolution to its result, in the same shape
+    as `process_video_in_worker`.
+    """
+    resolutions = [rendition['resolution'] for rendition in renditions]
+    outputs = {}
+    audio_process = None
+    audio_fd = None
     try:
-        print(f"[DEBUG] Starting processing for job {job_id}, resolution {resolution}")
-        
-        temp_output_path = os.path.join(TEMP_DIR, f"{job_id}_{resolution}.mp4")
-        print(f"[DEBUG] Output path: {temp_output_path}")
+        print(f"[DEBUG] Starting ladder processing for job {job_id}, resolutions {resolutions}")
 
-        target_res = Resolution.from_string(resolution)
-        
-        # Check if input file exists
-        if not os.path.exists(input_path):
+        if not is_remote(input_path) and not os.path.exists(input_path):
             raise FileNotFoundError(f"Input file not found: {input_path}")
-        
-        # Get video duration
-        duration_cmd = [
-            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1', input_path
-        ]
+
+        duration = media['duration']
+
+        def on_progress(progress, stats):
+            update_job_statuses(job_id, {
+                resolution: {"status": "processing", "progress": progress, "encode": stats}
+                for resolution in resolutions
+            })
+
+        # One at a time, so those already started are discarded if a later one fails to open
+        for resolution in resolutions:
+            outputs[resolution] = open_output(job_id, resolution, workdir)
+        cost = sum(rendition_cost(rendition) for rendition in renditions)
+        with slot_budget.reserve(cost) as slots:
+            print(f"[DEBUG] Ladder for job {job_id} running on {slots} slots")
+            pass_fds = output_fds(outputs.values())
+            if shares_audio(renditions, media):
+                audio_process, audio_fd = start_audio_pipe(input_path, renditions[0]['audio_args'])
+                pass_fds.append(audio_fd)
+            cmd = build_ladder_command(
+                input_path,
+                [(rendition, output_target(outputs[rendition['resolution']])) for rendition in renditions],
+                slots,
+                PROGRESSIVE_OUTPUT_FLAGS if PROGRESSIVE_UPLOAD else (),
+                audio_input=f"pipe:{audio_fd}" if audio_process else None
+            )
+            encode_started = time.monotonic()
+            run_ffmpeg(cmd, duration, on_progress, pass_fds=pass_fds)
+            encode_seconds = time.monotonic() - encode_started
+        if audio_process:
+            os.close(audio_fd)
+            audio_fd = None
+            # A failed audio encode just ends the audio early, so check it before storing
+            if audio_process.wait() != 0:
+                raise Exception(f"Audio encode failed: {audio_process.stderr.read().decode()[-2000:]}")
+    except Exception as e:
+        for output in outputs.values():
+            discard_output(output)
+        if audio_process:
+            if audio_fd is not None:
+                os.close(audio_fd)
+            audio_process.kill()
+            audio_process.wait()
+
+        print(f"Error processing ladder for job {job_id}: {str(e)}")
+        return {
+            resolution: {"status": "failed", "progress": 0, "error": str(e)}
+            for resolution in resolutions
+        }
+
+    def finish(resolution):
         try:
-            duration = float(subprocess.check_output(duration_cmd, stderr=subprocess.PIPE).decode().strip())
-            print(f"[DEBUG] Video duration: {duration} seconds")
-        except subprocess.CalledProcessError as e:
-            print(f"[ERROR] Failed to get video duration: {e.stderr.decode()}")
-            raise Exception("Failed to get video duration")
-        
-        # Get input resolution
-        probe_cmd = [
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height',
-            '-of', 'csv=p=0', input_path
-        ]
-        result = subprocess.run(probe_cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"[ERROR] Failed to probe video: {result.stderr}")
-            raise Exception(f"Failed to probe video: {result.stderr}")
-            
-        input_width, input_height = map(int, result.stdout.strip().split(','))
-        print(f"[DEBUG] Input resolution: {input_width}x{input_height}")
-        print(f"[DEBUG] Target resolution: {target_res.width}x{target_res.height}")
-
-        # Start conversion
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-c:v', 'libx264', '-crf', '23',
-            '-preset', 'medium',
-            '-vf', f'scale={target_res.width}:{target_res.height}',
-            '-c:a', 'aac',
-            '-progress', 'pipe:1',
-            '-loglevel', 'warning',
-            '-stats',
-            '-y', temp_output_path
-        ]
-        
-        print(f"[DEBUG] Running FFmpeg command: {' '.join(cmd)}")
+            upload_started = time.monotonic()
+            result = finish_output(job_id, resolution, outputs[resolution])
+            result['timings'] = rendition_timings(
+                resolution, media['duration'], encode_seconds, time.monotonic() - upload_started
+            )
+            # Record each finished rendition right away so a restart does not redo it
+            update_job_status(job_id, resolution, result)
+            return result
+        except Exception as e:
+            discard_output(outputs[resolution])
+            print(f"Error uploading {resolution} for job {job_id}: {str(e)}")
+            return {"status": "failed", "progress": 0, "error": str(e)}
+
+    # Renditions are stored concurrently rather than one after another
+    with ThreadPoolExecutor(max_workers=min(UPLOAD_THREADS, len(resolutions))) as executor:
+        return dict(zip(resolutions, executor.map(finish, resolutions)))
+
+def packaged_output(job_id: str, resolution: str) -> dict:
+    print(f"Successfully packaged {resolution} for job {job_id}")
+    return {"status": "completed", "progress": 100}
+
+def build_package_command(input_path: str, renditions: list, slots: int, has_audio: bool, output_dir: str) -> list:
+    """Build one ffmpeg command that encodes every rendition into a single adaptive package.
+
+    Like `build_ladder_command`, the input is decoded once and split, but all
+    renditions go to one dash output together with a single audio stream,
+    encoded with the first rendition's audio settings.
+    """
+    costs = [rendition_cost(rendition) for rendition in renditions]
+    labels = [f"s{i}" for i in range(len(renditions))]
+    filters = [f"[0:v]split={len(renditions)}" + ''.join(f"[{label}]" for label in labels)]
+    for i, rendition in enumerate(renditions):
+        filters.append(f"[s{i}]{video_filter(rendition)}[v{i}]")
+
+    cmd = ['ffmpeg'] + input_args(input_path) + [
+        '-filter_complex', ';'.join(filters),
+        '-progress', 'pipe:1',
+        '-loglevel', 'warning',
+        '-nostats'
+    ]
+    for i in range(len(renditions)):
+        cmd += ['-map', f'[v{i}]']
+    if has_audio:
+        cmd += ['-map', '0:a:0', *renditions[0]['audio_args']]
+    cmd += keyframe_args()
+    # Every rendition has its own encoder settings within the one output
+    for i, rendition in enumerate(renditions):
+        threads = max(1, slots * costs[i] // sum(costs))
+        cmd += stream_args(rendition['video_args'] + ['-threads', str(threads)], i)
+    return cmd + package_args(has_audio, output_dir)
+
+def process_package_in_worker(job_id: str, input_path: str, renditions: list, media: dict, workdir: str) -> dict:
+    """Encode all renditions of an adaptive streaming job in one pass and upload the package.
+
+    The package is all or nothing: every rendition shares its manifests, so
+    they all complete or fail together.
+    """
+    resolutions = [rendition['resolution'] for rendition in renditions]
+    output_dir = os.path.join(workdir, 'package')
+    try:
+        print(f"[DEBUG] Starting package for job {job_id}, resolutions {resolutions}")
+
+        if not is_remote(input_path) and not os.path.exists(input_path):
+            raise FileNotFoundError(f"Input file not found: {input_path}")
+
+        def on_progress(progress, stats):
+            update_job_statuses(job_id, {
+                resolution: {"status": "processing", "progress": progress, "encode": stats}
+                for resolution in resolutions
+            })
+
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+        cost = sum(rendition_cost(rendition) for rendition in renditions)
+        with slot_budget.reserve(cost) as slots:
+            cmd = build_package_command(input_path, renditions, slots, media.get('has_audio', False), output_dir)
+            encode_started = time.monotonic()
+            run_ffmpeg(cmd, media['duration'], on_progress)
+            encode_seconds = time.monotonic() - encode_started
+        upload_started = time.monotonic()
+        upload_package(bucket, output_dir, package_prefix(job_id))
+        upload_seconds = time.monotonic() - upload_started
+        results = {resolution: packaged_output(job_id, resolution) for resolution in resolutions}
+        for resolution, result in results.items():
+            result['timings'] = rendition_timings(resolution, media['duration'], encode_seconds, upload_seconds)
+        return results
+    except Exception as e:
+        print(f"Error packaging job {job_id}: {str(e)}")
+        return {
+            resolution: {"status": "failed", "progress": 0, "error": str(e)}
+            for resolution in resolutions
+        }
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def process_video_in_worker(job_id: str, input_path: str, rendition: dict, media: dict, workdir: str,
+                            audio_path: str = None) -> dict:
+    """Transcode one rendition; with `audio_path` its already encoded audio is muxed in."""
+    resolution = rendition['resolution']
+    try:
+        print(f"[DEBUG] Starting processing for job {job_id}, resolution {resolution}")
         
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=1
-        )
+        # Check if input file exists
+        if not is_remote(input_path) and not os.path.exists(input_path):
+            raise FileNotFoundError(f"Input file not found: {input_path}")
         
-        # Monitor progress
-        time_processed = 0
-        last_progress_time = time.time()
-        progress_update_interval = 2  # Update progress every 2 seconds
-
-        while True:
-            stdout_line = process.stdout.readline()
-            if stdout_line:
-                print(f"[FFMPEG] {stdout_line.strip()}")
-                if stdout_line.startswith('out_time='):
-                    time_str = stdout_line.split('=')[1].strip()
-                    if ':' in time_str:
-                        h, m, s = time_str.split(':')
-                        time_processed = float(h) * 3600 + float(m) * 60 + float(s)
-                        current_time = time.time()
-                        if current_time - last_progress_time >= progress_update_interval:
-                            progress = min(98, (time_processed / duration) * 100)
-                            print(f"[DEBUG] Progress: {progress:.2f}%")
-                            update_job_status(job_id, resolution, {
-                                "status": "processing",
-                                "progress": progress
-                            })
-                            last_progress_time = current_time
-
-            stderr_line = process.stderr.readline()
-            if stderr_line:
-                print(f"[FFMPEG ERROR] {stderr_line.strip()}")
-
-            if process.poll() is not None:
-                for line in process.stdout.readlines():
-                    print(f"[FFMPEG] {line.strip()}")
-                for line in process.stderr.readlines():
-                    print(f"[FFMPEG ERROR] {line.strip()}")
-                break
-
-            time.sleep(0.1)
-
-        if process.returncode == 0:
-            if os.path.exists(temp_output_path):
-                output_blob = bucket.blob(f"processed/{job_id}/{resolution}.mp4")
-                output_blob.upload_from_filename(temp_output_path)
-                
-                output_blob.metadata = {'auto-delete': 'true'}
-                output_blob.update()
-                
-                signed_url = output_blob.generate_signed_url(
-                    version="v4",
-                    expiration=timedelta(minutes=5),
-                    method="GET"
-                )
-                
-                os.remove(temp_output_path)
-                
-                result = {
-                    "status": "completed",
-                    "progress": 100,
-                    "output_url": signed_url
-                }
-                print(f"Successfully processed {resolution} for job {job_id}")
-                return result
+        duration = media['duration']
+        print(f"[DEBUG] Input resolution: {media['width']}x{media['height']}")
+        print(f"[DEBUG] Target resolution: {rendition['width']}x{rendition['height']}")
+
+        output = open_output(job_id, resolution, workdir)
+        print(f"[DEBUG] Output: {output_target(output)}")
+
+        with slot_budget.reserve(rendition_cost(rendition)) as slots:
+            # Start conversion
+            if audio_path:
+                audio = ['-i', audio_path, '-map', '0:v:0', '-map', '1:a', '-c:a', 'copy']
             else:
-                raise Exception("Output file not created")
-        else:
-            stderr = process.stderr.read()
-            raise Exception(f"FFmpeg failed: {stderr}")
+                audio = rendition['audio_args']
+            cmd = ['ffmpeg'] + input_args(input_path) + [
+                *audio,
+                *rendition['video_args'],
+                '-threads', str(slots),
+                '-vf', video_filter(rendition),
+                '-progress', 'pipe:1',
+                '-loglevel', 'warning',
+                '-nostats',
+                *(PROGRESSIVE_OUTPUT_FLAGS if PROGRESSIVE_UPLOAD else ()),
+                '-y', output_target(output)
+            ]
+            
+            encode_started = time.monotonic()
+            run_ffmpeg(cmd, duration, lambda progress, stats: update_job_status(job_id, resolution, {
+                "status": "processing",
+                "progress": progress,
+                "encode": stats
+            }), pass_fds=output_fds([output]))
+            encode_seconds = time.monotonic() - encode_started
+
+        upload_started = time.monotonic()
+        result = finish_output(job_id, resolution, output)
+        result['timings'] = rendition_timings(resolution, duration, encode_seconds, time.monotonic() - upload_started)
+        # Record the finished rendition right away so a restart does not redo it
+        update_job_status(job_id, resolution, result)
+        return result
 
     except Exception as e:
-        if 'temp_output_path' in locals() and os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
+        if 'output' in locals():
+            discard_output(output)
             
         print(f"Error processing {resolution} for job {job_id}: {str(e)}")
         return {
@@ -245,163 +442,812 @@ def process_video_in_worker(job_id: str, input_path: str, resolution: str) -> di
             "error": str(e)
         }
 
-def handle_job(job_id: str):
+def segment_prefix(job_id: str, run: str) -> str:
+    return f"segments/{job_id}/{run}"
+
+def delete_prefix(prefix: str):
+    blobs = list(bucket.list_blobs(prefix=prefix))
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        list(executor.map(lambda blob: blob.delete(), blobs))
+
+def split_source(source: str, workdir: str) -> list:
+    """Cut the video stream of `source` into segments without re-encoding.
+
+    Stream copy can only cut on keyframes, so every segment starts with one
+    and can be encoded on its own. Returns a list of (path, duration).
+    """
+    segment_list = os.path.join(workdir, 'segments.csv')
+    cmd = ['ffmpeg'] + input_args(source) + [
+        '-map', '0:v:0', '-c', 'copy', '-an', '-sn', '-dn',
+        '-f', 'segment',
+        '-segment_time', str(SEGMENT_SECONDS),
+        '-segment_format', 'matroska',
+        '-segment_list', segment_list,
+        '-segment_list_type', 'csv',
+        '-reset_timestamps', '1',
+        '-loglevel', 'error',
+        '-y', os.path.join(workdir, 'src_%04d.mkv')
+    ]
+    print(f"[DEBUG] Splitting input: {' '.join(cmd)}")
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Failed to split input: {result.stderr[-2000:]}")
+
+    segments = []
+    with open(segment_list) as f:
+        for line in f:
+            name, start, end = line.strip().rsplit(',', 2)
+            segments.append((os.path.join(workdir, name), float(end) - float(start)))
+    return segments
+
+def encode_audio(source: str, path: str, audio_args: list):
+    """Encode the audio of `source` once, to be muxed into every rendition."""
+    cmd = ['ffmpeg'] + input_args(source) + [
+        '-map', '0:a:0', '-vn', *audio_args, '-loglevel', 'error', '-y', path
+    ]
+    with slot_budget.reserve(1):
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Failed to encode audio: {result.stderr[-2000:]}")
+
+def segment_audio(source: str, path: str, audio_args: list, prefix: str, resumed: bool):
+    """Encode a segmented job's audio, keeping a copy with its segments for a resumed run."""
+    blob = bucket.blob(f"{prefix}/audio.m4a")
+    if resumed and blob.exists():
+        blob.download_to_filename(path)
+        return
+    encode_audio(source, path, audio_args)
+    blob.upload_from_filename(path)
+
+def requeue_lost_segments(job_id: str, run: str) -> int:
+    """Queue again the segments of a resumed run that no live worker holds."""
+    lost = orphaned_segments(redis_client, job_id, run, segment_states(redis_client, job_id))
+    for index in lost:
+        if not requeue_segment(redis_client, job_id, run, index):
+            raise Exception(f"Segment {index} was interrupted too many times")
+    return len(lost)
+
+def discard_segment_runs(job_id: str):
+    """Delete whatever earlier attempts of a job left of their segmented runs."""
+    delete_segments(redis_client, job_id)
+    delete_prefix(f"segments/{job_id}/")
+
+def wait_for_segments(job_id: str, run: str, resolutions: list, total_duration: float):
+    """Wait for every segment of a job, rolling their progress up into its conversions.
+
+    Segments that are neither queued nor leased on two checks in a row (the
+    worker encoding them died) are queued again. Raises if a segment fails
+    or is lost too many times.
+    """
+    suspects = set()
+    last_progress = None
+    while True:
+        segments = segment_states(redis_client, job_id)
+        if not segments:
+            raise Exception("Segment state was removed while waiting for the segments")
+        failed = [segment for segment in segments.values() if segment.get('status') == 'failed']
+        if failed:
+            raise Exception(f"Segment encode failed: {failed[0].get('error')}")
+
+        encoded = sum(segment['duration'] * segment['progress'] / 100 for segment in segments.values())
+        # The last few percent are left for stitching the segments together
+        progress = min(95, encoded / total_duration * 95) if total_duration else 0
+        if progress != last_progress:
+            update_job_statuses(job_id, {
+                resolution: {"status": "processing", "progress": progress} for resolution in resolutions
+            })
+            last_progress = progress
+
+        if all(segment.get('status') == 'done' for segment in segments.values()):
+            return
+
+        orphans = set(orphaned_segments(redis_client, job_id, run, segments))
+        for index in orphans & suspects:
+            if not requeue_segment(redis_client, job_id, run, index):
+                raise Exception(f"Segment {index} was interrupted too many times")
+            print(f"[WARNING] Requeued segment {index} of job {job_id}")
+        suspects = orphans - suspects
+        time.sleep(SEGMENT_POLL_INTERVAL)
+
+def concat_rendition(job_id: str, resolution: str, prefix: str, count: int,
+                     audio_path: str, workdir: str, duration: float) -> dict:
+    """Stitch a rendition's encoded segments together, without re-encoding, and store it."""
+    parts = [os.path.join(workdir, f"{resolution}_{index:04d}.mp4") for index in range(count)]
+    for index, path in enumerate(parts):
+        bucket.blob(f"{prefix}/{resolution}/{index:04d}.mp4").download_to_filename(path)
+    concat_list = os.path.join(workdir, f"{resolution}.txt")
+    with open(concat_list, 'w') as f:
+        f.writelines(f"file '{path}'\n" for path in parts)
+
+    output = open_output(job_id, resolution, workdir)
+    try:
+        cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', concat_list]
+        if audio_path:
+            cmd += ['-i', audio_path, '-map', '0:v', '-map', '1:a']
+        cmd += [
+            '-c', 'copy',
+            '-progress', 'pipe:1',
+            '-loglevel', 'warning',
+            *(PROGRESSIVE_OUTPUT_FLAGS if PROGRESSIVE_UPLOAD else ()),
+            '-y', output_target(output)
+        ]
+        run_ffmpeg(cmd, duration, lambda progress, stats: None, pass_fds=output_fds([output]))
+        result = finish_output(job_id, resolution, output)
+    except Exception:
+        discard_output(output)
+        raise
+    finally:
+        for path in parts:
+            if os.path.exists(path):
+                os.remove(path)
+    update_job_status(job_id, resolution, result)
+    return result
+
+def package_renditions(job_id: str, resolutions: list, prefix: str, count: int,
+                       audio_path: str, workdir: str, duration: float) -> dict:
+    """Package the encoded segments of every rendition, without re-encoding, and store them."""
+    package_dir = os.path.join(workdir, 'package')
+    os.makedirs(package_dir, exist_ok=True)
+    cmd = ['ffmpeg']
+    for resolution in resolutions:
+        concat_list = os.path.join(workdir, f"{resolution}.txt")
+        with open(concat_list, 'w') as f:
+            for index in range(count):
+                path = os.path.join(workdir, f"{resolution}_{index:04d}.mp4")
+                bucket.blob(f"{prefix}/{resolution}/{index:04d}.mp4").download_to_filename(path)
+                f.write(f"file '{path}'\n")
+        cmd += ['-f', 'concat', '-safe', '0', '-i', concat_list]
+    if audio_path:
+        cmd += ['-i', audio_path]
+    for i in range(len(resolutions)):
+        cmd += ['-map', f'{i}:v']
+    if audio_path:
+        cmd += ['-map', f'{len(resolutions)}:a']
+    cmd += ['-c', 'copy', '-progress', 'pipe:1', '-loglevel', 'warning']
+    run_ffmpeg(cmd + package_args(bool(audio_path), package_dir), duration, lambda progress, stats: None)
+    upload_package(bucket, package_dir, package_prefix(job_id))
+    return {resolution: packaged_output(job_id, resolution) for resolution in resolutions}
+
+def process_segmented(job_id: str, source: str, renditions: list, media: dict, workdir: str,
+                      output_format: str = "mp4", timings: Optional[JobTimings] = None) -> dict:
+    """Encode a long input as keyframe-aligned segments spread over all workers.
+
+    The input's video is split by stream copy and the segments are queued as
+    subtasks; whichever workers pick them up encode every rendition of their
+    segment in one ladder pass. The audio is encoded once here meanwhile.
+    Each rendition is then concatenated from its segments and the audio
+    without re-encoding, or all of them are packaged together for adaptive
+    jobs. If an earlier attempt of the job died part way through, its run
+    is picked up where it stopped: only segments not yet encoded are
+    encoded. Local files go under the job's scratch directory `workdir`.
+    The split, the wait for the segments and the concatenation are timed
+    as stages in `timings`. Returns a dict mapping each resolution to its
+    result.
+    """
+    timings = timings or JobTimings()
+    resolutions = [rendition['resolution'] for rendition in renditions]
+    resumed = resumable_run(redis_client, job_id, renditions, output_format)
+    run, count = resumed or (uuid.uuid4().hex[:8], 0)
+    prefix = segment_prefix(job_id, run)
+    workdir = os.path.join(workdir, 'segments')
+    os.makedirs(workdir, exist_ok=True)
+    audio_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio')
+    try:
+        audio_path = None
+        audio_future = None
+        if media.get('has_audio'):
+            audio_path = os.path.join(workdir, 'audio.m4a')
+            audio_future = audio_executor.submit(
+                segment_audio, source, audio_path, renditions[0]['audio_args'], prefix, bool(resumed)
+            )
+
+        if resumed:
+            requeued = requeue_lost_segments(job_id, run)
+            print(f"[DEBUG] Resuming segmented run {run} of job {job_id}; requeued {requeued} of {count} segments")
+        else:
+            # Runs left for other renditions, or cut short before they were recorded, are of no use
+            discard_segment_runs(job_id)
+            with timings.stage('split'):
+                segments = split_source(source, workdir)
+                count = len(segments)
+                print(f"[DEBUG] Split job {job_id} into {count} segments")
+
+                def upload_segment(index, path):
+                    bucket.blob(f"{prefix}/src/{index:04d}.mkv").upload_from_filename(path)
+                    os.remove(path)
+
+                with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+                    for future in [executor.submit(upload_segment, index, path) for index, (path, _) in enumerate(segments)]:
+                        future.result()
+
+            create_segments(
+                redis_client, job_id, run, renditions, [duration for _, duration in segments], output_format
+            )
+        with timings.stage('segments'):
+            wait_for_segments(job_id, run, resolutions, media['duration'])
+            if audio_future:
+                audio_future.result()
+
+        if output_format == ADAPTIVE:
+            with timings.stage('concat'):
+                return package_renditions(
+                    job_id, resolutions, prefix, count, audio_path, workdir, media['duration']
+                )
+
+        def concat(resolution):
+            try:
+                return concat_rendition(
+                    job_id, resolution, prefix, count, audio_path, workdir, media['duration']
+                )
+            except Exception as e:
+                print(f"Error concatenating {resolution} for job {job_id}: {str(e)}")
+                return {"status": "failed", "progress": 0, "error": str(e)}
+
+        with timings.stage('concat'), ThreadPoolExecutor(max_workers=min(UPLOAD_THREADS, len(resolutions))) as executor:
+            return dict(zip(resolutions, executor.map(concat, resolutions)))
+    except Exception as e:
+        print(f"Error processing segmented job {job_id}: {str(e)}")
+        return {
+            resolution: {"status": "failed", "progress": 0, "error": str(e)}
+            for resolution in resolutions
+        }
+    finally:
+        # The run's state and stored segments are left for the job's next
+        # attempt; they go once the job has finished (see `clean_up_job`)
+        audio_executor.shutdown(wait=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def report_segment_progress(task: str, progress: float):
+    try:
+        set_segment_progress(redis_client, task, progress)
+    except Exception as e:
+        print(f"Error updating segment progress: {str(e)}")
+
+def run_segment(task: str, state: dict):
+    """Encode one segment of a segmented job into every rendition and store the results.
+
+    A segment this worker has no scratch space for within SCRATCH_WAIT
+    goes back to the queue for another worker.
+    """
+    job_id, run, index = parse_segment_task(task)
+    prefix = segment_prefix(job_id, run)
+    renditions = json.loads(state['renditions'])
+    duration = float(state[f"{index}:duration"])
+    workdir = None
+    with running_jobs_lock:
+        running_segments.add(task)
+    try:
+        source_blob = bucket.get_blob(f"{prefix}/src/{index:04d}.mkv")
+        if source_blob is None:
+            raise Exception("Segment source is missing from storage")
+        needed = source_blob.size + sum(rendition_bytes(rendition, {"duration": duration}) for rendition in renditions)
+        workdir = scratch.acquire(f"{job_id}_{run}_{index}", needed)
+        if workdir is None:
+            print(f"[WARNING] No scratch space for segment {index} of job {job_id}; returning it to the queue")
+            return_segment(redis_client, task)
+            SEGMENTS_FINISHED.labels(outcome='returned').inc()
+            return
+
+        print(f"[DEBUG] Encoding segment {index} of job {job_id}")
+        source = os.path.join(workdir, 'src.mkv')
+        source_blob.download_to_filename(source)
+
+        outputs = [(rendition, os.path.join(workdir, f"{rendition['resolution']}.mp4")) for rendition in renditions]
+        cost = sum(rendition_cost(rendition) for rendition in renditions)
+        # A fixed timescale keeps every segment's timestamps compatible for concat
+        output_flags = ['-video_track_timescale', '90000']
+        if state.get('output_format') == ADAPTIVE:
+            output_flags += keyframe_args()
+        with slot_budget.reserve(cost) as slots:
+            cmd = build_ladder_command(source, outputs, slots, output_flags)
+            with SEGMENT_ENCODE_SECONDS.time():
+                run_ffmpeg(cmd, duration, lambda progress, stats: report_segment_progress(task, progress))
+
+        for rendition, path in outputs:
+            bucket.blob(f"{prefix}/{rendition['resolution']}/{index:04d}.mp4").upload_from_filename(path)
+        finish_segment(redis_client, task, 'done')
+        SEGMENTS_FINISHED.labels(outcome='done').inc()
+    except Exception as e:
+        print(f"Error encoding segment {index} of job {job_id}: {str(e)}")
+        SEGMENTS_FINISHED.labels(outcome='failed').inc()
+        try:
+            finish_segment(redis_client, task, 'failed', str(e))
+        except Exception as update_error:
+            print(f"Error updating segment status: {str(update_error)}")
+    finally:
+        with running_jobs_lock:
+            running_segments.discard(task)
+        if workdir:
+            scratch.release(workdir)
+
+def segment_loop(worker_id: str):
+    """Claim and run segment tasks, up to MAX_CONCURRENT_SEGMENTS at a time.
+
+    Segments have their own seats so jobs waiting on their segments can
+    never occupy every seat that could encode them.
+    """
+    blocking_client = get_blocking_client(redis_client)
+    segment_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SEGMENTS, thread_name_prefix='segment')
+    segment_seats = threading.BoundedSemaphore(MAX_CONCURRENT_SEGMENTS)
+    while True:
+        segment_seats.acquire()
+        try:
+            claimed = claim_segment(blocking_client, worker_id)
+            if not claimed:
+                segment_seats.release()
+                continue
+            future = segment_executor.submit(run_segment, *claimed)
+            future.add_done_callback(lambda _: segment_seats.release())
+        except Exception as e:
+            segment_seats.release()
+            print(f"Error in segment loop: {str(e)}")
+            time.sleep(1)
+
+def cache_groups(output_format: str, renditions: list) -> list:
+    """Split renditions into cache entries: one per MP4, one for a whole adaptive package."""
+    if output_format == ADAPTIVE:
+        return [renditions]
+    return [[rendition] for rendition in renditions]
+
+def cache_params(output_format: str, renditions: list) -> dict:
+    params = {
+        "format": output_format,
+        "renditions": [
+            [r['resolution'], r['width'], r['height'], r['fps'], r['video_args'], r['audio_args']]
+            for r in renditions
+        ]
+    }
+    if output_format == ADAPTIVE:
+        params["segment_seconds"] = STREAM_SEGMENT_SECONDS
+    return params
+
+def job_output_files(job_id: str, output_format: str, renditions: list):
+    """Storage prefix and file names of a job's stored outputs for `renditions`."""
+    if output_format == ADAPTIVE:
+        prefix = package_prefix(job_id)
+        return prefix, [blob.name[len(prefix) + 1:] for blob in bucket.list_blobs(prefix=prefix + '/')]
+    return f"processed/{job_id}", [f"{rendition['resolution']}.mp4" for rendition in renditions]
+
+def copy_files(source_prefix: str, target_prefix: str, names: list):
+    """Server-side copies within the bucket; the data never passes through the worker."""
+    def copy(name):
+        bucket.copy_blob(bucket.blob(f"{source_prefix}/{name}"), bucket, f"{target_prefix}/{name}")
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        list(executor.map(copy, names))
+
+def restore_from_cache(job_id: str, content_hash: str, renditions: list, output_format: str) -> dict:
+    """Copy the outputs of earlier jobs on the same content into this job.
+
+    Returns a dict mapping each restored resolution to its result; the
+    others still have to be encoded.
+    """
+    restored = {}
+    for group in cache_groups(output_format, renditions):
+        try:
+            entry = lookup_cache(redis_client, cache_entry_id(content_hash, cache_params(output_format, group)))
+            if not entry:
+                continue
+            prefix, _ = job_output_files(job_id, output_format, group)
+            copy_files(entry['prefix'], prefix, entry['files'])
+        except Exception as e:
+            # An entry evicted while it was being copied is just a miss
+            print(f"[WARNING] Failed to restore cached outputs for job {job_id}: {str(e)}")
+            continue
+        for rendition in group:
+            resolution = rendition['resolution']
+            print(f"[DEBUG] Restored {resolution} for job {job_id} from the transcode cache")
+            if output_format == ADAPTIVE:
+                restored[resolution] = packaged_output(job_id, resolution)
+            else:
+                restored[resolution] = completed_output(job_id, resolution, output_blob(job_id, resolution))
+    return restored
+
+def cache_outputs(job_id: str, content_hash: str, renditions: list, results: dict, output_format: str):
+    """Keep copies of a job's new outputs for later jobs on the same content, then evict old entries."""
+    for group in cache_groups(output_format, renditions):
+        if not all(results[rendition['resolution']]['status'] == 'completed' for rendition in group):
+            continue
+        entry_id = cache_entry_id(content_hash, cache_params(output_format, group))
+        try:
+            prefix, names = job_output_files(job_id, output_format, group)
+            copy_files(prefix, cache_prefix(entry_id), names)
+            store_cache(redis_client, entry_id, names)
+        except Exception as e:
+            print(f"[WARNING] Failed to cache outputs of job {job_id}: {str(e)}")
+
+    try:
+        for prefix in evict_cache(redis_client):
+            print(f"[DEBUG] Evicting {prefix} from the transcode cache")
+            delete_prefix(prefix)
+    except Exception as e:
+        print(f"[WARNING] Failed to evict transcode cache entries: {str(e)}")
+
+def source_passes(renditions: list, media: dict, output_format: str, resumed: bool = False) -> int:
+    """How many ffmpeg processes read a job's source, for the way it is going to be encoded.
+
+    A ladder or package pass reads it once, plus once more for a shared
+    audio encode. Renditions encoded separately each read it. A segmented
+    job splits it, unless resuming a run, and encodes its audio from it.
+    """
+    audio = 1 if shares_audio(renditions, media) else 0
+    if use_segments(media):
+        return (0 if resumed else 1) + (1 if media.get('has_audio') else 0)
+    if output_format == ADAPTIVE or len(renditions) == 1:
+        return 1
+    if LADDER_MODE:
+        return 1 + audio
+    return len(renditions) + audio
+
+def scratch_bytes(renditions: list, media: dict, output_format: str, local_input: bool) -> int:
+    """Most scratch space a job uses at once, for the way it is going to be encoded.
+
+    Progressive MP4 outputs go straight to storage and take none. A
+    segmented job first holds the split copy of its video, then the encoded
+    segments of its renditions, plus their outputs unless uploaded
+    progressively.
+    """
+    audio = audio_bytes(renditions[0]['audio_args'], media['duration']) if media.get('has_audio') else 0
+    outputs = sum(rendition_bytes(rendition, media) + audio for rendition in renditions)
+    needed = input_bytes(media) if local_input else 0
+    if use_segments(media):
+        concat = outputs if PROGRESSIVE_UPLOAD and output_format != ADAPTIVE else 2 * outputs
+        return needed + audio + max(input_bytes(media), concat)
+    if output_format == ADAPTIVE or not PROGRESSIVE_UPLOAD:
+        return needed + outputs + audio
+    if len(renditions) > 1 and not LADDER_MODE:
+        return needed + audio
+    return needed
+
+def handle_job(job_id: str) -> bool:
+    """Run a job to completion or failure.
+
+    Returns False if it was not started for lack of scratch space, in which
+    case the caller hands it back to the queue. The time spent in each stage
+    is stored on the job record as `timings` when it finishes.
+    """
     print(f"Handling job {job_id}")
-    temp_input_path = None
+    workdir = None
+    timings = JobTimings()
+    started = time.monotonic()
     try:
-        job_data = json.loads(redis_client.get(f"job:{job_id}"))
+        job_data = load_job(redis_client, job_id)
         if not job_data:
             raise Exception(f"No data found for job {job_id}")
+        enqueued_at = queued_at(redis_client, job_id)
+        if enqueued_at:
+            timings.add('queue', max(time.time() - enqueued_at, 0))
 
         print(f"Starting job {job_id} with data: {json.dumps(job_data, indent=2)}")
         
-        job_data['status'] = 'processing'
-        redis_client.set(f"job:{job_id}", json.dumps(job_data))
+        set_job_status(redis_client, job_id, 'processing')
         
         input_url = job_data['job_data']['input_url']
-        temp_input_path = os.path.join(TEMP_DIR, f"{job_id}_input.mp4")
-        
-        if input_url.startswith('http'):
+        output_format = job_data['job_data'].get('output_format', 'mp4')
+        # Set for uploads, whose content was hashed on the way in
+        content_hash = job_data['job_data'].get('content_hash') if TRANSCODE_CACHE else None
+        source = input_url
+
+        def fetch_input():
+            path = os.path.join(workdir, 'input.mp4')
             print(f"[DEBUG] Downloading file from URL: {input_url}")
             try:
-                response = requests.get(input_url, stream=True)
-                response.raise_for_status()
-                with open(temp_input_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                print(f"[DEBUG] Successfully downloaded file to: {temp_input_path}")
-                
-                if 'gcs_path' in job_data['job_data']:
-                    try:
-                        source_blob = bucket.blob(job_data['job_data']['gcs_path'])
-                        source_blob.delete()
-                        print(f"[DEBUG] Deleted source file from GCS: {job_data['job_data']['gcs_path']}")
-                    except Exception as e:
-                        print(f"[WARNING] Failed to delete source file from GCS: {str(e)}")
+                download(input_url, path)
+                print(f"[DEBUG] Successfully downloaded file to: {path}")
             except Exception as e:
                 print(f"[ERROR] Failed to download file: {str(e)}")
                 raise
-        else:
-            temp_input_path = input_url
+            return path
         
-        resolutions = job_data['job_data']['resolutions']
-        process_params = [(job_id, temp_input_path, resolution) for resolution in resolutions]
+        # ffmpeg reads remote inputs directly, so encoding starts while the
+        # file is still arriving, unless it would have to seek to decode it
+        # Probe once per input; every rendition reuses the result. Remote
+        # inputs are probed in place, so the scratch space for a local copy
+        # is known before the copy is made.
+        with timings.stage('probe'):
+            local_input = is_remote(input_url) and (INPUT_MODE != 'stream' or needs_local_copy(input_url))
+            if is_remote(input_url) and not local_input:
+                print(f"[DEBUG] Streaming input for job {job_id} from its URL")
+            media = get_media_info(
+                source, redis_client, cache_key=f"content:{content_hash}" if content_hash else None
+            )
+        update_job(redis_client, job_id, media=media)
         
-        n_processes = min(len(resolutions), max(cpu_count() // 2, 1))
-        print(f"Processing {len(resolutions)} resolutions using {n_processes} processes")
+        # Plan renditions against the source before any encoding starts
+        renditions, skipped = plan_renditions(job_data['job_data']['resolutions'], media)
+        apply_profile(renditions, get_profile(job_data['job_data'].get('profile')), media)
+        plan_updates = {}
+        for resolution, reason in skipped.items():
+            print(f"[DEBUG] Skipping {resolution} for job {job_id}: {reason}")
+            plan_updates[resolution] = {"resolution": resolution, "status": "skipped", "progress": 0, "reason": reason}
+            RENDITIONS_FINISHED.labels(resolution=resolution, outcome='skipped').inc()
+        for rendition in renditions:
+            plan_updates[rendition['resolution']] = {"width": rendition['width'], "height": rendition['height']}
+        update_job_statuses(job_id, plan_updates)
+
+        if not renditions:
+            raise Exception(f"No renditions can be produced from a {media['width']}x{media['height']} source")
+
+        # Renditions finished by an earlier, interrupted attempt are kept as they are
+        completed = [
+            rendition['resolution'] for rendition in renditions
+            if job_data['conversions'][rendition['resolution']].get('status') == 'completed'
+        ]
+        # An adaptive package covers every rendition, so it is made again as a whole
+        if output_format == ADAPTIVE and len(completed) < len(renditions):
+            completed = []
+        # ... and only trusted while their outputs are still in storage
+        if completed:
+            stored = stored_outputs(job_id, output_format, completed)
+            if len(stored) < len(completed):
+                print(f"[WARNING] Job {job_id} is missing the outputs of {sorted(set(completed) - set(stored))}; encoding them again")
+            completed = stored
+        if completed:
+            print(f"[DEBUG] Job {job_id} already has {completed}; encoding the rest")
+        renditions = [rendition for rendition in renditions if rendition['resolution'] not in completed]
+
+        # The same video uploaded before may already have these renditions
+        if content_hash and renditions:
+            with timings.stage('cache_restore'):
+                restored = restore_from_cache(job_id, content_hash, renditions, output_format)
+            if restored:
+                update_job_statuses(job_id, restored)
+                for resolution in restored:
+                    RENDITIONS_FINISHED.labels(resolution=resolution, outcome='cached').inc()
+                renditions = [rendition for rendition in renditions if rendition['resolution'] not in restored]
+        resolutions = [rendition['resolution'] for rendition in renditions]
+
+        # Every ffmpeg reading a streamed input fetches all of it again
+        if is_remote(source) and not local_input and renditions:
+            resumed = use_segments(media) and resumable_run(redis_client, job_id, renditions, output_format)
+            if source_passes(renditions, media, output_format, bool(resumed)) > 1:
+                print(f"[DEBUG] Job {job_id} reads its input more than once; fetching a local copy")
+                local_input = True
+
+        if renditions:
+            # Reserved up front, so jobs wait for space instead of filling the disk mid-encode
+            with timings.stage('scratch_wait'):
+                workdir = scratch.acquire(job_id, scratch_bytes(renditions, media, output_format, local_input))
+            if workdir is None:
+                print(f"[WARNING] No scratch space for job {job_id} within {SCRATCH_WAIT:g}s; handing it back to the queue")
+                set_job_status(redis_client, job_id, 'pending')
+                JOBS_FINISHED.labels(outcome='deferred').inc()
+                return False
+            if local_input:
+                with timings.stage('download'):
+                    source = fetch_input()
         
-        with Pool(processes=n_processes) as pool:
-            results = pool.starmap(process_video_in_worker, process_params)
+        encode_started = time.monotonic()
+        if not renditions:
+            results = []
+        elif use_segments(media):
+            print(f"Processing {len(renditions)} resolutions as segments across workers")
+            segment_results = process_segmented(job_id, source, renditions, media, workdir, output_format, timings)
+            results = [segment_results[resolution] for resolution in resolutions]
+        elif output_format == ADAPTIVE:
+            print(f"Packaging {len(renditions)} resolutions for adaptive streaming")
+            package_results = process_package_in_worker(job_id, source, renditions, media, workdir)
+            results = [package_results[resolution] for resolution in resolutions]
+        elif LADDER_MODE and len(renditions) > 1:
+            print(f"Processing {len(renditions)} resolutions in a single ladder pass")
+            ladder_results = process_ladder_in_worker(job_id, source, renditions, media, workdir)
+            results = [ladder_results[resolution] for resolution in resolutions]
+        else:
+            # Each rendition waits for its own share of the worker's CPU slots
+            print(f"Processing {len(renditions)} resolutions on the shared slot budget")
+            shared_audio = None
+            if len(renditions) > 1 and shares_audio(renditions, media):
+                audio_path = os.path.join(workdir, 'audio.mka')
+                try:
+                    encode_audio(source, audio_path, renditions[0]['audio_args'])
+                    shared_audio = audio_path
+                except Exception as e:
+                    print(f"[WARNING] Shared audio encode failed, encoding it per rendition: {str(e)}")
+            futures = [
+                rendition_executor.submit(
+                    process_video_in_worker, job_id, source, rendition, media, workdir, shared_audio
+                )
+                for rendition in renditions
+            ]
+            results = [future.result() for future in futures]
         
-        all_completed = True
-        for resolution, result in zip(resolutions, results):
-            job_data['conversions'][resolution].update(result)
-            if result['status'] != 'completed':
-                all_completed = False
-            
-            redis_client.set(f"job:{job_id}", json.dumps(job_data))
-            print(f"Updated status for resolution {resolution}")
+        all_completed = all(result['status'] == 'completed' for result in results)
+        # Segmented jobs are encoded by several workers, so their speed is not one seat's
+        if results and all_completed and not use_segments(media):
+            record_encode_speed(redis_client, media['duration'] * len(results), time.monotonic() - encode_started)
+        if results:
+            timings.add('transcode', time.monotonic() - encode_started)
+            update_job_statuses(job_id, dict(zip(resolutions, results)))
+            for resolution, result in zip(resolutions, results):
+                RENDITIONS_FINISHED.labels(resolution=resolution, outcome=result['status']).inc()
+            if content_hash:
+                with timings.stage('cache_store'):
+                    cache_outputs(job_id, content_hash, renditions, dict(zip(resolutions, results)), output_format)
         
-        job_data['status'] = 'completed' if all_completed else 'failed'
-        job_data['completed_at'] = datetime.now().isoformat()
-        redis_client.set(f"job:{job_id}", json.dumps(job_data))
-        print(f"Completed job {job_id} with status: {job_data['status']}")
+        status = 'completed' if all_completed else 'failed'
+        timings.add('total', time.monotonic() - started)
+        set_job_status(redis_client, job_id, status, completed_at=datetime.now().isoformat(), timings=timings.stages)
+        JOBS_FINISHED.labels(outcome=status).inc()
+        print(f"Completed job {job_id} with status: {status}")
         
     except Exception as e:
         print(f"Error handling job {job_id}: {str(e)}")
-        try:
-            job_data = redis_client.get(f"job:{job_id}")
-            if job_data:
-                job_info = json.loads(job_data)
-                job_info['status'] = 'failed'
-                job_info['error'] = str(e)
-                redis_client.set(f"job:{job_id}", json.dumps(job_info))
-        except Exception as update_error:
-            print(f"Error updating failed job status: {str(update_error)}")
+        timings.add('total', time.monotonic() - started)
+        mark_job_failed(job_id, str(e), timings=timings.stages)
+        JOBS_FINISHED.labels(outcome='failed').inc()
     finally:
-        if temp_input_path and os.path.exists(temp_input_path):
-            try:
-                os.remove(temp_input_path)
-                print(f"[DEBUG] Cleaned up input file: {temp_input_path}")
-            except Exception as e:
-                print(f"[WARNING] Failed to clean up input file: {str(e)}")
+        if workdir:
+            scratch.release(workdir)
+            print(f"[DEBUG] Cleaned up scratch files of job {job_id}")
+    return True
+
+def clean_up_job(job_id: str):
+    """Delete what a finished job kept for another attempt: its segmented runs and its uploaded source.
+
+    Only for jobs that have completed or failed for good. An attempt that is
+    interrupted, or whose job another worker has taken over, leaves both for
+    the attempt after it.
+    """
+    try:
+        discard_segment_runs(job_id)
+    except Exception as e:
+        print(f"[WARNING] Failed to clean up segments of job {job_id}: {str(e)}")
+    job = load_job(redis_client, job_id)
+    gcs_path = job['job_data'].get('gcs_path') if job else None
+    if gcs_path:
+        try:
+            bucket.blob(gcs_path).delete()
+            print(f"[DEBUG] Deleted source file from GCS: {gcs_path}")
+        except NotFound:
+            pass
+        except Exception as e:
+            print(f"[WARNING] Failed to delete source file from GCS: {str(e)}")
+
+def mark_job_failed(job_id: str, error: str, **fields):
+    try:
+        set_job_status(redis_client, job_id, 'failed', error=error, **fields)
+    except Exception as update_error:
+        print(f"Error updating failed job status: {str(update_error)}")
+
+def run_job(worker_id: str, job_id: str):
+    with running_jobs_lock:
+        running_jobs.add(job_id)
+    deferred = False
+    try:
+        deferred = not handle_job(job_id)
         
-        redis_client.srem("active_jobs", job_id)
-        print(f"Removed job {job_id} from active jobs")
+        job_info = None if deferred else load_job(redis_client, job_id)
+        if job_info:
+            print(f"Job completed. Final status: {json.dumps(job_info, indent=2)}")
+        elif not deferred:
+            print(f"Warning: No data found for completed job {job_id}")
+    except Exception as e:
+        print(f"Error processing job {job_id}: {str(e)}")
+        mark_job_failed(job_id, str(e))
+    finally:
+        with running_jobs_lock:
+            running_jobs.discard(job_id)
+        if deferred:
+            if defer_job(redis_client, worker_id, job_id):
+                print(f"Handed job {job_id} back to the queue")
+            else:
+                print(f"[WARNING] Job {job_id} was taken over by another worker after its lease expired")
+        elif ack_job(redis_client, worker_id, job_id):
+            print(f"Removed job {job_id} from active jobs")
+            clean_up_job(job_id)
+        else:
+            print(f"[WARNING] Job {job_id} was taken over by another worker after its lease expired")
+
+def record_worker_gauges():
+    """Sample this worker's slots, running work and scratch space into its metrics."""
+    SLOTS_TOTAL.set(slot_budget.total)
+    SLOTS_IN_USE.set(slot_budget.in_use)
+    with running_jobs_lock:
+        RUNNING_JOBS.set(len(running_jobs))
+        RUNNING_SEGMENTS.set(len(running_segments))
+    for area, usage in scratch.usage().items():
+        SCRATCH_QUOTA.labels(area=area).set(usage['quota'])
+        SCRATCH_RESERVED.labels(area=area).set(usage['reserved'])
+
+def heartbeat(worker_id: str):
+    """Renew the leases of running jobs and segments, and requeue jobs whose worker died.
+
+    Also keeps this worker's seats counted in the capacity the API admits jobs against.
+    """
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        try:
+            register_worker(redis_client, worker_id)
+            record_worker_gauges()
+            with running_jobs_lock:
+                jobs = list(running_jobs)
+                segments = list(running_segments)
+            if segments:
+                for task in renew_segment_leases(redis_client, worker_id, segments):
+                    print(f"[WARNING] Lost lease on segment {task}; it may be encoded elsewhere")
+            if jobs:
+                for job_id in renew_leases(redis_client, worker_id, jobs):
+                    print(f"[WARNING] Lost lease on job {job_id}; it may be requeued")
+            
+            for job_id in reap_expired_jobs(redis_client):
+                mark_job_failed(job_id, "Job was interrupted too many times")
+                clean_up_job(job_id)
+        except Exception as e:
+            print(f"Error in heartbeat: {str(e)}")
 
-def start_worker():
-    global redis_client
+def start_worker(role: str = 'worker'):
+    """Run a worker until it is told to stop.
+
+    `role` names the kind of worker process in its id (see `claim_worker_id`).
+    """
+    global redis_client, slot_budget, rendition_executor, scratch
     redis_client = get_redis_client()
+    blocking_client = get_blocking_client(redis_client)
+    worker_id = claim_worker_id(redis_client, role)
+    # Drop this process's live gauges however it exits; a worker started by
+    # an API process exits without running these, so its parent does it
+    atexit.register(process_exited, os.getpid())
+    
+    slot_budget = SlotBudget(WORKER_SLOTS)
+    # Whatever this worker was doing before a restart starts over, and
+    # workers that have died will not come back for their files
+    clean_orphans(worker_id, live_workers(redis_client), WORKER_TTL)
+    scratch = Scratch(worker_id)
+    print(f"[DEBUG] Scratch space: {json.dumps(scratch.usage())}")
+    start_exporter()
+    record_worker_gauges()
+    rendition_executor = ThreadPoolExecutor(max_workers=WORKER_SLOTS, thread_name_prefix='rendition')
+    job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix='job')
+    job_seats = threading.BoundedSemaphore(MAX_CONCURRENT_JOBS)
+    
+    def submit_job(job_id: str):
+        future = job_executor.submit(run_job, worker_id, job_id)
+        future.add_done_callback(lambda _: job_seats.release())
     
     def handle_exit(signum, frame):
         print("Shutting down worker...")
+        try:
+            unregister_worker(redis_client, worker_id)
+        except Exception as e:
+            print(f"[WARNING] Failed to unregister worker: {str(e)}")
+        process_exited(os.getpid())
         sys.exit(0)
     
     signal.signal(signal.SIGTERM, handle_exit)
     signal.signal(signal.SIGINT, handle_exit)
     
-    print("Worker started and waiting for jobs...")
+    threading.Thread(target=heartbeat, args=(worker_id,), daemon=True, name='heartbeat').start()
+    threading.Thread(target=segment_loop, args=(worker_id,), daemon=True, name='segments').start()
+    
+    # Jobs queued by a version without the scheduler
+    moved = migrate_legacy_queue(redis_client)
+    if moved:
+        print(f"Moved {moved} jobs from the old job queue into the scheduler")
+    
+    # Finish jobs this worker had claimed before it was restarted
+    for job_id in pending_jobs(redis_client, worker_id):
+        print(f"Resuming job {job_id} from processing list of {worker_id}")
+        job_seats.acquire()
+        submit_job(job_id)
+    
+    register_worker(redis_client, worker_id)
+    print(f"Worker {worker_id} started with {WORKER_SLOTS} slots and {MAX_CONCURRENT_JOBS} job seats, waiting for jobs...")
     
     while True:
+        # Only claim a job once there is a free seat to run it
+        job_seats.acquire()
         try:
-            active_jobs = redis_client.smembers("active_jobs")
-            print(f"Checking active jobs: {active_jobs}")
-            
-            for job_id in active_jobs:
-                try:
-                    job_data = redis_client.get(f"job:{job_id}")
-                    if job_data:
-                        job_info = json.loads(job_data)
-                        if job_info['status'] == 'pending':
-                            print(f"Found pending job in active jobs: {job_id}")
-                            handle_job(job_id)
-                    else:
-                        print(f"Removing stale job {job_id} from active jobs")
-                        redis_client.srem("active_jobs", job_id)
-                except Exception as e:
-                    print(f"Error checking job {job_id}: {str(e)}")
-                    redis_client.srem("active_jobs", job_id)
-            
-            active_count = redis_client.scard("active_jobs")
-            queue_length = redis_client.llen("job_queue")
-            print(f"Active jobs: {active_count}, Queued jobs: {queue_length}")
+            # Blocks inside Redis until a job is queued; no polling while idle
+            job_id = claim_next_job(blocking_client, worker_id)
+            if not job_id:
+                job_seats.release()
+                continue
             
-            if active_count < MAX_CONCURRENT_JOBS:
-                job_id = redis_client.rpop("job_queue")
-                if job_id:
-                    print(f"Starting to process new job: {job_id}")
-                    redis_client.sadd("active_jobs", job_id)
-                    
-                    try:
-                        handle_job(job_id)
-                        
-                        job_data = redis_client.get(f"job:{job_id}")
-                        if job_data:
-                            job_info = json.loads(job_data)
-                            print(f"Job completed. Final status: {json.dumps(job_info, indent=2)}")
-                        else:
-                            print(f"Warning: No data found for completed job {job_id}")
-                    except Exception as e:
-                        print(f"Error processing job {job_id}: {str(e)}")
-                        redis_client.srem("active_jobs", job_id)
-                        
-                        try:
-                            job_data = redis_client.get(f"job:{job_id}")
-                            if job_data:
-                                job_info = json.loads(job_data)
-                                job_info['status'] = 'failed'
-                                job_info['error'] = str(e)
-                                redis_client.set(f"job:{job_id}", json.dumps(job_info))
-                        except Exception as update_error:
-                            print(f"Error updating failed job status: {str(update_error)}")
-                else:
-                    time.sleep(1)
-            else:
-                print(f"Maximum concurrent jobs ({MAX_CONCURRENT_JOBS}) reached")
-                time.sleep(1)
+            print(f"Starting to process new job: {job_id}")
+            submit_job(job_id)
                 
         except Exception as e:
+            job_seats.release()
             print(f"Error in worker loop: {str(e)}")
             print(f"Error details: {str(sys.exc_info())}")
             time.sleep(1)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The service modules import each other as top-level modules, as they do
+# when run from their own directory in the container
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'video_processor'))
@@ -0,0 +1,85 @@
+import time
+
+import fakeredis
+import pytest
+
+import cache
+from cache import (
+    CACHE_INDEX, cache_entry_id, cache_key, cache_prefix, cache_stats_from_results, evict_cache, lookup_cache,
+    queue_cache_stats, store_cache
+)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def store(client, entry_id, age):
+    """Store an entry last used `age` seconds ago."""
+    store_cache(client, entry_id, ["720p.mp4"])
+    client.zadd(CACHE_INDEX, {entry_id: time.time() - age})
+
+
+def test_entry_ids_follow_content_and_params():
+    params = {"format": "mp4", "renditions": [{"resolution": "720p", "video_args": ["-crf", "23"]}]}
+
+    assert cache_entry_id("md5:a", params) == cache_entry_id("md5:a", dict(reversed(list(params.items()))))
+    assert cache_entry_id("md5:a", params) != cache_entry_id("md5:b", params)
+    assert cache_entry_id("md5:a", params) != cache_entry_id("md5:a", dict(params, format="webm"))
+    assert cache_prefix(cache_entry_id("md5:a", params)).startswith("cache/md5/a/")
+
+
+def test_entries_unused_for_the_ttl_are_evicted(client, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_TTL", 3600)
+    store(client, "stale", 7200)
+    store(client, "fresh", 60)
+
+    assert evict_cache(client) == [cache_prefix("stale")]
+    assert not client.exists(cache_key("stale"))
+    assert client.zrange(CACHE_INDEX, 0, -1) == ["fresh"]
+
+
+def test_least_recently_used_entries_beyond_the_limit_are_evicted(client, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_MAX_ENTRIES", 2)
+    for age, entry_id in enumerate(["d", "c", "b", "a"]):
+        store(client, entry_id, age * 10)
+
+    # Using an entry makes it the most recent
+    assert lookup_cache(client, "a")["files"] == ["720p.mp4"]
+
+    assert sorted(evict_cache(client)) == [cache_prefix("b"), cache_prefix("c")]
+    assert sorted(client.zrange(CACHE_INDEX, 0, -1)) == ["a", "d"]
+
+
+def test_evicted_entries_are_handed_out_once(monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_TTL", 3600)
+    server = fakeredis.FakeServer()
+    client, other = (fakeredis.FakeRedis(server=server, decode_responses=True) for _ in range(2))
+    store(client, "stale", 7200)
+    evicted_elsewhere = []
+    zcard = client.zcard
+
+    def evict_elsewhere(key):
+        # Another evictor runs between this one's reads and its removals
+        evicted_elsewhere.extend(evict_cache(other))
+        return zcard(key)
+
+    monkeypatch.setattr(client, "zcard", evict_elsewhere)
+
+    assert evict_cache(client) == []
+    assert evicted_elsewhere == [cache_prefix("stale")]
+
+
+def test_lookups_count_hits_and_misses(client):
+    store(client, "entry", 0)
+
+    assert lookup_cache(client, "missing") is None
+    lookup_cache(client, "entry")
+    lookup_cache(client, "entry")
+
+    pipe = client.pipeline()
+    queue_cache_stats(pipe)
+    assert cache_stats_from_results(*pipe.execute()) == {
+        "entries": 1, "hits": 2, "misses": 1, "hit_rate": pytest.approx(2 / 3)
+    }
@@ -0,0 +1,103 @@
+import fakeredis
+import pytest
+
+import capacity
+from capacity import (
+    WORKER_TTL, admission_delay, capacity_from_snapshot, read_capacity, register_worker, retry_after,
+    take_token
+)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def queue_work(client, priority, queued, work):
+    client.hset(f"job_queue:stats:{priority}", mapping={"queued": queued, "work": work})
+
+
+def test_backlog_counts_the_classes_ahead(client):
+    register_worker(client, "w-0", seats=2)
+    client.set(capacity.ENCODE_SPEED, 2.0)
+    queue_work(client, "high", 1, 400)
+    queue_work(client, "normal", 2, 800)
+
+    snapshot = capacity_from_snapshot(read_capacity(client))
+
+    assert snapshot["job_seats"] == 2
+    assert snapshot["backlog"]["high"] == {"queued_jobs": 1, "backlog_seconds": 100.0}
+    assert snapshot["backlog"]["low"] == {"queued_jobs": 3, "backlog_seconds": 300.0}
+
+
+def test_jobs_are_admitted_while_the_workers_keep_up(client):
+    register_worker(client, "w-0", seats=2)
+    queue_work(client, "normal", 3, 60)
+
+    assert admission_delay(capacity_from_snapshot(read_capacity(client)), "normal") is None
+
+
+def test_no_workers_retries_after_the_worker_ttl(client):
+    queue_work(client, "normal", 3, 60)
+
+    reason, seconds = admission_delay(capacity_from_snapshot(read_capacity(client)), "normal")
+
+    assert "No workers" in reason
+    assert seconds == WORKER_TTL
+
+
+def test_full_queue_retries_once_the_excess_is_worked_off(client, monkeypatch):
+    monkeypatch.setattr(capacity, "MAX_QUEUED_JOBS", 4)
+    register_worker(client, "w-0", seats=1)
+    queue_work(client, "normal", 5, 500)
+
+    reason, seconds = admission_delay(capacity_from_snapshot(read_capacity(client)), "normal")
+
+    assert "5 jobs" in reason
+    assert seconds == pytest.approx(200)
+    # Work queued below a class does not hold it back
+    assert admission_delay(capacity_from_snapshot(read_capacity(client)), "high") is None
+
+
+def test_long_backlog_retries_once_it_is_under_the_limit(client, monkeypatch):
+    monkeypatch.setattr(capacity, "MAX_BACKLOG_SECONDS", 600)
+    register_worker(client, "w-0", seats=1)
+    queue_work(client, "low", 2, 1000)
+
+    reason, seconds = admission_delay(capacity_from_snapshot(read_capacity(client)), "low")
+
+    assert "minutes" in reason
+    assert seconds == pytest.approx(400)
+
+
+def test_unknown_throughput_still_gives_a_retry_time(client, monkeypatch):
+    monkeypatch.setattr(capacity, "DEFAULT_ENCODE_SPEED", 0.0)
+    monkeypatch.setattr(capacity, "MAX_QUEUED_JOBS", 1)
+    register_worker(client, "w-0", seats=1)
+    queue_work(client, "normal", 1, 100)
+    snapshot = capacity_from_snapshot(read_capacity(client))
+    assert snapshot["backlog"]["normal"]["backlog_seconds"] is None
+
+    _, seconds = admission_delay(snapshot, "normal")
+    assert seconds == WORKER_TTL
+    assert admission_delay(snapshot, "high") is None
+    assert retry_after(seconds) == str(WORKER_TTL)
+
+
+def test_token_bucket_allows_a_burst_then_refills(client, monkeypatch):
+    monkeypatch.setattr(capacity, "CLIENT_RATE_LIMIT", 60)
+    monkeypatch.setattr(capacity, "CLIENT_BURST", 3)
+
+    assert [float(take_token(client, "a", now=100)) for _ in range(3)] == [0, 0, 0]
+    assert float(take_token(client, "a", now=100)) == pytest.approx(1)
+    # Other clients have buckets of their own
+    assert float(take_token(client, "b", now=100)) == 0
+    assert float(take_token(client, "a", now=101.5)) == 0
+    assert float(take_token(client, "a", now=101.5)) == pytest.approx(0.5)
+    assert client.ttl(capacity.rate_limit_key("a")) > 0
+
+
+def test_retry_after_is_whole_seconds_and_at_least_one():
+    assert retry_after(0) == "1"
+    assert retry_after(0.2) == "1"
+    assert retry_after(61.1) == "62"
@@ -0,0 +1,190 @@
+import fakeredis
+import pytest
+
+import dispatch
+from dispatch import (
+    ACTIVE_JOBS, JOB_ATTEMPTS, JOB_OWNERS, LEGACY_JOB_QUEUE, QUEUED_JOBS, REAPER_LOCK,
+    ack_job, claim_next_job, defer_job, enqueue_job, lease_key, migrate_legacy_queue,
+    pending_jobs, pick_next_job, processing_key, queue_snapshot, queued_at, reap_expired_jobs,
+    schedule_stats
+)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def drain(client, worker_id="w-0", now=1000.0):
+    picked = []
+    while True:
+        job_id = pick_next_job(client, worker_id, now=now)
+        if not job_id:
+            return picked
+        picked.append(job_id)
+
+
+def expire_lease(client, job_id):
+    client.delete(lease_key(job_id))
+    client.delete(REAPER_LOCK)
+
+
+def test_pick_leases_and_records_the_job(client):
+    assert enqueue_job(client, "j1", now=100.0) == 1
+
+    assert pick_next_job(client, "w-0", now=130.0) == "j1"
+    assert client.lrange(processing_key("w-0"), 0, -1) == ["j1"]
+    assert client.get(lease_key("j1")) == "w-0"
+    assert 0 < client.ttl(lease_key("j1")) <= dispatch.LEASE_TTL
+    assert client.hget(JOB_OWNERS, "j1") == "w-0"
+    assert client.smembers(ACTIVE_JOBS) == {"j1"}
+    assert queued_at(client, "j1") == 100.0
+    assert pick_next_job(client, "w-1", now=130.0) is None
+
+
+def test_ack_releases_only_for_the_owner(client):
+    enqueue_job(client, "j1")
+    pick_next_job(client, "w-0")
+
+    assert not ack_job(client, "w-1", "j1")
+    assert client.smembers(ACTIVE_JOBS) == {"j1"}
+
+    assert ack_job(client, "w-0", "j1")
+    assert client.llen(processing_key("w-0")) == 0
+    assert not client.exists(ACTIVE_JOBS, JOB_OWNERS, lease_key("j1"))
+    assert not client.hexists(QUEUED_JOBS, "j1")
+
+
+def test_defer_returns_the_job_to_its_place(client):
+    for i, job_id in enumerate(["j1", "j2", "j3"]):
+        enqueue_job(client, job_id, now=100.0 + i)
+    assert pick_next_job(client, "w-0") == "j1"
+
+    assert not defer_job(client, "w-1", "j1")
+    assert defer_job(client, "w-0", "j1")
+    assert client.llen(processing_key("w-0")) == 0
+    assert not client.exists(ACTIVE_JOBS, JOB_OWNERS, lease_key("j1"))
+    assert drain(client) == ["j1", "j2", "j3"]
+
+
+def test_expired_lease_is_requeued_then_failed(client, monkeypatch):
+    monkeypatch.setattr(dispatch, "MAX_JOB_ATTEMPTS", 1)
+    enqueue_job(client, "j1")
+    pick_next_job(client, "w-0")
+
+    # A live lease is left alone
+    assert reap_expired_jobs(client) == []
+    assert client.smembers(ACTIVE_JOBS) == {"j1"}
+
+    expire_lease(client, "j1")
+    assert reap_expired_jobs(client) == []
+    assert client.llen(processing_key("w-0")) == 0
+    assert not client.exists(ACTIVE_JOBS, JOB_OWNERS)
+    assert client.hget(JOB_ATTEMPTS, "j1") == "1"
+
+    assert pick_next_job(client, "w-1") == "j1"
+    expire_lease(client, "j1")
+    assert reap_expired_jobs(client) == ["j1"]
+    assert not client.exists(ACTIVE_JOBS, JOB_ATTEMPTS)
+    assert not client.hexists(QUEUED_JOBS, "j1")
+    assert pick_next_job(client, "w-1") is None
+
+
+def test_reaper_runs_once_per_interval(client):
+    enqueue_job(client, "j1")
+    pick_next_job(client, "w-0")
+    reap_expired_jobs(client)
+
+    client.delete(lease_key("j1"))
+    assert reap_expired_jobs(client) == []
+    assert client.smembers(ACTIVE_JOBS) == {"j1"}
+
+
+def test_restarted_worker_resumes_only_jobs_it_still_owns(client):
+    enqueue_job(client, "j1", now=1.0)
+    enqueue_job(client, "j2", now=2.0)
+    pick_next_job(client, "w-0")
+    pick_next_job(client, "w-0")
+    # j2 was requeued while w-0 was down and another worker took it
+    expire_lease(client, "j2")
+    client.delete(lease_key("j1"))
+    client.hset(JOB_OWNERS, "j2", "w-1")
+
+    assert pending_jobs(client, "w-0") == ["j1"]
+    assert client.lrange(processing_key("w-0"), 0, -1) == ["j1"]
+    assert client.get(lease_key("j1")) == "w-0"
+
+
+def test_higher_priority_goes_first(client):
+    enqueue_job(client, "low", priority="low", now=1.0)
+    enqueue_job(client, "normal", priority="normal", now=2.0)
+    enqueue_job(client, "high", priority="high", now=3.0)
+
+    assert drain(client) == ["high", "normal", "low"]
+
+
+def test_clients_share_in_proportion_to_weight(client, monkeypatch):
+    monkeypatch.setitem(dispatch.CLIENT_WEIGHTS, "b", 2)
+    for i in range(6):
+        enqueue_job(client, f"a{i}", client_id="a", work=300, now=float(i))
+        enqueue_job(client, f"b{i}", client_id="b", work=300, now=float(i))
+
+    picked = drain(client)[:6]
+    assert [job[0] for job in picked] == ["a", "b", "b", "a", "b", "b"]
+    # Each client's own jobs stay in submission order
+    assert [job for job in picked if job[0] == "b"] == ["b0", "b1", "b2", "b3"]
+
+
+def test_returning_client_does_not_bank_idle_time(client):
+    for i in range(3):
+        enqueue_job(client, f"a{i}", client_id="a", work=300, now=float(i))
+    pick_next_job(client, "w-0")
+    pick_next_job(client, "w-0")
+
+    # b joins at the class clock rather than at zero, so it alternates with
+    # a instead of taking every turn until its virtual time catches up
+    enqueue_job(client, "b0", client_id="b", work=300, now=10.0)
+    enqueue_job(client, "b1", client_id="b", work=300, now=11.0)
+    assert drain(client) == ["b0", "a2", "b1"]
+
+
+def test_shortest_job_first_within_a_client(client, monkeypatch):
+    monkeypatch.setattr(dispatch, "SHORTEST_JOB_FIRST", True)
+    enqueue_job(client, "long", work=3600, now=0.0)
+    enqueue_job(client, "short", work=60, now=10.0)
+
+    assert drain(client) == ["short", "long"]
+
+
+def test_schedule_stats(client):
+    enqueue_job(client, "a0", client_id="a", now=100.0)
+    enqueue_job(client, "a1", client_id="a", now=101.0)
+    enqueue_job(client, "b0", client_id="b", now=102.0)
+    enqueue_job(client, "h0", priority="high", now=103.0)
+    pick_next_job(client, "w-0", now=113.0)
+
+    stats = schedule_stats(queue_snapshot(client))
+    assert stats["high"] == {"queued": 0, "clients": {}, "dispatched": 1, "mean_wait_seconds": 10.0}
+    assert stats["normal"]["queued"] == 3
+    assert stats["normal"]["clients"] == {"a": ["a0", "a1"], "b": ["b0"]}
+    assert stats["normal"]["mean_wait_seconds"] is None
+    assert stats["low"]["queued"] == 0
+
+
+def test_legacy_queue_is_migrated_oldest_first(client):
+    # The old queue was fed with LPUSH and consumed with BRPOP
+    client.lpush(LEGACY_JOB_QUEUE, "old1", "old2")
+
+    assert migrate_legacy_queue(client) == 2
+    assert not client.exists(LEGACY_JOB_QUEUE)
+    assert drain(client) == ["old1", "old2"]
+
+
+def test_claim_waits_on_the_doorbell(client):
+    assert claim_next_job(client, "w-0", timeout=1) is None
+
+    enqueue_job(client, "j1")
+    assert claim_next_job(client, "w-0", timeout=1) == "j1"
+    # Nothing left queued, so the doorbell is cleared rather than left ringing
+    assert claim_next_job(client, "w-0", timeout=1) is None
+    assert not client.exists(dispatch.DOORBELL)
@@ -0,0 +1,126 @@
+import asyncio
+import json
+
+import fakeredis
+import fakeredis.aioredis
+
+import events
+from events import JobEventHub, apply_delta, decode_delta
+from jobstore import job_channel, load_job, save_job, set_job_status, update_conversions
+
+JOB = {
+    "job_id": "job", "status": "processing", "started_at": "2024-01-01T00:00:00",
+    "conversions": {"720p": {"status": "processing", "progress": 0}, "360p": {"status": "processing", "progress": 0}}
+}
+
+
+def clients():
+    server = fakeredis.FakeServer()
+    return fakeredis.FakeRedis(server=server, decode_responses=True), server
+
+
+def async_client(server):
+    # Made inside asyncio.run, as its locks belong to the running loop
+    return fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+
+
+def test_deltas_fold_into_the_stored_job():
+    client, _ = clients()
+    save_job(client, JOB)
+    job = load_job(client, "job")
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(job_channel("job"))
+    pubsub.get_message(timeout=1)
+
+    update_conversions(client, "job", {"720p": {"progress": 50, "encode": {"fps": 30.0}}})
+    set_job_status(client, "job", "failed", error="boom")
+    for _ in range(2):
+        delta = decode_delta(pubsub.get_message(timeout=1)["data"])
+        apply_delta(job, delta)
+
+    assert job == load_job(client, "job")
+    assert decode_delta(json.dumps({"status": "completed"})) == {"status": "completed"}
+
+
+def test_watchers_of_a_job_share_one_subscription():
+    client, server = clients()
+    save_job(client, JOB)
+
+    async def scenario():
+        redis_client = async_client(server)
+        hub = JobEventHub(redis_client)
+        first = await hub.watch("job")
+        second = await hub.watch("job")
+        other = await hub.watch("other")
+        assert (await redis_client.pubsub_numsub(job_channel("job"))) == [(job_channel("job"), 1)]
+
+        update_conversions(client, "job", {"360p": {"progress": 20}})
+        events_seen = [await asyncio.wait_for(queue.get(), 2) for queue in (first, second)]
+
+        await hub.unwatch("job", first)
+        await hub.unwatch("job", second)
+        await hub.unwatch("job", second)
+        channels = await redis_client.pubsub_numsub(job_channel("job"))
+        empty = other.empty()
+        await hub.close()
+        return events_seen, channels, empty
+
+    events_seen, channels, empty = asyncio.run(scenario())
+
+    for delta, data in events_seen:
+        assert delta == {"progress": 10, "conversions": {"360p": {"progress": 20}}}
+        assert json.loads(data) == delta
+    assert channels == [(job_channel("job"), 0)]
+    assert empty
+
+
+def test_watchers_that_fall_behind_are_told_to_resynchronise(monkeypatch):
+    monkeypatch.setattr(events, "EVENT_BUFFER", 2)
+    _, server = clients()
+
+    async def scenario():
+        hub = JobEventHub(async_client(server))
+        queue = await hub.watch("job")
+        for progress in range(4):
+            hub._dispatch("job", json.dumps({"progress": str(progress)}))
+        hub._dispatch("job", "not json")
+        hub._dispatch("nobody", json.dumps({"progress": "1"}))
+        received = [queue.get_nowait() for _ in range(queue.qsize())]
+        await hub.close()
+        return received
+
+    received = asyncio.run(scenario())
+
+    assert received[0] is None
+    assert [delta for delta, _ in received[1:]] == [{"progress": 3}]
+
+
+def test_closing_stops_a_reader_whose_cancellation_was_lost():
+    class LosingPubSub:
+        """Loses the first cancellation, as a read completing at the same moment can on Python 3.9."""
+
+        lost = False
+
+        async def get_message(self, ignore_subscribe_messages, timeout):
+            try:
+                await asyncio.sleep(timeout)
+            except asyncio.CancelledError:
+                if self.lost:
+                    raise
+                self.lost = True
+            return None
+
+        async def close(self):
+            pass
+
+    _, server = clients()
+
+    async def scenario():
+        hub = JobEventHub(async_client(server))
+        hub.pubsub = LosingPubSub()
+        hub._reader = asyncio.get_running_loop().create_task(hub._read())
+        await asyncio.sleep(0)
+        await asyncio.wait_for(hub.close(), 3)
+        return hub.pubsub.lost, hub._reader.done()
+
+    assert asyncio.run(scenario()) == (True, True)
@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import os
+import tracemalloc
+
+import pytest
+
+from ingest import WRITE_BUFFER_SIZE, UploadError, stream_multipart_upload
+
+BOUNDARY = "----testboundary7MA4YWxkTrZu0gW"
+# Starlette hands request bodies over in pieces of about this size
+RECEIVE_SIZE = 64 * 1024
+BODY_SIZE = 64 * 1024 * 1024
+
+
+class RecordingWriter:
+    """Stand-in for a storage writer that keeps only the size of what it is given."""
+
+    def __init__(self):
+        self.size = 0
+        self.largest_write = 0
+        self.closed = False
+        self.digest = hashlib.md5()
+
+    def write(self, block):
+        self.size += len(block)
+        self.largest_write = max(self.largest_write, len(block))
+        self.digest.update(block)
+
+    def close(self):
+        self.closed = True
+
+
+async def multipart_body(size, complete=True):
+    yield (
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="video"; filename="big.mp4"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+    ).encode()
+    block = os.urandom(RECEIVE_SIZE)
+    sent = 0
+    while sent < size:
+        piece = block[:min(RECEIVE_SIZE, size - sent)]
+        sent += len(piece)
+        yield piece
+    if not complete:
+        return
+    yield (
+        f"\r\n--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="resolutions"\r\n\r\n'
+        '["720p"]\r\n'
+        f"--{BOUNDARY}--\r\n"
+    ).encode()
+
+
+def stream(body, writers, discarded=None):
+    def open_writer(filename, content_type):
+        writers.append(RecordingWriter())
+        return writers[-1]
+
+    return asyncio.run(stream_multipart_upload(
+        f"multipart/form-data; boundary={BOUNDARY}", body, open_writer,
+        discard_writer=discarded.append if discarded is not None else None
+    ))
+
+
+def test_large_upload_is_streamed_in_bounded_blocks():
+    writers = []
+    tracemalloc.start()
+    try:
+        fields, video = stream(multipart_body(BODY_SIZE), writers)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    writer = writers[0]
+    assert fields == {"resolutions": '["720p"]'}
+    assert video["size"] == writer.size == BODY_SIZE
+    assert video["md5"] == writer.digest.hexdigest()
+    assert writer.closed
+    # Never more than one write buffer plus the request chunk that filled it
+    assert writer.largest_write <= WRITE_BUFFER_SIZE + RECEIVE_SIZE
+    assert peak < 4 * (WRITE_BUFFER_SIZE + RECEIVE_SIZE)
+
+
+def test_truncated_upload_is_discarded_not_committed():
+    writers, discarded = [], []
+    with pytest.raises(Exception):
+        stream(multipart_body(4 * RECEIVE_SIZE, complete=False), writers, discarded)
+    assert discarded == writers
+    assert not writers[0].closed
+
+
+def test_second_file_is_refused():
+    async def body():
+        part = (
+            f"--{BOUNDARY}\r\n"
+            'Content-Disposition: form-data; name="video"; filename="a.mp4"\r\n\r\n'
+            "data\r\n"
+        )
+        yield (part * 2 + f"--{BOUNDARY}--\r\n").encode()
+
+    with pytest.raises(UploadError):
+        stream(body(), [], [])
@@ -0,0 +1,144 @@
+import json
+
+import fakeredis
+import pytest
+
+from jobstore import (
+    job_channel, job_key, list_job_ids, load_job, save_job, set_job_status, status_index,
+    update_conversions
+)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def add_job(client, job_id, minute, status="completed"):
+    save_job(client, {
+        "job_id": job_id,
+        "status": status,
+        "started_at": f"2024-01-01T00:{minute:02d}:00",
+        "conversions": {}
+    })
+
+
+def all_pages(client, limit, **kwargs):
+    pages, cursor = [], None
+    while True:
+        job_ids, total, cursor = list_job_ids(client, cursor=cursor, limit=limit, **kwargs)
+        pages.append(job_ids)
+        if not cursor:
+            return pages, total
+
+
+def test_pages_are_newest_first_and_cover_every_job(client):
+    for i in range(7):
+        add_job(client, f"job-{i}", i)
+
+    pages, total = all_pages(client, limit=3)
+
+    assert total == 7
+    assert pages == [["job-6", "job-5", "job-4"], ["job-3", "job-2", "job-1"], ["job-0"]]
+
+
+def test_jobs_started_at_the_same_time_are_not_repeated_or_lost(client):
+    for i in range(5):
+        add_job(client, f"job-{i}", 1)
+    add_job(client, "older", 0)
+
+    pages, _ = all_pages(client, limit=2)
+
+    assert [job_id for page in pages for job_id in page] == [
+        "job-4", "job-3", "job-2", "job-1", "job-0", "older"
+    ]
+
+
+def test_cursor_is_unaffected_by_new_jobs(client):
+    for i in range(4):
+        add_job(client, f"job-{i}", i)
+    first, _, cursor = list_job_ids(client, limit=2)
+
+    add_job(client, "newer", 30)
+    second, total, _ = list_job_ids(client, cursor=cursor, limit=2)
+
+    assert first == ["job-3", "job-2"]
+    assert second == ["job-1", "job-0"]
+    assert total == 5
+
+
+def test_pages_can_be_filtered_by_status(client):
+    add_job(client, "done", 0)
+    add_job(client, "broken", 1, status="failed")
+    add_job(client, "running", 2, status="processing")
+
+    assert list_job_ids(client, status="failed") == (["broken"], 1, None)
+
+
+def test_malformed_cursor_is_refused(client):
+    add_job(client, "job-0", 0)
+
+    with pytest.raises(ValueError):
+        list_job_ids(client, cursor="not-a-cursor")
+
+
+def events(client, job_id):
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(job_channel(job_id))
+    pubsub.get_message(timeout=1)
+    return pubsub
+
+
+def next_event(pubsub):
+    message = pubsub.get_message(timeout=1)
+    return json.loads(message["data"])
+
+
+def test_job_records_round_trip(client):
+    job = {
+        "job_id": "job", "status": "processing", "started_at": "2024-01-01T00:00:00",
+        "resolutions": ["720p"], "progress": 0, "error": None,
+        "conversions": {"720p": {"resolution": "720p", "status": "pending", "progress": 0}}
+    }
+    save_job(client, job)
+
+    assert load_job(client, "job") == {key: value for key, value in job.items() if value is not None}
+
+
+def test_progress_is_the_mean_of_renditions_that_are_not_skipped(client):
+    save_job(client, {
+        "job_id": "job", "status": "processing", "started_at": "2024-01-01T00:00:00",
+        "conversions": {
+            "1080p": {"status": "processing", "progress": 0},
+            "720p": {"status": "processing", "progress": 0},
+            "4K": {"status": "skipped", "progress": 0}
+        }
+    })
+    pubsub = events(client, "job")
+
+    assert update_conversions(client, "job", {"1080p": {"progress": 40}}) == 20
+    assert next_event(pubsub) == {"conv:1080p:progress": "40", "progress": "20"}
+    assert update_conversions(client, "job", {"720p": {"progress": 100, "status": "completed"}}) == 70
+
+    job = load_job(client, "job")
+    assert job["progress"] == 70
+    assert job["conversions"]["720p"] == {"status": "completed", "progress": 100}
+    assert job["conversions"]["1080p"]["status"] == "processing"
+
+
+def test_progress_updates_to_a_deleted_job_are_dropped(client):
+    assert update_conversions(client, "gone", {"720p": {"progress": 50}}) is None
+    assert not client.exists(job_key("gone"))
+
+
+def test_status_changes_move_the_job_between_indexes(client):
+    add_job(client, "job", 0, status="processing")
+    pubsub = events(client, "job")
+
+    assert set_job_status(client, "job", "failed", error="boom")
+
+    assert client.zrange(status_index("processing"), 0, -1) == []
+    assert client.zrange(status_index("failed"), 0, -1) == ["job"]
+    assert next_event(pubsub) == {"status": "failed", "error": "boom"}
+    assert load_job(client, "job")["error"] == "boom"
+    assert not set_job_status(client, "gone", "failed")
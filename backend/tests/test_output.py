@@ -0,0 +1,168 @@
+import gc
+import os
+import socket
+
+import pytest
+
+import output
+from gcs import abandon_writer
+from output import ProgressiveUpload, composite_upload, upload_file
+
+emulator = pytest.importorskip("gcp_storage_emulator.server")
+storage = pytest.importorskip("google.cloud.storage")
+
+BUCKET = "test-videos"
+# Smallest part size that is still a valid resumable upload chunk, so a
+# composite upload of a few MiB has several parts
+CHUNK_SIZE = 256 * 1024
+# gcp-storage-emulator finalizes a streamed upload on its first chunk, as it
+# does not accept the unknown total size ("bytes 0-N/*") of the chunks
+# before the last, so writers are given less than one chunk here. The data
+# still reaches them in several writes.
+WRITER_CHUNK_SIZE = 8 * CHUNK_SIZE
+WRITER_DATA_SIZE = 7 * CHUNK_SIZE + 99
+
+
+@pytest.fixture(scope="module")
+def bucket():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = emulator.create_server("127.0.0.1", port, in_memory=True, default_bucket=BUCKET)
+    server.start()
+    host = os.environ.get("STORAGE_EMULATOR_HOST")
+    os.environ["STORAGE_EMULATOR_HOST"] = f"http://127.0.0.1:{port}"
+    try:
+        yield storage.Client(project="test").bucket(BUCKET)
+    finally:
+        if host is None:
+            del os.environ["STORAGE_EMULATOR_HOST"]
+        else:
+            os.environ["STORAGE_EMULATOR_HOST"] = host
+        server.stop()
+
+
+@pytest.fixture
+def chunk_sizes(monkeypatch):
+    monkeypatch.setattr(output, "OUTPUT_CHUNK_SIZE", WRITER_CHUNK_SIZE)
+    monkeypatch.setattr(output, "COMPOSITE_PART_SIZE", CHUNK_SIZE)
+
+
+def names(bucket, prefix):
+    return [blob.name for blob in bucket.list_blobs(prefix=prefix)]
+
+
+def write_source(tmp_path, size):
+    data = os.urandom(size)
+    path = tmp_path / "rendition.mp4"
+    path.write_bytes(data)
+    return str(path), data
+
+
+def test_upload_file_sets_type_and_metadata(bucket, tmp_path):
+    path, data = write_source(tmp_path, 1000)
+
+    upload_file(bucket.blob("small/720p.mp4"), path)
+
+    blob = bucket.get_blob("small/720p.mp4")
+    assert blob.download_as_bytes() == data
+    assert blob.content_type == output.OUTPUT_CONTENT_TYPE
+    assert blob.metadata == output.OUTPUT_METADATA
+
+
+def test_composite_upload_joins_parts_and_removes_them(bucket, tmp_path, chunk_sizes):
+    size = 5 * CHUNK_SIZE + 123
+    path, data = write_source(tmp_path, size)
+
+    composite_upload(bucket.blob("composite/1080p.mp4"), path, size)
+
+    assert bucket.blob("composite/1080p.mp4").download_as_bytes() == data
+    assert names(bucket, "composite/") == ["composite/1080p.mp4"]
+
+
+def test_composite_upload_never_exceeds_the_compose_limit(bucket, tmp_path, chunk_sizes, monkeypatch):
+    monkeypatch.setattr(output, "MAX_COMPOSE_PARTS", 3)
+    size = 10 * CHUNK_SIZE
+    path, data = write_source(tmp_path, size)
+    composed = []
+    compose = storage.Blob.compose
+    monkeypatch.setattr(storage.Blob, "compose", lambda blob, parts, **kwargs: (
+        composed.append(len(parts)), compose(blob, parts, **kwargs)
+    ))
+
+    composite_upload(bucket.blob("limit/1080p.mp4"), path, size)
+
+    assert composed == [3]
+    assert bucket.blob("limit/1080p.mp4").download_as_bytes() == data
+
+
+def test_failed_composite_upload_leaves_nothing(bucket, tmp_path, chunk_sizes, monkeypatch):
+    size = 3 * CHUNK_SIZE
+    path, _ = write_source(tmp_path, size)
+
+    def fail(blob, parts, **kwargs):
+        raise RuntimeError("compose failed")
+
+    monkeypatch.setattr(storage.Blob, "compose", fail)
+    with pytest.raises(RuntimeError):
+        composite_upload(bucket.blob("failed/1080p.mp4"), path, size)
+
+    assert names(bucket, "failed/") == []
+
+
+def write_to_pipe(upload, data):
+    with os.fdopen(os.dup(upload.fd), 'wb') as pipe:
+        pipe.write(data)
+
+
+def test_progressive_upload_commits_on_success(bucket, chunk_sizes):
+    data = os.urandom(WRITER_DATA_SIZE)
+    upload = ProgressiveUpload(bucket.blob("progressive/720p.mp4"))
+    assert upload.target == f"pipe:{upload.fd}"
+
+    write_to_pipe(upload, data)
+    upload.finish(True)
+
+    blob = bucket.get_blob("progressive/720p.mp4")
+    assert blob.download_as_bytes() == data
+    assert blob.content_type == output.OUTPUT_CONTENT_TYPE
+
+
+def test_progressive_upload_stores_nothing_on_failure(bucket, chunk_sizes):
+    upload = ProgressiveUpload(bucket.blob("progressive/failed.mp4"))
+    write_to_pipe(upload, os.urandom(WRITER_DATA_SIZE))
+    upload.finish(False)
+    del upload
+    gc.collect()
+
+    assert bucket.get_blob("progressive/failed.mp4") is None
+
+
+def test_progressive_upload_refuses_empty_output(bucket, chunk_sizes):
+    upload = ProgressiveUpload(bucket.blob("progressive/empty.mp4"))
+    with pytest.raises(Exception, match="no output"):
+        upload.finish(True)
+    del upload
+    gc.collect()
+
+    assert bucket.get_blob("progressive/empty.mp4") is None
+
+
+def test_abandoned_writer_is_not_committed_when_collected(bucket):
+    writer = bucket.blob("abandoned/video.mp4").open('wb', chunk_size=WRITER_CHUNK_SIZE)
+    writer.write(os.urandom(WRITER_DATA_SIZE))
+    abandon_writer(writer)
+    del writer
+    gc.collect()
+
+    assert bucket.get_blob("abandoned/video.mp4") is None
+
+
+def test_closed_writer_is_committed(bucket):
+    # The behaviour abandon_writer guards against: closing commits the object
+    data = os.urandom(WRITER_DATA_SIZE)
+    writer = bucket.blob("closed/video.mp4").open('wb', chunk_size=WRITER_CHUNK_SIZE)
+    writer.write(data)
+    writer.close()
+
+    assert bucket.blob("closed/video.mp4").download_as_bytes() == data
@@ -0,0 +1,84 @@
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+from packaging import MANIFEST_NAME, keyframe_args, package_args, sign_manifest
+
+MASTER = """#EXTM3U
+#EXT-X-VERSION:7
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="group_A1",NAME="audio_1",DEFAULT=YES,URI="media_1.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=106489,RESOLUTION=320x180,AUDIO="group_A1"
+media_0.m3u8
+"""
+
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MAP:URI="init-0.m4s"
+#EXTINF:4.000000,
+chunk-0-00001.m4s
+#EXTINF:1.000000,
+chunk-0-00002.m4s
+#EXT-X-ENDLIST
+"""
+
+MPD = """<SegmentList timescale="1000000" duration="4000000" startNumber="1">
+    <Initialization sourceURL="init-0.m4s" />
+    <SegmentURL media="chunk-0-00001.m4s" />
+</SegmentList>
+"""
+
+
+def sign(segment):
+    return f"https://storage.example/{segment}?X-Goog-Expires=600&X-Goog-Signature=abc"
+
+
+def test_hls_master_keeps_playlists_relative():
+    assert sign_manifest("master.m3u8", MASTER, sign) == MASTER
+
+
+def test_hls_media_playlist_signs_the_init_and_every_segment():
+    signed = sign_manifest("media_0.m3u8", MEDIA, sign)
+
+    assert f'#EXT-X-MAP:URI="{sign("init-0.m4s")}"' in signed
+    assert sign("chunk-0-00001.m4s") + "\n" in signed
+    assert sign("chunk-0-00002.m4s") + "\n" in signed
+    assert "#EXTINF:1.000000," in signed
+
+
+def test_dash_urls_are_signed_and_escaped():
+    signed = sign_manifest("manifest.mpd", MPD, sign)
+
+    assert 'sourceURL="https://storage.example/init-0.m4s?X-Goog-Expires=600&amp;X-Goog-Signature=abc"' in signed
+    assert 'media="https://storage.example/chunk-0-00001.m4s?X-Goog-Expires=600&amp;' in signed
+    assert 'timescale="1000000"' in signed
+
+
+def test_only_manifests_are_served():
+    assert MANIFEST_NAME.match("media_12.m3u8")
+    assert not MANIFEST_NAME.match("chunk-0-00001.m4s")
+    assert not MANIFEST_NAME.match("../master.m3u8")
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="needs ffmpeg")
+def test_every_packaged_segment_is_signed(tmp_path):
+    subprocess.run(
+        ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=size=320x180:rate=25', '-f', 'lavfi', '-i', 'sine',
+         '-t', '9', '-map', '0:v', '-map', '1:a', '-c:v', 'libx264', '-c:a', 'aac']
+        + keyframe_args() + package_args(True, str(tmp_path)),
+        check=True
+    )
+    segments = {name for name in os.listdir(tmp_path) if name.endswith('.m4s')}
+    manifests = [name for name in os.listdir(tmp_path) if MANIFEST_NAME.match(name)]
+    assert len(manifests) == 4
+
+    referenced = set()
+    for name in manifests:
+        signed = sign_manifest(name, (tmp_path / name).read_text(), sign)
+        referenced.update(re.findall(r'https://storage\.example/([^?]+)\?', signed))
+        # Nothing is left pointing at storage without a signature
+        assert not re.search(r'(?<!/)\b(init|chunk)-[\w-]+\.m4s\b(?!\?)', signed)
+
+    assert referenced == segments
@@ -0,0 +1,49 @@
+import threading
+
+import probe
+from probe import get_media_info, probe_cache_key
+
+
+def test_url_keys_keep_the_query_but_not_the_signature():
+    signed = (
+        "https://storage.googleapis.com/bucket/uploads/a.mp4"
+        "?X-Goog-Algorithm=GOOG4-RSA-SHA256&X-Goog-Credential=x&X-Goog-Date=1"
+        "&X-Goog-Expires=3600&X-Goog-SignedHeaders=host&X-Goog-Signature=abc"
+    )
+    resigned = signed.replace("X-Goog-Date=1", "X-Goog-Date=2").replace("abc", "def")
+
+    assert probe_cache_key(signed) == probe_cache_key(resigned)
+    assert probe_cache_key(signed) == "url:https://storage.googleapis.com/bucket/uploads/a.mp4"
+    assert probe_cache_key("https://example.com/video?id=1") != probe_cache_key("https://example.com/video?id=2")
+    assert probe_cache_key("https://example.com/v?a=1&b=2") == probe_cache_key("https://example.com/v?b=2&a=1")
+
+
+def test_file_keys_follow_content(tmp_path):
+    first, second, other = tmp_path / "a.mp4", tmp_path / "b.mp4", tmp_path / "c.mp4"
+    first.write_bytes(b"x" * 5000)
+    second.write_bytes(b"x" * 5000)
+    other.write_bytes(b"y" * 5000)
+
+    assert probe_cache_key(str(first)) == probe_cache_key(str(second))
+    assert probe_cache_key(str(first)) != probe_cache_key(str(other))
+
+
+def test_memory_cache_is_bounded_under_concurrent_jobs(monkeypatch):
+    monkeypatch.setattr(probe, "_memory_cache", type(probe._memory_cache)())
+    monkeypatch.setattr(probe, "PROBE_MEMORY_CACHE_SIZE", 8)
+    monkeypatch.setattr(probe, "probe_media", lambda source: {
+        "width": 1280, "height": 720, "duration": 1.0, "video_codec": "h264", "audio_codec": None
+    })
+    monkeypatch.setattr("builtins.print", lambda *args, **kwargs: None)
+
+    def probe_many(start):
+        for i in range(start, start + 200):
+            assert get_media_info(f"https://example.com/v?id={i % 20}")["cache_key"].startswith("url:")
+
+    threads = [threading.Thread(target=probe_many, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(probe._memory_cache) == 8
@@ -0,0 +1,76 @@
+import subprocess
+import sys
+
+from progress import MAX_RUNNING_PROGRESS, ProgressMonitor, encode_stats, out_time_seconds
+
+BLOCK = """frame=120
+fps=59.8
+bitrate=2048.5kbits/s
+out_time_us=4000000
+out_time=00:00:04.000000
+speed=2.0x
+progress={state}
+"""
+
+# Stands in for ffmpeg: three progress blocks on stdout, stats lines ending
+# in carriage returns and an error on stderr
+FAKE_FFMPEG = f"""
+import sys
+for seconds, state in ((2, 'continue'), (4, 'continue'), (10, 'end')):
+    sys.stdout.write({BLOCK!r}.replace('4000000', str(seconds * 1000000)).format(state=state))
+    sys.stdout.flush()
+    sys.stderr.write('frame=%d fps=60\\r' % (seconds * 30))
+sys.stderr.write('last line\\n')
+sys.exit(3)
+"""
+
+
+def block(text):
+    return dict(line.split('=', 1) for line in text.splitlines())
+
+
+def test_encode_stats_parses_a_progress_block():
+    stats = encode_stats(block(BLOCK.format(state="continue")), duration=10)
+
+    assert stats == {
+        "frame": 120, "fps": 59.8, "speed": 2.0, "bitrate_kbps": 2048.5,
+        "out_seconds": 4.0, "eta_seconds": 3.0
+    }
+
+
+def test_values_not_yet_known_are_none():
+    stats = encode_stats({"frame": "0", "fps": "0.00", "bitrate": "N/A", "speed": "N/A",
+                          "out_time_us": "N/A", "out_time": "N/A", "progress": "continue"}, duration=10)
+
+    assert stats["speed"] is None
+    assert stats["bitrate_kbps"] is None
+    assert stats["out_seconds"] is None
+    assert stats["eta_seconds"] is None
+
+
+def test_out_time_falls_back_to_older_fields():
+    assert out_time_seconds({"out_time_ms": "1500000"}) == 1.5
+    assert out_time_seconds({"out_time": "01:02:03.500000"}) == 3723.5
+    assert out_time_seconds({"out_time_us": "-5"}) == 0
+
+
+def test_monitor_throttles_updates_and_keeps_the_stderr_tail():
+    published = []
+    process = subprocess.Popen([sys.executable, "-c", FAKE_FFMPEG], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    monitor = ProgressMonitor(10, lambda percent, stats: published.append((percent, stats)), interval=3600)
+
+    assert monitor.follow(process) == 3
+
+    # The first block, then the last once ffmpeg has exited
+    assert [percent for percent, _ in published] == [20, MAX_RUNNING_PROGRESS]
+    assert published[-1][1]["eta_seconds"] == 0
+    assert monitor.stderr_tail(2) == "frame=300 fps=60\nlast line"
+
+
+def test_failing_callback_does_not_stop_the_monitor():
+    process = subprocess.Popen([sys.executable, "-c", FAKE_FFMPEG], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def fail(percent, stats):
+        raise RuntimeError("redis is down")
+
+    assert ProgressMonitor(10, fail, interval=0).follow(process) == 3
@@ -0,0 +1,80 @@
+import pytest
+
+import renditions
+from renditions import PROFILES, Resolution, apply_profile, plan_renditions
+
+HD = {"width": 1920, "height": 1080}
+
+
+def sizes(planned):
+    return [(r["resolution"], r["width"], r["height"]) for r in planned]
+
+
+def test_renditions_are_sized_to_the_source_aspect_ratio():
+    planned, skipped = plan_renditions(["720p", "360p"], {"width": 1920, "height": 800})
+
+    assert sizes(planned) == [("720p", 1728, 720), ("360p", 864, 360)]
+    assert skipped == {}
+
+
+def test_portrait_sources_match_the_short_side():
+    planned, _ = plan_renditions(["720p"], {"width": 1080, "height": 1920})
+
+    assert sizes(planned) == [("720p", 720, 1280)]
+
+
+def test_order_is_kept_and_duplicates_dropped():
+    planned, _ = plan_renditions(["360p", "1080p", "360p", "720p"], HD)
+
+    assert [r["resolution"] for r in planned] == ["360p", "1080p", "720p"]
+
+
+def test_cap_encodes_the_smallest_upscale_at_source_size(monkeypatch):
+    monkeypatch.setattr(renditions, "UPSCALE_POLICY", "cap")
+    source = {"width": 1280, "height": 534}
+
+    planned, skipped = plan_renditions(["4K", "1080p", "720p", "360p"], source)
+
+    assert sizes(planned) == [("720p", 1280, 534), ("360p", 862, 360)]
+    assert planned[0]["capped"]
+    assert set(skipped) == {"4K", "1080p"}
+    assert "capped to source size as 720p" in skipped["4K"]
+
+
+def test_cap_is_not_needed_when_a_rendition_already_matches_the_source(monkeypatch):
+    monkeypatch.setattr(renditions, "UPSCALE_POLICY", "cap")
+
+    planned, skipped = plan_renditions(["4K", "1080p"], HD)
+
+    assert sizes(planned) == [("1080p", 1920, 1080)]
+    assert "would upscale" in skipped["4K"]
+
+
+def test_skip_drops_every_upscale(monkeypatch):
+    monkeypatch.setattr(renditions, "UPSCALE_POLICY", "skip")
+
+    planned, skipped = plan_renditions(["1080p", "720p"], {"width": 640, "height": 360})
+
+    assert planned == []
+    assert set(skipped) == {"1080p", "720p"}
+
+
+def test_unknown_resolutions_are_refused():
+    with pytest.raises(ValueError):
+        plan_renditions(["720p", "8K"], HD)
+    with pytest.raises(ValueError):
+        Resolution.from_string(720)
+
+
+def test_sources_without_video_are_refused():
+    with pytest.raises(ValueError):
+        plan_renditions(["720p"], {"width": None, "height": None})
+
+
+def test_fast_profile_caps_fps_and_copies_aac():
+    planned, _ = plan_renditions(["720p"], HD)
+
+    apply_profile(planned, PROFILES["fast"], {"frame_rate": 59.94, "audio_codec": "aac"})
+
+    assert planned[0]["fps"] == 30
+    assert planned[0]["audio_args"] == ["-c:a", "copy"]
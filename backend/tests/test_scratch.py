@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+import pytest
+
+import scratch
+from scratch import ScratchSpace, clean_orphans, rendition_bytes
+
+Usage = namedtuple("Usage", "total used free")
+
+
+@pytest.fixture
+def free_space(monkeypatch):
+    """Pretend the scratch filesystem has `free_space["bytes"]` free."""
+    free = {"bytes": 10 ** 12}
+    monkeypatch.setattr(scratch.shutil, "disk_usage", lambda path: Usage(0, 0, free["bytes"]))
+    monkeypatch.setattr(scratch, "SCRATCH_POLL_INTERVAL", 0.05)
+    return free
+
+
+def test_reservations_stay_within_the_quota(tmp_path, free_space):
+    space = ScratchSpace(str(tmp_path), quota=100)
+    first = space.acquire("a", 60)
+
+    assert os.path.isdir(first)
+    assert space.acquire("b", 60, timeout=0.1) is None
+    space.release(first)
+    assert not os.path.exists(first)
+    assert space.acquire("b", 60, timeout=0.1)
+    assert space.in_use == 60
+
+
+def test_requests_are_granted_in_arrival_order(tmp_path, free_space):
+    space = ScratchSpace(str(tmp_path), quota=100)
+    first = space.acquire("a", 60)
+    granted = []
+    waiter = threading.Thread(target=lambda: granted.append(space.acquire("b", 60, timeout=5)))
+    waiter.start()
+    while not space._waiting:
+        time.sleep(0.01)
+
+    # Fits, but would overtake the request already waiting
+    assert space.acquire("c", 30, timeout=0.1) is None
+    # Requests for no space do not wait their turn
+    assert space.acquire("d", 0, timeout=0)
+
+    space.release(first)
+    waiter.join()
+    assert granted == [os.path.join(str(tmp_path), "b")]
+
+
+def test_oversized_requests_run_alone(tmp_path, free_space):
+    space = ScratchSpace(str(tmp_path), quota=100)
+    small = space.acquire("a", 10)
+
+    assert space.acquire("big", 500, timeout=0.1) is None
+    space.release(small)
+    assert space.acquire("big", 500, timeout=0.1)
+    assert space.in_use == 100
+
+
+def test_space_reserved_but_not_yet_written_is_kept_free(tmp_path, free_space):
+    free_space["bytes"] = 1000
+    space = ScratchSpace(str(tmp_path), quota=10 ** 6, headroom=200)
+    first = space.acquire("a", 500)
+
+    # 800 free above the headroom, 500 of it promised to the first job
+    assert space.acquire("b", 400, timeout=0.1) is None
+    with open(os.path.join(first, "out.mp4"), "wb") as f:
+        f.write(b"x" * 200)
+    free_space["bytes"] -= 200
+    assert space.acquire("b", 300, timeout=0.1)
+
+
+def test_default_quota_is_the_free_space_less_headroom(tmp_path, free_space):
+    free_space["bytes"] = 5000
+
+    assert ScratchSpace(str(tmp_path), headroom=1000).quota == 4000
+
+
+def test_capped_renditions_are_sized_at_their_maxrate(monkeypatch):
+    monkeypatch.setattr(scratch, "SCRATCH_SAFETY_FACTOR", 1.0)
+    media = {"duration": 10.0, "frame_rate": 25}
+    capped = {"width": 1280, "height": 720, "video_args": ["-crf", "23", "-maxrate", "3000k"]}
+    uncapped = {"width": 1280, "height": 720, "video_args": ["-crf", "23"]}
+
+    assert rendition_bytes(capped, media) == 3_750_000
+    assert rendition_bytes(uncapped, media, duration=2.0) == int(1280 * 720 * 25 * scratch.SCRATCH_BITS_PER_PIXEL * 2 / 8)
+
+
+def test_orphans_of_dead_workers_are_removed_after_the_grace_period(tmp_path, monkeypatch):
+    monkeypatch.setattr(scratch, "SCRATCH_DIR", str(tmp_path))
+    monkeypatch.setattr(scratch, "TMPFS_DIR", None)
+    for name in ("me", "live", "dead", "fresh"):
+        os.makedirs(tmp_path / name / "job")
+    old = time.time() - 3600
+    for name in ("me", "live", "dead"):
+        os.utime(tmp_path / name, (old, old))
+    monkeypatch.setattr("builtins.print", lambda *args, **kwargs: None)
+
+    clean_orphans("me", ["me", "live"], grace=600)
+
+    assert sorted(os.listdir(tmp_path)) == ["fresh", "live"]
@@ -0,0 +1,127 @@
+import fakeredis
+import pytest
+
+import segments
+from segments import (
+    SEGMENT_QUEUE, claim_segment, create_segments, finish_segment, orphaned_segments,
+    renew_segment_leases, requeue_segment, resumable_run, return_segment, segment_lease_key, segment_states,
+    segment_task
+)
+
+RENDITIONS = [{"resolution": "720p", "width": 1280, "height": 720, "video_args": ["-crf", "23"]}]
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def test_segments_are_queued_in_order_and_leased_when_claimed(client):
+    create_segments(client, "job", "r1", RENDITIONS, [60.0, 60.0, 12.5])
+
+    claimed = [claim_segment(client, f"w-{i}", timeout=1) for i in range(3)]
+    assert [task for task, _ in claimed] == [segment_task("job", "r1", i) for i in range(3)]
+    task, state = claimed[2]
+    assert state["2:status"] == "running"
+    assert state["2:worker"] == "w-2"
+    assert float(state["2:duration"]) == 12.5
+    assert client.get(segment_lease_key(task)) == "w-2"
+
+
+def test_tasks_of_an_earlier_run_are_skipped(client):
+    create_segments(client, "job", "r1", RENDITIONS, [60.0])
+    create_segments(client, "job", "r2", RENDITIONS, [60.0])
+
+    assert claim_segment(client, "w-0", timeout=1) is None
+    task, _ = claim_segment(client, "w-0", timeout=1)
+    assert task == segment_task("job", "r2", 0)
+
+
+def test_renewal_does_not_take_back_a_requeued_segment(client):
+    create_segments(client, "job", "r1", RENDITIONS, [60.0])
+    task, _ = claim_segment(client, "slow", timeout=1)
+    assert renew_segment_leases(client, "slow", [task]) == []
+
+    # The slow worker misses its renewals, the coordinator requeues the
+    # segment and another worker claims it
+    client.delete(segment_lease_key(task))
+    assert orphaned_segments(client, "job", "r1", segment_states(client, "job")) == [0]
+    assert requeue_segment(client, "job", "r1", 0)
+    assert claim_segment(client, "fast", timeout=1)[0] == task
+
+    assert renew_segment_leases(client, "slow", [task]) == [task]
+    assert client.get(segment_lease_key(task)) == "fast"
+    assert renew_segment_leases(client, "fast", [task]) == []
+
+
+def test_queued_and_leased_segments_are_not_orphaned(client):
+    create_segments(client, "job", "r1", RENDITIONS, [60.0, 60.0, 60.0])
+    running, _ = claim_segment(client, "w-0", timeout=1)
+    finish_segment(client, running, "done")
+    claim_segment(client, "w-1", timeout=1)
+
+    assert orphaned_segments(client, "job", "r1", segment_states(client, "job")) == []
+
+
+def test_requeue_gives_up_after_max_attempts(client, monkeypatch):
+    monkeypatch.setattr(segments, "MAX_JOB_ATTEMPTS", 2)
+    create_segments(client, "job", "r1", RENDITIONS, [60.0])
+    client.delete(SEGMENT_QUEUE)
+
+    assert requeue_segment(client, "job", "r1", 0)
+    assert requeue_segment(client, "job", "r1", 0)
+    assert not requeue_segment(client, "job", "r1", 0)
+    assert client.lrange(SEGMENT_QUEUE, 0, -1) == [segment_task("job", "r1", 0)] * 2
+
+
+def test_returned_segment_does_not_count_an_attempt(client):
+    create_segments(client, "job", "r1", RENDITIONS, [60.0])
+    task, _ = claim_segment(client, "w-0", timeout=1)
+
+    assert return_segment(client, task)
+    assert not client.exists(segment_lease_key(task))
+    state = segment_states(client, "job")[0]
+    assert state["status"] == "queued"
+    assert state["attempts"] == 0
+    assert claim_segment(client, "w-1", timeout=1)[0] == task
+
+
+def test_results_of_a_replaced_run_are_dropped(client):
+    create_segments(client, "job", "r1", RENDITIONS, [60.0])
+    task, _ = claim_segment(client, "w-0", timeout=1)
+    create_segments(client, "job", "r2", RENDITIONS, [60.0])
+
+    assert not finish_segment(client, task, "done")
+    assert segment_states(client, "job")[0]["status"] == "queued"
+
+
+def test_an_interrupted_run_is_resumed_for_the_same_renditions(client):
+    renditions = RENDITIONS + [{"resolution": "360p", "width": 640, "height": 360, "video_args": ["-crf", "23"]}]
+    create_segments(client, "job", "r1", renditions, [60.0, 60.0], output_format="webm")
+
+    assert resumable_run(client, "job", renditions, output_format="webm") == ("r1", 2)
+    assert resumable_run(client, "job", RENDITIONS, output_format="webm") == ("r1", 2)
+    assert resumable_run(client, "job", renditions, output_format="mp4") is None
+    changed = [dict(RENDITIONS[0], video_args=["-crf", "18"])]
+    assert resumable_run(client, "job", changed, output_format="webm") is None
+    assert resumable_run(client, "other", renditions) is None
+
+
+def test_resumed_run_requeues_only_the_segments_that_were_lost(client):
+    create_segments(client, "job", "r1", RENDITIONS, [60.0, 60.0, 60.0])
+    done, _ = claim_segment(client, "dead", timeout=1)
+    finish_segment(client, done, "done")
+    lost, _ = claim_segment(client, "dead", timeout=1)
+    held, _ = claim_segment(client, "live", timeout=1)
+    # The coordinating worker died and so did the lease of the segment it held
+    client.delete(segment_lease_key(lost))
+
+    run, count = resumable_run(client, "job", RENDITIONS)
+    assert (run, count) == ("r1", 3)
+    states = segment_states(client, "job")
+    assert orphaned_segments(client, "job", run, states) == [1]
+    assert requeue_segment(client, "job", run, 1)
+
+    assert states[0]["status"] == "done"
+    assert client.lrange(SEGMENT_QUEUE, 0, -1) == [lost]
+    assert client.get(segment_lease_key(held)) == "live"
@@ -20,9 +20,11 @@ import { CloudStatus } from "@/components/CloudStatus";
 import { DevelopedByModal } from "@/components/DevelopedByModal";
 import { Job } from "@/lib/types";
 import { API_CONFIG } from "@/lib/config";
+import { api } from "@/lib/api";
 
 const SUPPORTED_VIDEO_FORMATS = ['video/mp4', 'video/quicktime', 'video/x-msvideo'];
 const MAX_FILE_SIZE = 500 * 1024 * 1024; // 500MB in bytes
+const MAX_STREAMED_JOBS = 4;
 
 export default function Home() {
   const [selectedFile, setSelectedFile] = useState<File | null>(null);
@@ -41,6 +43,21 @@ export default function Home() {
   });
   const [jobs, setJobs] = useState<Job[]>([]);
 
+  // Transform backend job format to frontend format
+  const transformJob = (job: any): Job => ({
+    id: job.job_id,
+    status: job.status.toLowerCase(),
+    name: job.job_data?.input_url?.split('/').pop() || 'Unknown',
+    createdAt: job.started_at,
+    provider: job.job_data?.cloud_provider || 'auto',
+    resolutions: job.job_data?.resolutions || [],
+    progress: Object.values(job.conversions).reduce((acc: number, conv: any) => acc + conv.progress, 0) / 
+             Object.keys(job.conversions).length,
+    duration: job.completed_at ? 
+      String(new Date(job.completed_at).getTime() - new Date(job.started_at).getTime()) : 
+      '-',
+  });
+
   // Fetch jobs from backend
   const fetchJobs = async () => {
     try {
@@ -49,21 +66,7 @@ export default function Home() {
         throw new Error(`Failed to fetch jobs: ${response.statusText}`);
       }
       const data = await response.json();
-      // Transform backend job format to frontend format
-      const transformedJobs = data.jobs.map((job: any) => ({
-        id: job.job_id,
-        status: job.status.toLowerCase(),
-        name: job.job_data?.input_url?.split('/').pop() || 'Unknown',
-        createdAt: job.started_at,
-        provider: job.job_data?.cloud_provider || 'auto',
-        resolutions: job.job_data?.resolutions || [],
-        progress: Object.values(job.conversions).reduce((acc: number, conv: any) => acc + conv.progress, 0) / 
-                 Object.keys(job.conversions).length,
-        duration: job.completed_at ? 
-          new Date(job.completed_at).getTime() - new Date(job.started_at).getTime() : 
-          '-',
-      }));
-      setJobs(transformedJobs);
+      setJobs(data.jobs.map(transformJob));
     } catch (error) {
       console.error('Error fetching jobs:', error);
       toast.error('Failed to fetch processing jobs');
@@ -72,11 +75,32 @@ export default function Home() {
 
   useEffect(() => {
     fetchJobs();
-    // Poll for updates every 5 seconds
-    const interval = setInterval(fetchJobs, 5000);
+    // Refresh the list now and then for jobs submitted elsewhere; running
+    // jobs push their progress below
+    const interval = setInterval(fetchJobs, 30000);
     return () => clearInterval(interval);
   }, []);
 
+  // Stream progress for the jobs still running instead of polling them.
+  // Each stream holds a connection, and browsers allow few per server, so
+  // only the newest few are streamed; the rest update with the list.
+  const activeJobIds = jobs
+    .filter((job) => job.status !== 'completed' && job.status !== 'failed')
+    .slice(0, MAX_STREAMED_JOBS)
+    .map((job) => job.id)
+    .join(',');
+
+  useEffect(() => {
+    if (!activeJobIds) return;
+    const stops = activeJobIds.split(',').map((jobId) =>
+      api.watchJob(jobId, (job) => {
+        const updated = transformJob(job);
+        setJobs((current) => current.map((j) => (j.id === updated.id ? updated : j)));
+      })
+    );
+    return () => stops.forEach((stop) => stop());
+  }, [activeJobIds]);
+
   const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
     if (e.target.files && e.target.files[0]) {
       const file = e.target.files[0];
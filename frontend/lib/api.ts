@@ -91,6 +91,35 @@ export const api = {
     }
   },
 
+  // Follow a job over server-sent events. `onChange` gets the whole job as
+  // GET /jobs/{id} returns it each time it changes; the stream closes once
+  // the job completes or fails. Returns a function that stops watching.
+  watchJob(jobId: string, onChange: (job: any) => void): () => void {
+    const source = new EventSource(
+      `${API_CONFIG.BASE_URL}${API_CONFIG.ENDPOINTS.STATUS}/${jobId}/events`
+    );
+    let job: any = null;
+
+    source.addEventListener('snapshot', (event) => {
+      job = JSON.parse((event as MessageEvent).data);
+      onChange(job);
+      if (job.status === 'completed' || job.status === 'failed') {
+        source.close();
+      }
+    });
+    source.addEventListener('update', (event) => {
+      if (!job) return;
+      const { conversions, ...fields } = JSON.parse((event as MessageEvent).data);
+      job = { ...job, ...fields, conversions: { ...job.conversions } };
+      for (const [resolution, conversion] of Object.entries(conversions || {})) {
+        job.conversions[resolution] = { ...job.conversions[resolution], ...(conversion as object) };
+      }
+      onChange(job);
+    });
+
+    return () => source.close();
+  },
+
   async checkHealth(): Promise<boolean> {
     try {
       const response = await fetch(`${API_CONFIG.BASE_URL}${API_CONFIG.ENDPOINTS.HEALTH}`);